@@ -4,6 +4,8 @@ ArchitectureModule, Opcode, Operand, and Emulator objects.
 '''
 
 import types
+import array
+import bisect
 import struct
 import platform
 
@@ -66,6 +68,10 @@ import envi.memory as e_mem
 import envi.registers as e_reg
 import envi.memcanvas as e_canvas
 
+# The padding for parsing the last bytes of a linear sweep (longer than
+# any instruction we parse)
+opcode_pad_size = 32
+
 class ArchitectureModule:
     """
     An architecture module implementes methods to deal
@@ -143,6 +149,58 @@ class ArchitectureModule:
         '''
         raise ArchNotImplemented('archParseOpcode')
 
+    def archParseOpcodes(self, bytez, offset=0, va=0, count=None, endva=None):
+        '''
+        Linear sweep parse the opcodes from the given bytes (up to count
+        instructions and/or those starting before endva) into an
+        OpcodeArray of compact (va, size, opcode, iflags, branches)
+        records.  The sweep stops early at the first bytes which don't
+        parse (or an instruction cut off by the end of the bytes).  Any
+        exception from the decoder counts as bytes which don't parse, so
+        sweeping raw data never raises.
+
+        NOTE: each instruction is still parsed by archParseOpcode() (there
+              are no per-arch fast decoders) so this saves the memory of
+              the Opcode objects, not the time to parse them.
+
+        Example:
+            ops = a.archParseOpcodes(bytez, va=0x41414141, count=1000)
+            print('parsed up to 0x%.8x' % ops.endva)
+        '''
+        ops = OpcodeArray(self, bytez, offset, va)
+
+        maxoff = len(bytez)
+        if endva != None:
+            maxoff = min(maxoff, offset + (endva - va))
+
+        while offset < maxoff:
+            if count != None and len(ops) >= count:
+                break
+
+            try:
+                left = len(bytez) - offset
+                if left < opcode_pad_size:
+                    # Parse the last few bytes padded out so a cut off
+                    # instruction doesn't read past the end of them.
+                    op = self.archParseOpcode(str(bytez[offset:]) + '\x00' * opcode_pad_size, 0, va)
+                    if op.size > left:
+                        break
+                else:
+                    op = self.archParseOpcode(bytez, offset, va)
+
+            except Exception:
+                # (not every decoder raises InvalidInstruction for junk)
+                break
+
+            if op.size <= 0:
+                break
+
+            ops.addOpcode(op)
+            offset += op.size
+            va += op.size
+
+        return ops
+
     def archGetRegisterGroups(self):
         '''
         Returns a tuple of tuples of registers for different register groups.
@@ -588,7 +646,93 @@ class Opcode:
     def getOperands(self):
         return list(self.opers)
 
-class Emulator(e_reg.RegisterContext, e_mem.MemoryObject):
+class OpcodeArray:
+    '''
+    The results of a linear sweep (see ArchitectureModule.archParseOpcodes())
+    kept as arrays of (va, size, opcode, iflags) and the branches of each
+    instruction rather than as a list of Opcode objects.
+
+    Indexing returns a (va, size, opcode, iflags, branches) tuple where
+    opcode is the architecture specific numerical opcode and branches is
+    a tuple of the (bva, bflags) from Opcode.getBranches() (leaving out
+    any whose target can't be computed or wrapped below 0).  Use
+    getOpcode() for the full Opcode object.
+
+    Example:
+        ops = arch.archParseOpcodes(bytez, va=0x41410000)
+        for va, size, opcode, iflags, branches in ops:
+            if iflags & IF_CALL:
+                print(repr(ops.getOpcode(ops.index(va))))
+    '''
+    def __init__(self, arch, bytez, offset=0, va=0):
+        self.arch = arch
+        self.bytez = bytez
+        self.offset = offset
+        self.va = va
+        # The va after the last instruction (where the sweep stopped)
+        self.endva = va
+
+        self.vas = array.array('L')
+        self.sizes = array.array('L')
+        self.opcodes = array.array('l')
+        self.iflags = array.array('L')
+        # The branches of instruction i are brvas/brflags[brstarts[i]:brstarts[i+1]]
+        self.brstarts = array.array('L', [0])
+        self.brvas = array.array('L')
+        self.brflags = array.array('L')
+
+    def __len__(self):
+        return len(self.vas)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self.vas)
+        return (self.vas[idx], self.sizes[idx], self.opcodes[idx], self.iflags[idx], self.getBranches(idx))
+
+    def __iter__(self):
+        for idx in xrange(len(self.vas)):
+            yield self[idx]
+
+    def addOpcode(self, op):
+        self.vas.append(op.va)
+        self.sizes.append(op.size)
+        self.opcodes.append(op.opcode)
+        self.iflags.append(op.iflags)
+        for bva, bflags in op.getBranches():
+            if bva == None or bva < 0:
+                continue
+            self.brvas.append(bva)
+            self.brflags.append(bflags)
+        self.brstarts.append(len(self.brvas))
+        self.endva = op.va + op.size
+
+    def getBranches(self, idx):
+        '''
+        Return a tuple of the (bva, bflags) branches for the instruction
+        at the given index.
+        '''
+        start = self.brstarts[idx]
+        end = self.brstarts[idx+1]
+        return tuple(zip(self.brvas[start:end], self.brflags[start:end]))
+
+    def index(self, va):
+        '''
+        Return the index of the instruction at the given va (or -1).
+        '''
+        idx = bisect.bisect_left(self.vas, va)
+        if idx < len(self.vas) and self.vas[idx] == va:
+            return idx
+        return -1
+
+    def getOpcode(self, idx):
+        '''
+        Parse (again) and return the full Opcode object for the
+        instruction at the given index.
+        '''
+        va = self.vas[idx]
+        return self.arch.archParseOpcode(self.bytez, self.offset + (va - self.va), va)
+
+class Emulator(e_reg.RegisterContext, e_mem.CowMemoryObject):
     """
     The Emulator class is mostly "Abstract" in the java
     Interface sense.  The emulator should be able to
@@ -601,11 +745,14 @@ class Emulator(e_reg.RegisterContext, e_mem.MemoryObject):
     The intention is for "light weight" emulation to be
     implemented mostly for user-space emulation of
     protected mode execution.
+
+    (Emulator memory is a copy-on-write e_mem.CowMemoryObject, so the
+    snapshots from getEmuSnap() are cheap; see getEmuStats())
     """
     def __init__(self, archmod=None):
 
         self.metadata = {}
-        e_mem.MemoryObject.__init__(self, arch=archmod._arch_id)
+        e_mem.CowMemoryObject.__init__(self, arch=archmod._arch_id)
         e_reg.RegisterContext.__init__(self)
 
         self._emu_segments = [(0, 0xffffffff)]
@@ -688,6 +835,17 @@ class Emulator(e_reg.RegisterContext, e_mem.MemoryObject):
         self.setRegisterSnap(regs)
         self.setMemorySnap(mem)
 
+    def getEmuStats(self):
+        '''
+        Return a dict of emulator statistics (currently the memory
+        snapshot counters, including the pages/bytes copied on write).
+
+        Example:
+            emu.runFunction(fva)
+            print(emu.getEmuStats()['pages_copied'])
+        '''
+        return self.getMemorySnapStats()
+
     def executeOpcode(self, opobj):
         """
         This is the core method for the 
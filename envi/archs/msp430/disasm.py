@@ -820,7 +820,7 @@ class Msp430Disasm:
                 # Test to see of primary input is not opcode
                 if not (workData >> 12):
                     # Okay, something went wrong, so return the dirty word
-                    raise Exception("Decode Error 0")
+                    raise envi.InvalidInstruction(mesg="Decode Error 0", va=va)
 
                 ds_addr_mode = (workData & SOURCE_ADDR_MODE) >> 4
                 dsreg = workData & DEST_REG
@@ -829,7 +829,7 @@ class Msp430Disasm:
                 # Test op_dw here to ensure it is used correctly
                 if (((workData & SINGLE_OPCODE) >> 7) in [1,3,5,6]) and op_bw:
                     # Okay, something went wrong, so return the dirty word
-                    raise Exception("Decode Error 1")
+                    raise envi.InvalidInstruction(mesg="Decode Error 1", va=va)
                 if (ds_addr_mode == REG_INDEX) or (ds_addr_mode == REG_IND_AUTOINC):
                     dsopsize = 1
                 # It is a Single Opcode
@@ -841,7 +841,7 @@ class Msp430Disasm:
                         return Msp430Opcode( va, SP_OPCODE_TYPE, mnem, [], flags, opData.lenData())
                     else:
                         # Okay, something went wrong, so return the dirty word
-                        raise Exception('Decode Error 2')
+                        raise envi.InvalidInstruction(mesg="Decode Error 2", va=va)
                 else:
                     mnem, flags = scode[(workData & SINGLE_OPCODE) >> 7]
                     flags |= (op_bw << 8)
@@ -231,7 +231,7 @@ def thumb32_01(va, val, val2):
     elif (op2 & 0x40) == 0x40:
         raise Exception('# Coprocessor, Advanced SIMD, Floating point instrs')
     else:
-        raise InvalidInstruction(
+        raise envi.InvalidInstruction(
                 mesg="Thumb32 failure",
                 bytez=struct.pack("<H", val)+struct.pack("<H", val2), va=va)
     return ( olist, mnem, opcode, flags )
@@ -253,7 +253,7 @@ def thumb32_10(va, val, val2):
         raise Exception('# Branches and miscellaneous control')
 
     else:
-        raise InvalidInstruction(
+        raise envi.InvalidInstruction(
                 mesg="Thumb32 failure",
                 bytez=struct.pack("<H", val)+struct.pack("<H", val2), va=va)
     return ( olist, mnem, opcode, flags )
@@ -343,7 +343,7 @@ def ldm_reg_32(va, val1, val2):
 def ldm_32(va, val1, val2):
     rn = val1 & 0xf
     if val2 & 0x2000:
-        raise InvalidInstruction("LDM instruction with stack indicated: 0x%x: 0x%x, 0x%x" % (va, val1, val2))
+        raise envi.InvalidInstruction(mesg="LDM instruction with stack indicated: 0x%x: 0x%x, 0x%x" % (va, val1, val2))
         # PC not ok on some instructions...  
     wback = (val1 >> 5) & 1
 
@@ -356,7 +356,7 @@ def ldm_32(va, val1, val2):
 
 def pop_32(va, val1, val2):
     if val2 & 0x2000:
-        raise InvalidInstruction("LDM instruction with stack indicated: 0x%x: 0x%x, 0x%x" % (va, val1, val2))
+        raise envi.InvalidInstruction(mesg="LDM instruction with stack indicated: 0x%x: 0x%x, 0x%x" % (va, val1, val2))
         # PC not ok on some instructions...  
     oper0 = ArmRegListOper(val2)
     return (oper0, ), None, None, 0
@@ -403,7 +403,7 @@ def strexn_32(va, val1, val2):
     op3 = (val1 >> 4) & 0xf
     if (op3 & 0xc != 0x10):
         bytez = struct.pack("<HH", val1, val2)
-        raise InvalidInstruction(bytez=bytez, va=va)
+        raise envi.InvalidInstruction(bytez=bytez, va=va)
 
     tsize = op3 & 4
     mnem = ('strexb', 'strexh', None, 'strexd')[tsize]
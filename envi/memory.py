@@ -1,5 +1,9 @@
 import re
+import array
+import bisect
 import struct
+import itertools
+import collections
 
 import envi
 import envi.bits as e_bits
@@ -311,6 +315,41 @@ class IMemory:
 
         return results
 
+    def searchMemoryMulti(self, patterns, regex=False):
+        '''
+        Search each of the current memory maps (in one pass per map) for
+        all of the given patterns, yielding (pattern id, va) tuples as
+        they are found.  The patterns may be a list, a dict of pattern id
+        -> pattern, or a MultiSearch (to reuse one across searches).  See
+        MultiSearch for the pattern forms (including bytesig masks).
+
+        Example:
+            pats = {'dh1':dh_group1, 'dh2':dh_group2}
+            for pid, va in mem.searchMemoryMulti(pats):
+                print('%s at 0x%.8x' % (pid, va))
+        '''
+        if not isinstance(patterns, MultiSearch):
+            patterns = MultiSearch(patterns, regex=regex)
+
+        for va,size,perm,fname in self.getMemoryMaps():
+            try:
+                bytez = self.readMemory(va, size)
+            except:
+                continue # Some platforms dont let debuggers read non-readable mem
+
+            for hit in patterns.iterMatches(bytez, va):
+                yield hit
+
+    def searchMemoryRangeMulti(self, patterns, address, size, regex=False):
+        '''
+        Like searchMemoryMulti() but only search the specified memory
+        range (address -> size).
+        '''
+        if not isinstance(patterns, MultiSearch):
+            patterns = MultiSearch(patterns, regex=regex)
+
+        return patterns.iterMatches(self.readMemory(address, size), address)
+
     def parseOpcode(self, va, arch=envi.ARCH_DEFAULT):
         '''
         Parse an opcode from the specified virtual address.
@@ -324,13 +363,47 @@ class MemoryCache(IMemory):
     '''
     An object which acts like "copy on write" cache for another memory
     object.
+
+    Pages are read from the underlying memory object on demand and kept
+    (up to maxpages of them, least recently used first out) so slow
+    memory objects (vtrace/gdbstub targets) aren't asked twice.  A miss
+    which continues a sequential or strided run of misses also reads the
+    next readahead pages of the run (within the same memory map) in the
+    same read.
+
+    Writes only go to the cached pages.  Pages with writes which have not
+    been written back (see syncDirtyPages()) are never evicted, so a cache
+    which is written to but never synced may grow past maxpages (even if
+    clearDirtyPages() is called, unless it is told to unpin them).
+
+    Example:
+        cache = MemoryCache(trace, maxpages=1024, readahead=8)
+        bytez = cache.readMemory(va, 20)
+        print(cache.getCacheStats())
     '''
-    def __init__(self, mem, pagesize=4096):
+    # the most pages (around a strided miss) read for read-ahead
+    ra_maxspan = 64
+
+    def __init__(self, mem, pagesize=4096, maxpages=None, readahead=0):
         self.mem = mem
         self.pagesize = pagesize # must be binary multiplicative
         self.pagemask = ~ (self.pagesize - 1)
-        self.pagecache = {}
+        self.maxpages = maxpages
+        self.readahead = readahead
+        self.pagecache = collections.OrderedDict()
         self.pagedirty = {}
+        self.pagepinned = set()
+
+        self._ra_last = None    # last page va we missed on
+        self._ra_delta = None   # and the distance from the one before
+        self._cache_stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'reads': 0,
+            'readahead': 0,
+            'writebacks': 0,
+        }
 
         # Steal a few methods from our parent object
         self.getMemoryMap = mem.getMemoryMap
@@ -339,16 +412,128 @@ class MemoryCache(IMemory):
     def _cachePage(self, va):
         return self.mem.readMemory(va, self.pagesize)
 
+    def getCacheStats(self):
+        '''
+        Return a dict of the cache counters (hits/misses are page lookups,
+        reads are calls to the underlying memory object's readMemory).
+
+        Example:
+            stats = cache.getCacheStats()
+            print('%(hits)d hits %(misses)d misses' % stats)
+        '''
+        stats = dict(self._cache_stats)
+        stats['pages'] = len(self.pagecache)
+        stats['dirty'] = len(self.pagedirty)
+        return stats
+
+    def _savePage(self, pageva, page):
+        self.pagecache[pageva] = page
+        if self.maxpages == None:
+            return
+
+        # evict the least recently used (written back) pages
+        tries = len(self.pagecache)
+        while len(self.pagecache) > self.maxpages and tries:
+            tries -= 1
+            oldva, oldpage = self.pagecache.popitem(last=False)
+            if oldva in self.pagepinned or oldva == pageva:
+                self.pagecache[oldva] = oldpage
+                continue
+            self._cache_stats['evictions'] += 1
+
+    def _getReadAhead(self, pageva):
+        '''
+        Return the list of page vas to read along with pageva (or None).
+        '''
+        delta = None
+        if self._ra_last != None:
+            delta = pageva - self._ra_last
+
+        stride = None
+        if delta == self.pagesize or (delta and delta == self._ra_delta):
+            stride = delta
+
+        self._ra_last = pageva
+        self._ra_delta = delta
+
+        if not self.readahead or stride == None:
+            return None
+
+        count = min(self.readahead, (self.ra_maxspan * self.pagesize) / abs(stride))
+        if self.maxpages != None:
+            count = min(count, self.maxpages - 1)
+        if count < 1:
+            return None
+
+        # stay inside the page's memory map
+        mmap = self.getMemoryMap(pageva)
+        if mmap == None:
+            return None
+        mva, msize = mmap[:2]
+
+        pagevas = [pageva]
+        for i in xrange(count):
+            nextva = pageva + stride * (i + 1)
+            if nextva < (mva & self.pagemask) or nextva >= mva + msize:
+                break
+            if nextva not in self.pagecache:
+                pagevas.append(nextva)
+
+        if len(pagevas) == 1:
+            return None
+        return pagevas
+
+    def _getPage(self, pageva):
+        page = self.pagecache.get(pageva)
+        if page != None:
+            self._cache_stats['hits'] += 1
+            if self.maxpages != None:
+                # (most recently used)
+                del self.pagecache[pageva]
+                self.pagecache[pageva] = page
+            return page
+
+        self._cache_stats['misses'] += 1
+        pagevas = self._getReadAhead(pageva)
+        if pagevas != None:
+            # one read spanning the run (even if it is strided)
+            minva = min(pagevas)
+            maxva = max(pagevas) + self.pagesize
+            try:
+                bytez = self.mem.readMemory(minva, maxva - minva)
+                self._cache_stats['reads'] += 1
+            except Exception:
+                bytez = None
+
+            if bytez != None:
+                # (the page we want goes in last so it isn't evicted)
+                for va in pagevas[1:] + pagevas[:1]:
+                    off = va - minva
+                    if off >= len(bytez):
+                        continue
+                    self._savePage(va, bytez[off:off+self.pagesize])
+                    if va != pageva:
+                        self._cache_stats['readahead'] += 1
+
+                # (so the next miss along the run reads ahead again)
+                self._ra_last = pagevas[-1]
+
+                page = self.pagecache.get(pageva)
+                if page != None:
+                    return page
+
+        page = self._cachePage(pageva)
+        self._cache_stats['reads'] += 1
+        self._savePage(pageva, page)
+        return page
+
     def readMemory(self, va, size):
         ret = ''
         while size:
             pageva = va & self.pagemask
             pageoff = va - pageva
             chunksize = min( self.pagesize - pageoff, size )
-            page = self.pagecache.get( pageva )
-            if page == None:
-                page = self.mem.readMemory(pageva, self.pagesize)
-                self.pagecache[pageva] = page
+            page = self._getPage(pageva)
             ret += page[ pageoff : pageoff + chunksize ]
 
             va += chunksize
@@ -361,25 +546,36 @@ class MemoryCache(IMemory):
         while len(bytez):
             pageva = va & self.pagemask
             pageoff = va - pageva
-            chunksize = min(self.pagesize, len(bytez))
+            chunksize = min(self.pagesize - pageoff, len(bytez))
 
-            page = self.pagecache.get(pageva)
-            if page == None:
-                page = self.mem.readMemory(pageva, self.pagesize)
-                self.pagecache[pageva] = page
+            page = self._getPage(pageva)
 
             self.pagedirty[pageva] = True
+            self.pagepinned.add(pageva)
             page = page[:pageoff] + bytez[:chunksize] + page[pageoff+chunksize:]
             self.pagecache[pageva] = page
 
             va += chunksize
             bytez = bytez[chunksize:]
 
-    def clearDirtyPages(self):
+    def clearDirtyPages(self, unpin=False):
         '''
         Clear the "dirty cache" allowing tracking of writes *since* this call.
+
+        The written pages stay in the cache (whatever maxpages says) until
+        syncDirtyPages() writes them back.  If the underlying memory is
+        already known to match them, specify unpin=True to let them be
+        evicted (any writes not written back are lost when they are).
+
+        Example:
+            for va, bytez in cache.getDirtyPages():
+                if trace.readMemory(va, len(bytez)) != bytez:
+                    print('diff at 0x%.8x' % va)
+            cache.clearDirtyPages(unpin=True)
         '''
         self.pagedirty.clear()
+        if unpin:
+            self.pagepinned.clear()
 
     def isDirtyPage(self, va):
         '''
@@ -387,16 +583,334 @@ class MemoryCache(IMemory):
         '''
         return self.pagedirty.get( va & self.pagemask, False )
 
-    def getDirtyPages(self):
+    def getDirtyPages(self, coalesce=False):
         '''
         Returns a list of dirty pages as (pageva, pagebytez) tuples.
+
+        If coalesce is True, runs of adjacent dirty pages are merged into
+        one (va, bytez) tuple (sorted by va).
+
+        Example:
+            for va, bytez in cache.getDirtyPages(coalesce=True):
+                trace.writeMemory(va, bytez)
+        '''
+        if not coalesce:
+            return [ (va, self.pagecache.get(va)) for va in self.pagedirty.keys() ]
+        return self._coalescePages(self.pagedirty.keys())
+
+    def _coalescePages(self, pagevas):
+        ret = []
+        for va in sorted(pagevas):
+            page = self.pagecache.get(va)
+            if ret and ret[-1][0] + len(ret[-1][1]) * self.pagesize == va:
+                ret[-1][1].append(page)
+                continue
+            ret.append((va, [page]))
+        return [ (va, ''.join(pages)) for va, pages in ret ]
+
+    def syncDirtyPages(self):
         '''
-        return [ (va, self.pagecache.get(va)) for va in self.pagedirty.keys() ]
+        Write all of the (not yet written back) pages we have written to
+        back to the underlying memory object, one writeMemory() per run
+        of adjacent pages.  Returns the number of writes.
+
+        Example:
+            cache.writeMemory(va, 'woot')
+            cache.syncDirtyPages()
+        '''
+        runs = self._coalescePages(self.pagepinned)
+        for va, bytez in runs:
+            self.mem.writeMemory(va, bytez)
+            self._cache_stats['writebacks'] += 1
+
+        self.pagepinned.clear()
+        self.pagedirty.clear()
+        return len(runs)
+
+def _snapBytes(mbytes):
+    if type(mbytes) is bytearray:
+        return str(mbytes)
+    return mbytes
+
+def findBytes(bytez, needle, offset=0):
+    '''
+    Like bytez.find(needle, offset) for any of the memory map byte types
+    returned by getByteView() (str, mmap, bytearray or buffer).
+
+    Example:
+        off, bytez = mem.getByteView(va)
+        nulloff = e_mem.findBytes(bytez, '\\x00', off)
+    '''
+    if type(bytez) is buffer:
+        match = re.compile(re.escape(needle)).search(bytez, offset)
+        if match == None:
+            return -1
+        return match.start()
+    return bytez.find(needle, offset)
+
+# gram size -> array typecode (for the MultiSearch word tables)
+gram_types = {}
+for _tc in 'HIL':
+    gram_types.setdefault(array.array(_tc).itemsize, _tc)
+
+class MultiSearch:
+    '''
+    A set of search patterns compiled for one pass over the bytes (see
+    IMemory.searchMemoryMulti()).
+
+    The patterns are a list (whose indexes are the pattern ids) or a dict
+    of pattern id -> pattern, where each pattern is either a string (a
+    regex if regex=True) or an envi.bytesig style (bytes, masks) tuple
+    where each byte matches if (membyte & mask) == (sigbyte & mask)
+    (masks may be None for all \\xff).
+
+    Every offset at which a pattern matches is reported, so overlapping
+    matches (of the same or different patterns) are all found.
+
+    Byte patterns with 3 or more unmasked bytes in a row are found through
+    tables of the aligned 2 or 4 byte words they must contain (one pass of
+    lookups over the words of the bytes, checking the patterns only where
+    one of their words turns up).  Shorter ones share one regex, and each
+    regex pattern is searched for alone (so its groups still work).
+
+    Example:
+        ms = MultiSearch({'mz':'MZ', 'call':('\\xe8\\x00\\x00\\x00\\x00', '\\xff\\x00\\x00\\x00\\x00')})
+        for pid, off in ms.iterMatches(bytez):
+            print('%s at 0x%.8x' % (pid, off))
+    '''
+    max_finds = 64
+
+    def __init__(self, patterns, regex=False):
+        if isinstance(patterns, dict):
+            items = sorted(patterns.items())
+        else:
+            items = list(enumerate(patterns))
+
+        self.pids = []
+        self.regs = []
+        # The unmasked byte patterns (compared directly once found)
+        self.lits = []
+        # gram size -> { gram word: [ (delta, idx), ... ] }
+        self.grams = {}
+        # Byte patterns too short (or too masked) for a gram table are
+        # searched for with one regex, and the first byte -> indexes of
+        # those which may start with it.
+        self.regex = None
+        self.firsts = [ [] for i in xrange(256) ]
+        # The regex patterns (and the literals found with str.find())
+        # are each searched for on their own
+        self.regexes = []
+        self.finds = []
+
+        tokens = []
+        for pid, pat in items:
+            idx = len(self.pids)
+            self.pids.append(pid)
+
+            if regex and not isinstance(pat, tuple):
+                self.regs.append(re.compile(pat))
+                self.lits.append(None)
+                self.regexes.append(idx)
+                continue
+
+            if not isinstance(pat, tuple):
+                pat = (pat, None)
+
+            bytez, masks = pat
+            if masks == None:
+                if not bytez:
+                    raise Exception('Empty search pattern')
+                toks, first, run = None, [ord(bytez[0])], (0, len(bytez))
+                self.regs.append(None)
+                self.lits.append(bytez)
+            else:
+                toks, first, run = self._maskTokens(bytez, masks)
+                self.regs.append(re.compile(''.join(toks)))
+                self.lits.append(None)
+
+            if not self._addGrams(bytez, run, idx):
+                if toks == None:
+                    toks = [ re.escape(c) for c in bytez ]
+                tokens.append(toks)
+                for b in first:
+                    self.firsts[b].append(idx)
+
+        if tokens:
+            self.regex = re.compile(self._treeRegex(tokens))
+
+        # Walking the words of the bytes costs about as much as 50-100
+        # str.find() passes over them, so a few literals are quicker
+        # found on their own.
+        for size, table in self.grams.items():
+            lits = set([ idx for entries in table.values() for delta, idx in entries if self.lits[idx] != None ])
+            if not lits or len(lits) > self.max_finds:
+                continue
+
+            self.finds.extend(sorted(lits))
+            for word, entries in table.items():
+                entries = [ (delta, idx) for delta, idx in entries if idx not in lits ]
+                if entries:
+                    table[word] = entries
+                else:
+                    table.pop(word)
+            if not table:
+                self.grams.pop(size)
+
+        self.gramsets = dict([ (size, frozenset(table)) for size, table in self.grams.items() ])
+
+    def _maskTokens(self, bytez, masks=None):
+        # Returns a regex token per byte, the possible first bytes and
+        # the (offset, size) of the longest run of unmasked bytes
+        if not bytez:
+            raise Exception('Empty search pattern')
+        if masks == None:
+            masks = '\xff' * len(bytez)
+        if len(masks) != len(bytez):
+            raise Exception('Search pattern mask length mismatch: %r' % bytez)
+
+        toks = []
+        first = None
+        run = (0, 0)
+        runoff = 0
+        for i, (c, m) in enumerate(zip(bytez, masks)):
+            m = ord(m)
+            val = ord(c) & m
+            if m == 0xff:
+                chars = [val]
+                toks.append(re.escape(c))
+                if i + 1 - runoff > run[1]:
+                    run = (runoff, i + 1 - runoff)
+            else:
+                chars = [ b for b in xrange(256) if b & m == val ]
+                toks.append('[%s]' % ''.join([ '\\x%.2x' % b for b in chars ]))
+                runoff = i + 1
+            if first == None:
+                first = chars
+
+        return toks, first, run
+
+    def _addGrams(self, bytez, run, idx):
+        # Any match of a window of 2*size-1 unmasked bytes covers one
+        # word aligned to size in the searched bytes, so we put each of
+        # the size words in the window in the table and check the pattern
+        # wherever one of them turns up.  Words of one repeated byte
+        # (\x00\x00...) turn up everywhere, so we pick the window (and
+        # size) with the fewest of them.
+        runoff, runsize = run
+        best = None
+        for size in (4, 2):
+            if size not in gram_types:
+                continue
+            end = runoff + runsize - size + 1
+            uniform = [ bytez[off:off+size] == bytez[off] * size for off in xrange(runoff, end) ]
+            for woff in xrange(runoff, end - size + 1):
+                common = sum(uniform[woff-runoff:woff-runoff+size])
+                if best == None or common < best[0]:
+                    best = (common, size, woff)
+                if not common:
+                    break
+            if best != None and not best[0]:
+                break
+
+        if best == None:
+            return False
 
-    #def syncDirtyPages(self):
-        #'''
-        #Write all of the "dirty" pages back to the underlying memory object.
-        #'''
+        common, size, woff = best
+        if common and self.lits[idx] != None:
+            # (str.find() beats checking every \x00\x00 word we see)
+            self.finds.append(idx)
+            return True
+
+        table = self.grams.setdefault(size, {})
+        for off in xrange(woff, woff + size):
+            word = array.array(gram_types[size], bytez[off:off+size])[0]
+            table.setdefault(word, []).append((off, idx))
+        return True
+
+    def _treeRegex(self, tokens):
+        tree = {}
+        for toks in tokens:
+            node = tree
+            for tok in toks:
+                node = node.setdefault(tok, {})
+            node[None] = True
+
+        def emit(node):
+            # Once a pattern ends here it has matched (and we only want
+            # where matches start) so the longer ones don't matter.
+            if node.get(None):
+                return ''
+            alts = [ tok + emit(kid) for tok, kid in sorted(node.items()) ]
+            if len(alts) == 1:
+                return alts[0]
+            return '(?:%s)' % '|'.join(alts)
+
+        return emit(tree)
+
+    def _iterSearch(self, regex, bytez):
+        # Yield the start of every (non-empty) match, overlapping or not
+        offset = 0
+        search = regex.search
+        while offset < len(bytez):
+            match = search(bytez, offset)
+            if match == None:
+                return
+            off = match.start()
+            if match.end() > off:
+                yield off
+            offset = off + 1
+
+    def _findGrams(self, bytez):
+        hits = []
+        for size, table in self.grams.items():
+            words = array.array(gram_types[size], bytez[:len(bytez) - (len(bytez) % size)])
+            # (the words in the table are found without a python loop,
+            # and the set intersection is quicker when there are none)
+            if not self.gramsets[size].intersection(words):
+                continue
+            hitidx = itertools.compress(itertools.count(), itertools.imap(table.__contains__, words))
+            for i in hitidx:
+                woff = i * size
+                for delta, idx in table[words[i]]:
+                    off = woff - delta
+                    if off >= 0 and self._isMatch(bytez, off, idx):
+                        hits.append((off, idx))
+        return hits
+
+    def _isMatch(self, bytez, off, idx):
+        lit = self.lits[idx]
+        if lit != None:
+            return bytez[off:off+len(lit)] == lit
+        return self.regs[idx].match(bytez, off) != None
+
+    def iterMatches(self, bytez, base=0):
+        '''
+        Yield (pattern id, base + offset) for each match in the given
+        bytes (a str, buffer or mmap) in offset order.
+        '''
+        hits = self._findGrams(bytez)
+
+        if self.regex != None:
+            # The tree regex only tells us one of them matches here
+            for off in self._iterSearch(self.regex, bytez):
+                for idx in self.firsts[ord(bytez[off])]:
+                    if self._isMatch(bytez, off, idx):
+                        hits.append((off, idx))
+
+        for idx in self.regexes:
+            for off in self._iterSearch(self.regs[idx], bytez):
+                hits.append((off, idx))
+
+        for idx in self.finds:
+            lit = self.lits[idx]
+            off = findBytes(bytez, lit)
+            while off != -1:
+                hits.append((off, idx))
+                off = findBytes(bytez, lit, off + 1)
+
+        hits.sort()
+        for off, idx in hits:
+            yield self.pids[idx], base + off
 
 class MemoryObject(IMemory):
 
@@ -408,10 +922,63 @@ class MemoryObject(IMemory):
         """
         IMemory.__init__(self, arch=arch)
         self._map_defs = []
+        self._map_strs = {}     # map va -> (bytearray, str copy) for getByteDef
         self._supervisor = False
+        self._initMapIndex()
 
     #FIXME MemoryObject: def allocateMemory(self, size, perms=MM_RWX, suggestaddr=0):
 
+    def _initMapIndex(self):
+        '''
+        (Re)build the index of the map defs sorted by va which lets
+        _getMapDef() bisect rather than scan every map.
+        '''
+        self._map_starts = []
+        self._map_sorted = []
+        self._map_last = None
+        # If any maps overlap, the first in _map_defs order wins (which
+        # the bisect can't tell us) so we fall back to scanning.
+        self._map_overlap = False
+        for mdef in self._map_defs:
+            self._indexMapDef(mdef)
+
+    def _indexMapDef(self, mdef):
+        mva, mmaxva = mdef[:2]
+        if mmaxva <= mva:
+            return  # (empty maps never match)
+
+        idx = bisect.bisect_right(self._map_starts, mva)
+        if idx > 0 and self._map_sorted[idx-1][1] > mva:
+            self._map_overlap = True
+        if idx < len(self._map_starts) and self._map_starts[idx] < mmaxva:
+            self._map_overlap = True
+
+        self._map_starts.insert(idx, mva)
+        self._map_sorted.insert(idx, mdef)
+
+    def _getMapDef(self, va):
+        '''
+        Return the [mva, mmaxva, mmap, mbytes] map def which contains va
+        (or None).
+        '''
+        mdef = self._map_last
+        if mdef != None and va >= mdef[0] and va < mdef[1]:
+            return mdef
+
+        if self._map_overlap:
+            for mdef in self._map_defs:
+                if va >= mdef[0] and va < mdef[1]:
+                    return mdef
+            return None
+
+        idx = bisect.bisect_right(self._map_starts, va) - 1
+        if idx >= 0:
+            mdef = self._map_sorted[idx]
+            if va < mdef[1]:
+                self._map_last = mdef
+                return mdef
+        return None
+
     def addMemoryMap(self, va, perms, fname, bytez):
         '''
         Add a memory map to this object...
@@ -420,6 +987,7 @@ class MemoryObject(IMemory):
         mmap = (va, msize, perms, fname)
         hlpr = [va, va+msize, mmap, bytez]
         self._map_defs.append(hlpr)
+        self._indexMapDef(hlpr)
         return
 
     def getMemorySnap(self):
@@ -428,7 +996,10 @@ class MemoryObject(IMemory):
 
         Example: snap = mem.getMemorySnap()
         '''
-        return [ list(mdef) for mdef in self._map_defs ]
+        # (maps we have written to are bytearrays, so the snap gets
+        # an immutable copy of those)
+        return [ [mva, mmaxva, mmap, _snapBytes(mbytes)]
+                 for mva, mmaxva, mmap, mbytes in self._map_defs ]
 
     def setMemorySnap(self, snap):
         '''
@@ -437,42 +1008,53 @@ class MemoryObject(IMemory):
         Example: mem.setMemorySnap(snap)
         '''
         self._map_defs = [list(md) for md in snap]
+        self._map_strs = {}
+        self._initMapIndex()
 
     def getMemoryMap(self, va):
         """
         Get the va,size,perms,fname tuple for this memory map
         """
-        for mva, mmaxva, mmap, mbytes in self._map_defs:
-            if va >= mva and va < mmaxva:
-                return mmap
-        return None
+        mdef = self._getMapDef(va)
+        if mdef == None:
+            return None
+        return mdef[2]
 
     def getMemoryMaps(self):
         return [ mmap for mva, mmaxva, mmap, mbytes in self._map_defs ]
 
     def readMemory(self, va, size):
-
-        for mva, mmaxva, mmap, mbytes in self._map_defs:
-            if va >= mva and va < mmaxva:
-                mva, msize, mperms, mfname = mmap
-                if not mperms & MM_READ:
-                    raise envi.SegmentationViolation(va)
-                offset = va - mva
-                return mbytes[offset:offset+size]
-        raise envi.SegmentationViolation(va)
+        mapdef = self._getMapDef(va)
+        if mapdef == None:
+            raise envi.SegmentationViolation(va)
+
+        mva, mmaxva, mmap, mbytes = mapdef
+        if not mmap[2] & MM_READ:
+            raise envi.SegmentationViolation(va)
+        offset = va - mva
+        if type(mbytes) is bytearray:
+            return str(mbytes[offset:offset+size])
+        return mbytes[offset:offset+size]
 
     def writeMemory(self, va, bytes):
-        for mapdef in self._map_defs:
-            mva, mmaxva, mmap, mbytes = mapdef
-            if va >= mva and va < mmaxva:
-                mva, msize, mperms, mfname = mmap
-                if not (mperms & MM_WRITE or self._supervisor):
-                    raise envi.SegmentationViolation(va)
-                offset = va - mva
-                mapdef[3] = mbytes[:offset] + bytes + mbytes[offset+len(bytes):]
-                return
+        mapdef = self._getMapDef(va)
+        if mapdef == None:
+            raise envi.SegmentationViolation(va)
 
-        raise envi.SegmentationViolation(va)
+        mva, mmaxva, mmap, mbytes = mapdef
+        if not (mmap[2] & MM_WRITE or self._supervisor):
+            raise envi.SegmentationViolation(va)
+
+        # The first write to a map swaps its bytes (str/mmap/buffer) for a
+        # bytearray copy, after which writes are done in place.
+        if type(mbytes) is not bytearray:
+            mbytes = bytearray(mbytes)
+            mapdef[3] = mbytes
+
+        offset = va - mva
+        mbytes[offset:offset+len(bytes)] = bytes
+        if self._map_strs:
+            self._map_strs.pop(mva, None)
 
     def getByteDef(self, va):
         """
@@ -481,13 +1063,43 @@ class MemoryObject(IMemory):
         string object *AND* an offset of va into the
         buffer.  Used internally for optimized memory
         handling.  Returns (offset, bytes)
+
+        NOTE: for maps which have been written to, bytes is a str
+              copy of the map (kept until the next write to it).  Use
+              getByteView() to avoid the copy.
         """
-        for mapdef in self._map_defs:
-            mva, mmaxva, mmap, mbytes = mapdef
-            if va >= mva and va < mmaxva:
-                offset = va - mva
-                return (offset, mbytes)
-        raise envi.SegmentationViolation(va)
+        mapdef = self._getMapDef(va)
+        if mapdef == None:
+            raise envi.SegmentationViolation(va)
+
+        mva, mmaxva, mmap, mbytes = mapdef
+        if type(mbytes) is bytearray:
+            cached = self._map_strs.get(mva)
+            if cached == None or cached[0] is not mbytes:
+                cached = (mbytes, str(mbytes))
+                self._map_strs[mva] = cached
+            mbytes = cached[1]
+
+        return (va - mva, mbytes)
+
+    def getByteView(self, va):
+        '''
+        Like getByteDef() but for maps which have been written to, bytes
+        is a (read-only) buffer of the map's bytearray rather than a
+        copy.  A buffer indexes and slices like a str (and works with
+        struct.unpack_from) but has no str methods (see findBytes()).
+
+        Example:
+            off, bytez = mem.getByteView(va)
+            op = arch.archParseOpcode(bytez, off, va)
+        '''
+        mapdef = self._getMapDef(va)
+        if mapdef == None:
+            raise envi.SegmentationViolation(va)
+        mbytes = mapdef[3]
+        if type(mbytes) is bytearray:
+            mbytes = buffer(mbytes)
+        return (va - mapdef[0], mbytes)
 
     def parseOpcode(self, va, arch=envi.ARCH_DEFAULT):
         '''
@@ -495,7 +1107,7 @@ class MemoryObject(IMemory):
 
         Example: op = m.parseOpcode(0x7c773803)
         '''
-        off, b = self.getByteDef(va)
+        off, b = self.getByteView(va)
         return self.imem_archs[(arch & envi.ARCH_MASK) >> 16].archParseOpcode(b, off, va)
 
     def readMemString(self, va, maxlen=0xfffffff):
@@ -503,30 +1115,296 @@ class MemoryObject(IMemory):
         Returns a C-style string from memory.  Stops at Memory Map boundaries, or the first NULL (\x00) byte.
         '''
 
-        for mva, mmaxva, mmap, mbytes in self._map_defs:
-            if va >= mva and va < mmaxva:
-                mva, msize, mperms, mfname = mmap
-                if not mperms & MM_READ:
-                    raise envi.SegmentationViolation(va)
-                offset = va - mva
+        mapdef = self._getMapDef(va)
+        if mapdef == None:
+            raise envi.SegmentationViolation(va)
 
-                # now find the end of the string based on either \x00, maxlen, or end of map
-                end = mbytes.find('\x00', offset)
+        mva, mmaxva, mmap, mbytes = mapdef
+        if not mmap[2] & MM_READ:
+            raise envi.SegmentationViolation(va)
+        offset = va - mva
 
-                left = end - offset
-                if end == -1:
-                    # couldn't find the NULL byte
-                    mend = offset + maxlen
-                    cstr = mbytes[offset:mend]
-                else:
-                    # couldn't find the NULL byte go to the end of the map or maxlen
-                    mend = offset + (maxlen, left)[left < maxlen]
-                    cstr = mbytes[offset:mend]
-                return cstr
+        # now find the end of the string based on either \x00, maxlen, or end of map
+        end = findBytes(mbytes, '\x00', offset)
+
+        left = end - offset
+        if end == -1:
+            # couldn't find the NULL byte
+            mend = offset + maxlen
+            cstr = mbytes[offset:mend]
+        else:
+            # couldn't find the NULL byte go to the end of the map or maxlen
+            mend = offset + (maxlen, left)[left < maxlen]
+            cstr = mbytes[offset:mend]
+        return str(cstr)
+
+
+
+class CowMemoryObject(MemoryObject):
+    '''
+    A MemoryObject which never modifies the memory map bytes.  Writes go
+    to copy-on-write pages (pagesize chunks of a map) so a snapshot only
+    has to hand over the current pages.  Pages are shared between the
+    snapshots and the live memory until they are written again, so taking
+    or restoring a snapshot costs nothing and each path only copies the
+    pages it dirties.  (envi.Emulator is one of these.)
+
+    Example:
+        mem = CowMemoryObject()
+        mem.addMemoryMap(0x41410000, MM_RWX, 'stack', '\\xfe' * 0x8000)
+        snap = mem.getMemorySnap()
+        mem.writeMemory(0x41410010, 'woot')     # copies one page
+        mem.setMemorySnap(snap)
+    '''
+    def __init__(self, arch=None, pagesize=4096):
+        MemoryObject.__init__(self, arch=arch)
+        self._cow_pagesize = pagesize # must be binary multiplicative
+        self._cow_pagemask = ~ (pagesize - 1)
+        self._cow_pages = {}            # page va -> page bytes (str or bytearray)
+        self._cow_owned = set()         # page vas we may write in place
+        self._cow_shared = False        # is _cow_pages shared with a snapshot?
+        self._cow_dirtymaps = frozenset() # map vas with any pages
+        self._cow_mapbytes = {}         # map va -> merged map bytes (for getByteDef)
+        self._cow_mapsnap = None        # tuple of the map defs for the snapshots
+        self._cow_lastsnap = None
+        self._cow_stats = {
+            'snapshots': 0,
+            'restores': 0,
+            'pages_copied': 0,
+            'bytes_copied': 0,
+        }
+
+    def addMemoryMap(self, va, perms, fname, bytez):
+        # (so nobody else can change our map bytes, including a buffer
+        # from getByteView() over a written map's bytearray)
+        if type(bytez) in (bytearray, buffer):
+            bytez = str(bytez)
+        MemoryObject.addMemoryMap(self, va, perms, fname, bytez)
+        self._cow_mapsnap = None
+        self._cow_lastsnap = None
+
+    def getMemorySnap(self):
+        '''
+        Take a memory snapshot which may be restored later.  This does
+        not copy any bytes (the pages become copy-on-write again).
+
+        Example: snap = mem.getMemorySnap()
+        '''
+        self._cow_stats['snapshots'] += 1
+        if self._cow_lastsnap != None:
+            return self._cow_lastsnap
+
+        if self._cow_mapsnap == None:
+            self._cow_mapsnap = tuple(self._map_defs)
+
+        self._cow_owned = set()
+        self._cow_shared = True
+        self._cow_lastsnap = (self._cow_mapsnap, self._cow_pages, self._cow_dirtymaps)
+        return self._cow_lastsnap
 
-        raise envi.SegmentationViolation(va)
+    def setMemorySnap(self, snap):
+        '''
+        Restore a previously saved memory snapshot (or a list of map
+        defs from MemoryObject.getMemorySnap()).
+
+        Example: mem.setMemorySnap(snap)
+        '''
+        self._cow_stats['restores'] += 1
+        if type(snap) is list:
+            MemoryObject.setMemorySnap(self, snap)
+            snap = (tuple(self._map_defs), {}, frozenset())
+
+        mapsnap, pages, dirtymaps = snap
+        if mapsnap is not self._cow_mapsnap:
+            self._map_defs = list(mapsnap)
+            self._initMapIndex()
+            self._cow_mapsnap = mapsnap
+
+        self._cow_pages = pages
+        self._cow_owned = set()
+        self._cow_shared = True
+        self._cow_dirtymaps = dirtymaps
+        self._cow_mapbytes = {}
+        self._cow_lastsnap = snap
+
+    def getMemorySnapStats(self):
+        '''
+        Return a dict of the snapshot/copy-on-write counters (and the
+        number of pages currently written).
+
+        Example:
+            stats = mem.getMemorySnapStats()
+            print('%(snapshots)d snaps %(pages_copied)d pages copied' % stats)
+        '''
+        stats = dict(self._cow_stats)
+        stats['pages'] = len(self._cow_pages)
+        stats['dirty_pages'] = len(self._cow_owned)
+        return stats
+
+    def _readPages(self, mapdef, va, size):
+        mva, mmaxva, mmap, mbytes = mapdef
+        pages = self._cow_pages
+        offset = va - mva
+        end = min(offset + size, mmaxva - mva)
+        ret = []
+        while offset < end:
+            pageoff = offset & self._cow_pagemask
+            chunk = min(end, pageoff + self._cow_pagesize) - offset
+
+            page = pages.get(mva + pageoff)
+            if page == None:
+                ret.append(mbytes[offset:offset+chunk])
+            else:
+                poff = offset - pageoff
+                ret.append(str(page[poff:poff+chunk]))
+
+            offset += chunk
+
+        return ''.join(ret)
+
+    def readMemory(self, va, size):
+        mapdef = self._getMapDef(va)
+        if mapdef == None:
+            raise envi.SegmentationViolation(va)
+
+        mva, mmaxva, mmap, mbytes = mapdef
+        if not mmap[2] & MM_READ:
+            raise envi.SegmentationViolation(va)
+
+        offset = va - mva
+        if mva not in self._cow_dirtymaps:
+            return mbytes[offset:offset+size]
+
+        # (most reads are within one page)
+        pageoff = offset & self._cow_pagemask
+        if offset + size <= pageoff + self._cow_pagesize:
+            page = self._cow_pages.get(mva + pageoff)
+            if page == None:
+                return mbytes[offset:offset+size]
+            poff = offset - pageoff
+            return str(page[poff:poff+size])
+
+        return self._readPages(mapdef, va, size)
+
+    def writeMemory(self, va, bytes):
+        mapdef = self._getMapDef(va)
+        if mapdef == None:
+            raise envi.SegmentationViolation(va)
+
+        mva, mmaxva, mmap, mbytes = mapdef
+        if not (mmap[2] & MM_WRITE or self._supervisor):
+            raise envi.SegmentationViolation(va)
+
+        # (most writes are to a page we already own)
+        offset = va - mva
+        pageoff = offset & self._cow_pagemask
+        if mva + pageoff in self._cow_owned:
+            page = self._cow_pages[mva + pageoff]
+            poff = offset - pageoff
+            if poff + len(bytes) <= len(page):
+                page[poff:poff+len(bytes)] = bytes
+                if self._cow_mapbytes:
+                    self._cow_mapbytes.pop(mva, None)
+                return
+
+        if self._cow_shared:
+            self._cow_pages = dict(self._cow_pages)
+            self._cow_shared = False
+
+        if mva not in self._cow_dirtymaps:
+            self._cow_dirtymaps = self._cow_dirtymaps.union((mva,))
+
+        pages = self._cow_pages
+        owned = self._cow_owned
+        pagesize = self._cow_pagesize
+
+        size = min(len(bytes), mmaxva - va)
+        boff = 0
+        while boff < size:
+            pageoff = offset & self._cow_pagemask
+            pageva = mva + pageoff
+            if pageva in owned:
+                page = pages[pageva]
+            else:
+                # copy on write (from the snapshot's page or the map bytes)
+                page = pages.get(pageva)
+                if page == None:
+                    page = mbytes[pageoff:pageoff+pagesize]
+                page = bytearray(page)
+                pages[pageva] = page
+                owned.add(pageva)
+                self._cow_stats['pages_copied'] += 1
+                self._cow_stats['bytes_copied'] += len(page)
+
+            poff = offset - pageoff
+            chunk = min(size - boff, pagesize - poff)
+            page[poff:poff+chunk] = bytes[boff:boff+chunk]
+            offset += chunk
+            boff += chunk
+
+        self._cow_lastsnap = None
+        if self._cow_mapbytes:
+            self._cow_mapbytes.pop(mva, None)
+
+        # the rest runs on into the next map (if there is one)
+        if size < len(bytes):
+            CowMemoryObject.writeMemory(self, mmaxva, bytes[size:])
+
+    def getByteDef(self, va):
+        '''
+        Like MemoryObject.getByteDef() but for a map which has been
+        written to, the bytes are a (cached) merged copy of the map.
+        '''
+        mapdef = self._getMapDef(va)
+        if mapdef == None:
+            raise envi.SegmentationViolation(va)
+
+        mva, mmaxva, mmap, mbytes = mapdef
+        if mva in self._cow_dirtymaps:
+            mbytes = self._cow_mapbytes.get(mva)
+            if mbytes == None:
+                mbytes = self._readPages(mapdef, mva, mmaxva - mva)
+                self._cow_mapbytes[mva] = mbytes
+
+        return (va - mva, mbytes)
+
+    def getByteView(self, va):
+        # (the merged copy of a written map is ours alone anyway)
+        return self.getByteDef(va)
+
+    def parseOpcode(self, va, arch=envi.ARCH_DEFAULT):
+        mapdef = self._getMapDef(va)
+        if mapdef == None or mapdef[0] not in self._cow_dirtymaps:
+            return MemoryObject.parseOpcode(self, va, arch=arch)
+
+        # (rather than merge a written map for getByteDef)
+        b = self._readPages(mapdef, va, 16)
+        return self.imem_archs[(arch & envi.ARCH_MASK) >> 16].archParseOpcode(b, 0, va)
+
+    def readMemString(self, va, maxlen=0xfffffff):
+        mapdef = self._getMapDef(va)
+        if mapdef == None or mapdef[0] not in self._cow_dirtymaps:
+            return MemoryObject.readMemString(self, va, maxlen=maxlen)
+
+        if not mapdef[2][2] & MM_READ:
+            raise envi.SegmentationViolation(va)
+
+        ret = []
+        while maxlen > 0:
+            bytez = self._readPages(mapdef, va, min(maxlen, self._cow_pagesize))
+            if not bytez:
+                break
+
+            end = bytez.find('\x00')
+            if end != -1:
+                ret.append(bytez[:end])
+                break
 
+            ret.append(bytez)
+            va += len(bytez)
+            maxlen -= len(bytez)
 
+        return ''.join(ret)
 
 class MemoryFile:
     '''
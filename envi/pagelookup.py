@@ -3,6 +3,7 @@ A home for the page lookup construct.  Basically it is a
 python object which implements a similar lookup mechanism
 to the i386 page table lookups...
 '''
+import bisect
 import collections
 
 # FIXME move functions in here too so there is procedural "speed" way
@@ -70,3 +71,174 @@ class MapLookup:
     def __getslice__(self, start, end):
         print 'GET SLICE'
 
+
+class IntervalLookup:
+
+    '''
+    A drop-in replacement for MapLookup which stores a sorted list of
+    non-overlapping (start, end, obj) ranges rather than a slot for every
+    byte of every map.  Memory use scales with the number of ranges set
+    and lookups are a bisect rather than a scan of the maps list.
+
+    Semantics match MapLookup: setting a range overwrites (and truncates)
+    any ranges it overlaps, setting obj=None clears the range, and ranges
+    are clipped to the end of the memory map which contains their start.
+
+    A running count of the bytes covered in each map is also kept, see
+    getMapCoverage().
+    '''
+
+    def __init__(self):
+        self._maps_list = []
+        self._maps_starts = []
+        self._maps_covered = {}
+
+        self._starts = []
+        self._ends = []
+        self._objs = []
+
+    def __len__(self):
+        return len(self._starts)
+
+    def initMapLookup(self, va, size, obj=None):
+        idx = bisect.bisect_right(self._maps_starts, va)
+        self._maps_starts.insert(idx, va)
+        self._maps_list.insert(idx, (va, va+size))
+        self._maps_covered.setdefault(va, 0)
+        if obj is not None:
+            self.setMapLookup(va, size, obj)
+
+    def _getMapBounds(self, va):
+        idx = bisect.bisect_right(self._maps_starts, va) - 1
+        # maps may overlap, so walk back until we find one containing va
+        while idx >= 0:
+            mva, mvamax = self._maps_list[idx]
+            if va < mvamax:
+                return mva, mvamax
+            idx -= 1
+        return None
+
+    def setMapLookup(self, va, size, obj):
+        bounds = self._getMapBounds(va)
+        if bounds is None:
+            raise Exception('Address (0x%.8x) not in maps!' % va)
+
+        end = min(va + size, bounds[1])
+        if end <= va:
+            return
+
+        starts = self._starts
+        ends = self._ends
+        objs = self._objs
+
+        # i is the first range which overlaps [va, end), j is one past the last
+        i = bisect.bisect_right(starts, va) - 1
+        if i < 0 or ends[i] <= va:
+            i += 1
+        j = bisect.bisect_left(starts, end)
+
+        covered = 0
+        if obj is not None:
+            covered = end - va
+        for k in xrange(i, j):
+            covered -= min(ends[k], end) - max(starts[k], va)
+        self._maps_covered[bounds[0]] += covered
+
+        newstarts = []
+        newends = []
+        newobjs = []
+
+        # Keep the head of a range we only partially overwrite
+        if i < j and starts[i] < va:
+            newstarts.append(starts[i])
+            newends.append(va)
+            newobjs.append(objs[i])
+
+        if obj is not None:
+            newstarts.append(va)
+            newends.append(end)
+            newobjs.append(obj)
+
+        # ... and the tail
+        if i < j and ends[j-1] > end:
+            newstarts.append(end)
+            newends.append(ends[j-1])
+            newobjs.append(objs[j-1])
+
+        starts[i:j] = newstarts
+        ends[i:j] = newends
+        objs[i:j] = newobjs
+
+    def getMapLookup(self, va):
+        idx = bisect.bisect_right(self._starts, va) - 1
+        if idx >= 0 and va < self._ends[idx]:
+            return self._objs[idx]
+        return None
+
+    def getMapLookups(self, va, size):
+        '''
+        Return a list of the objects for every range which overlaps
+        [va, va+size) (in address order).
+        '''
+        starts = self._starts
+        i = bisect.bisect_right(starts, va) - 1
+        if i < 0 or self._ends[i] <= va:
+            i += 1
+        j = bisect.bisect_left(starts, va + size)
+        return self._objs[i:j]
+
+    def getMapRanges(self, va=None, size=None):
+        '''
+        Return a list of (start, end, obj) tuples for every range which
+        overlaps [va, va+size) (or every range if no va is given).
+        '''
+        starts = self._starts
+        if va is None:
+            i, j = 0, len(starts)
+        else:
+            i = bisect.bisect_right(starts, va) - 1
+            if i < 0 or self._ends[i] <= va:
+                i += 1
+            j = bisect.bisect_left(starts, va + size)
+        return zip(starts[i:j], self._ends[i:j], self._objs[i:j])
+
+    def getMapCoverage(self, va):
+        '''
+        Return the number of bytes covered by ranges in the map
+        which begins at va.
+        '''
+        return self._maps_covered.get(va, 0)
+
+    def getPrevMapLookup(self, va):
+        '''
+        Return the object for the range containing va, or the closest
+        range which ends before va (or None).
+        '''
+        idx = bisect.bisect_right(self._starts, va) - 1
+        if idx >= 0:
+            return self._objs[idx]
+        return None
+
+    def getUnsetRanges(self, va, size):
+        '''
+        Yield (va, size) tuples for each run of bytes in [va, va+size)
+        which is not covered by a range.  The index is re-checked after
+        each yield, so the caller may set ranges as it goes.
+        '''
+        starts = self._starts
+        ends = self._ends
+
+        endva = va + size
+        while va < endva:
+            idx = bisect.bisect_right(starts, va) - 1
+            if idx >= 0 and va < ends[idx]:
+                va = ends[idx]
+                continue
+
+            idx += 1
+            gapend = endva
+            if idx < len(starts) and starts[idx] < endva:
+                gapend = starts[idx]
+
+            yield va, gapend - va
+            va = gapend
@@ -7,3 +7,10 @@ class ArmInstructionSet(unittest.TestCase):
         am=e_arm.ArmModule()
         op = am.archParseOpcode('d3f021e3'.decode('hex'))
         self.assertEqual('msr CPSR_c, #0xd3', repr(op))
+
+    def test_parse_opcodes(self):
+        import envi
+        am = envi.getArchModule('arm')
+        ops = am.archParseOpcodes('feffffea1eff2fe1'.decode('hex'), va=0x2000)
+        self.assertEqual([ repr(ops.getOpcode(i)) for i in range(len(ops)) ], ['b #0x00002000', 'bx lr'])
+        self.assertEqual(ops.getBranches(0), ((0x2000, envi.ARCH_ARMV7),))
@@ -448,3 +448,43 @@ class i386InstructionSet(unittest.TestCase):
         opcheck = {'iflags': 65536, 'va': 16384, 'repr': None, 'prefixes': 0, 'mnem': 'cvttps2pi', 'opcode': 61440}
         opercheck = [{'tsize': 8, 'reg': 13}, {'disp': -287454021, 'tsize': 8, '_is_deref': True, 'reg': 2}]
         self.checkOpcode(opbytez, 0x4000, oprepr, opcheck, opercheck, oprepr)
+
+    def test_envi_i386_parse_opcodes(self):
+        # push ebp; mov ebp,esp; call +0x10; jz +2; ret; ret; (garbage)
+        bytez = '5589e5e8100000007402c3c3ffff'.decode('hex')
+        ops = self._arch.archParseOpcodes(bytez, va=0x41410000)
+        self.assertEqual(list(ops.vas), [0x41410000, 0x41410001, 0x41410003, 0x41410008, 0x4141000a, 0x4141000b])
+        self.assertEqual(ops.endva, 0x4141000c)
+
+        for i, (va, size, opcode, iflags, branches) in enumerate(ops):
+            op = self._arch.archParseOpcode(bytez, va - 0x41410000, va)
+            self.assertEqual((size, opcode, iflags), (op.size, op.opcode, op.iflags))
+            self.assertEqual(branches, tuple(op.getBranches()))
+            self.assertEqual(repr(ops.getOpcode(i)), repr(op))
+
+        self.assertTrue(ops[2][3] & envi.IF_CALL)
+        self.assertEqual([ bva for bva, bflags in ops.getBranches(2) if not bflags & envi.BR_FALL ], [0x41410018])
+        self.assertEqual(ops.index(0x41410008), 3)
+        self.assertEqual(ops.index(0x41410009), -1)
+
+        ops = self._arch.archParseOpcodes(bytez, va=0x41410000, count=2)
+        self.assertEqual(len(ops), 2)
+        ops = self._arch.archParseOpcodes(bytez, offset=3, va=0x41410003, endva=0x41410009)
+        self.assertEqual(list(ops.vas), [0x41410003, 0x41410008])
+
+    def test_envi_parse_opcodes_junk(self):
+        # A linear sweep over random bytes stops instead of raising for
+        # every arch (whatever the decoder raises on junk)
+        import random
+        rand = random.Random(0x41414141)
+        archs = [ arch for arch in envi.getArchModules() if arch != None ]
+        for arch in archs:
+            for i in xrange(300):
+                bytez = ''.join([ chr(rand.randint(0, 255)) for j in xrange(64) ])
+                ops = arch.archParseOpcodes(bytez, va=0x41410000)
+                self.assertEqual(ops.endva, 0x41410000 + sum(ops.sizes))
+
+        # and the bytes may be a bytearray (a written memory map)
+        bytez = bytearray('5589e5c3'.decode('hex'))
+        ops = self._arch.archParseOpcodes(bytez, va=0x41410000)
+        self.assertEqual(list(ops.vas), [0x41410000, 0x41410001, 0x41410003])
@@ -98,7 +98,8 @@ class LockStepper:
             if diffs:
                 diffstr = ','.join(['0x%.8x: %d' % (va+offset,size) for offset,size in diffs ])
                 raise Exception('LockStep: emu 0x%.8x %s | trace 0x%.8x %s | DIFFS: %s' % (emuop.va, repr(emuop), traceop.va, repr(traceop), diffstr))
-        self.memcache.clearDirtyPages()
+        # (the pages match the trace, so they may be evicted)
+        self.memcache.clearDirtyPages(unpin=True)
 
 breakpoints = {
     ('windows','i386'):('ntdll.RtlAllocateHeap',500),
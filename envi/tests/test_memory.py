@@ -1,7 +1,25 @@
+import re
+import random
 import unittest
 
+import envi
 import envi.memory as e_mem
 
+class CountingMemory(e_mem.MemoryObject):
+
+    def __init__(self):
+        e_mem.MemoryObject.__init__(self)
+        self.reads = []
+        self.writes = []
+
+    def readMemory(self, va, size):
+        self.reads.append((va, size))
+        return e_mem.MemoryObject.readMemory(self, va, size)
+
+    def writeMemory(self, va, bytez):
+        self.writes.append((va, len(bytez)))
+        return e_mem.MemoryObject.writeMemory(self, va, bytez)
+
 class EnviMemoryTest(unittest.TestCase):
 
     def test_envi_memory_cache(self):
@@ -18,3 +36,302 @@ class EnviMemoryTest(unittest.TestCase):
         self.assertEqual(mem.readMemory(0x41410040, 3), 'BBB')
         # Test a cross page read
         self.assertEqual(mem.readMemory(0x41410000 + (cache.pagesize - 2), 4), 'BBBB')
+
+    def test_envi_memory_cache_readahead(self):
+        mem = CountingMemory()
+        mem.addMemoryMap(0x41410000, e_mem.MM_RWX, 'a', ''.join([ chr(i) * 0x1000 for i in xrange(32) ]))
+        cache = e_mem.MemoryCache(mem, readahead=4)
+
+        # sequential: the second miss reads it and the next 4 pages at once
+        for i in xrange(6):
+            self.assertEqual(cache.readMemory(0x41410000 + i * 0x1000 + 10, 4), chr(i) * 4)
+        self.assertEqual(mem.reads, [(0x41410000, 0x1000), (0x41411000, 0x5000)])
+
+        # strided (one read spanning the run, up to the end of the map)
+        del mem.reads[:]
+        for i in (8, 11, 14, 17, 20, 23, 26, 29):
+            self.assertEqual(cache.readMemory(0x41410000 + i * 0x1000, 1), chr(i))
+        self.assertEqual(mem.reads, [(0x41418000, 0x1000), (0x4141b000, 0xd000), (0x4142a000, 0x4000)])
+
+        stats = cache.getCacheStats()
+        self.assertEqual((stats['reads'], stats['readahead'], stats['evictions']), (5, 9, 0))
+        self.assertEqual(stats['hits'] + stats['misses'], 14)
+
+    def test_envi_memory_cache_lru(self):
+        mem = CountingMemory()
+        mem.addMemoryMap(0x41410000, e_mem.MM_RWX, 'a', 'A' * 0x8000)
+        cache = e_mem.MemoryCache(mem, maxpages=2)
+
+        cache.readMemory(0x41410000, 1)
+        cache.readMemory(0x41412000, 1)
+        cache.readMemory(0x41410000, 1)
+        cache.readMemory(0x41414000, 1)   # evicts 0x41412000
+        self.assertEqual(sorted(cache.pagecache.keys()), [0x41410000, 0x41414000])
+
+        # written pages stay until they are written back (even over budget)
+        cache.writeMemory(0x41410ffe, 'wxyz')
+        cache.readMemory(0x41416000, 1)
+        self.assertEqual(sorted(cache.pagecache.keys()), [0x41410000, 0x41411000, 0x41416000])
+        self.assertEqual(cache.readMemory(0x41410ffd, 6), 'AwxyzA')
+        self.assertEqual(mem.readMemory(0x41410fff, 2), 'AA')
+
+        cache.writeMemory(0x41415000, 'q')
+        self.assertEqual([ va for va, bytez in cache.getDirtyPages(coalesce=True) ], [0x41410000, 0x41415000])
+        self.assertEqual(cache.syncDirtyPages(), 2)
+        self.assertEqual(mem.writes, [(0x41410000, 0x2000), (0x41415000, 0x1000)])
+        self.assertEqual(mem.readMemory(0x41410ffd, 6), 'AwxyzA')
+        self.assertEqual(cache.getDirtyPages(), [])
+
+        stats = cache.getCacheStats()
+        self.assertEqual((stats['evictions'], stats['writebacks']), (3, 2))
+
+        # clearing the dirty pages only unpins them if asked to
+        cache.writeMemory(0x41412000, 'r')
+        cache.writeMemory(0x41413000, 's')
+        cache.clearDirtyPages()
+        self.assertEqual(cache.getDirtyPages(), [])
+        cache.readMemory(0x41417000, 1)
+        self.assertTrue(0x41412000 in cache.pagecache)
+        self.assertTrue(0x41413000 in cache.pagecache)
+
+        cache.clearDirtyPages(unpin=True)
+        cache.readMemory(0x41410000, 1)
+        self.assertEqual(len(cache.pagecache), 2)
+        self.assertEqual(cache.syncDirtyPages(), 0)
+
+    def test_envi_memory_map_index(self):
+        mem = e_mem.MemoryObject()
+        # (added out of order, with an empty map and a gap)
+        mem.addMemoryMap(0x3000, e_mem.MM_READ, 'c', 'C' * 0x100)
+        mem.addMemoryMap(0x1000, e_mem.MM_RWX, 'a', 'A' * 0x100)
+        mem.addMemoryMap(0x1100, e_mem.MM_RWX, 'e', '')
+        mem.addMemoryMap(0x2000, e_mem.MM_RWX, 'b', 'B\x00' * 0x80)
+
+        self.assertEqual(mem.getMemoryMap(0x1000), (0x1000, 0x100, e_mem.MM_RWX, 'a'))
+        self.assertEqual(mem.getMemoryMap(0x30ff)[3], 'c')
+        for va in (0xfff, 0x1100, 0x1fff, 0x3100):
+            self.assertEqual(mem.getMemoryMap(va), None)
+            self.assertRaises(envi.SegmentationViolation, mem.readMemory, va, 1)
+
+        self.assertEqual(mem.readMemString(0x2000), 'B')
+        self.assertEqual(mem.getByteDef(0x2003), (3, 'B\x00' * 0x80))
+        mem.writeMemory(0x1010, 'xx')
+        self.assertEqual(mem.readMemory(0x100f, 4), 'AxxA')
+        self.assertRaises(envi.SegmentationViolation, mem.writeMemory, 0x3000, 'x')
+
+        # snapshots rebuild the index
+        snap = mem.getMemorySnap()
+        mem.addMemoryMap(0x4000, e_mem.MM_RWX, 'd', 'D' * 0x10)
+        self.assertEqual(mem.readMemory(0x4000, 1), 'D')
+        mem.setMemorySnap(snap)
+        self.assertEqual(mem.getMemoryMap(0x4000), None)
+        self.assertEqual(mem.readMemory(0x1010, 2), 'xx')
+
+    def test_envi_memory_map_overlap(self):
+        # overlapping maps resolve to the first one added (like the scan)
+        mem = e_mem.MemoryObject()
+        mem.addMemoryMap(0x1000, e_mem.MM_RWX, 'big', 'A' * 0x1000)
+        mem.addMemoryMap(0x1800, e_mem.MM_RWX, 'small', 'B' * 0x10)
+        self.assertEqual(mem.getMemoryMap(0x1808)[3], 'big')
+        self.assertEqual(mem.readMemory(0x1808, 1), 'A')
+        self.assertEqual(mem.getMemoryMap(0x1fff)[3], 'big')
+
+    def test_envi_memory_search_multi(self):
+        mem = e_mem.MemoryObject()
+        mem.addMemoryMap(0x1000, e_mem.MM_RWX, 'a', 'xxaaaxx\xe8\x10\x20\x30\x40MZ')
+        mem.addMemoryMap(0x4000, e_mem.MM_RWX, 'b', 'MZ\x90\xe8\x00\x00\x00\x00aab')
+
+        pats = {
+            'aa':'aa',      # (overlapping matches)
+            'a':'a',        # (a prefix of another pattern)
+            'mz':'MZ',
+            'call':('\xe8\x00\x00\x00\x00', '\xff\x00\x00\x00\x00'),
+            'nib':('\x90\xe0', '\xff\xf0'),
+        }
+        hits = list(mem.searchMemoryMulti(pats))
+        self.assertEqual(hits, [('a', 0x1002), ('aa', 0x1002), ('a', 0x1003), ('aa', 0x1003), ('a', 0x1004),
+                                ('call', 0x1007), ('mz', 0x100c),
+                                ('mz', 0x4000), ('nib', 0x4002), ('call', 0x4003),
+                                ('a', 0x4008), ('aa', 0x4008), ('a', 0x4009)])
+
+        # every literal pattern finds what searchMemory() finds
+        for pid in ('a', 'mz'):
+            self.assertEqual([ va for p, va in hits if p == pid ], mem.searchMemory(pats[pid]))
+
+        # regex patterns (by list index) and a range
+        ms = e_mem.MultiSearch(['a+b', 'M.', '(a)\\1', 'x*'], regex=True)
+        self.assertEqual(list(mem.searchMemoryMulti(ms)), [(3, 0x1000), (3, 0x1001), (2, 0x1002), (2, 0x1003), (3, 0x1005),
+                                                           (3, 0x1006), (1, 0x100c), (1, 0x4000), (0, 0x4008), (2, 0x4008), (0, 0x4009)])
+        self.assertEqual(list(mem.searchMemoryRangeMulti(ms, 0x4001, 10)), [(0, 0x4008), (2, 0x4008), (0, 0x4009)])
+        self.assertEqual(list(mem.searchMemoryRangeMulti(['x*'], 0x1000, 4, regex=True)), [(0, 0x1000), (0, 0x1001)])
+
+        self.assertEqual(list(mem.searchMemoryMulti([])), [])
+        self.assertRaises(Exception, e_mem.MultiSearch, [''])
+
+    def test_envi_memory_search_multi_many(self):
+        # enough literals for the word tables (plus masked and short ones)
+        rand = random.Random(0x24)
+        bytez = ''.join([ chr(rand.choice((0, 0, 0xff, rand.randrange(256)))) for i in xrange(0x4000) ])
+        pats = [ bytez[off:off+rand.randint(2, 24)] for off in rand.sample(xrange(0x3fe0), 150) ]
+        pats.extend([ ''.join([ chr(rand.randrange(256)) for i in xrange(rand.randint(3, 6)) ]) for i in xrange(80) ])
+        pats.append('\x00' * 8)
+        pats.append((bytez[0x100:0x120], '\xff\x00' * 0x10))
+        pats.append((bytez[0x200:0x210], '\xff' * 7 + '\x00' + '\xff' * 8))
+
+        mem = e_mem.MemoryObject()
+        mem.addMemoryMap(0x1000, e_mem.MM_RWX, 'a', bytez)
+
+        expect = []
+        for pid, pat in enumerate(pats):
+            regex = '(?=%s)' % e_mem.MultiSearch([pat]).regs[0].pattern if isinstance(pat, tuple) else '(?=%s)' % re.escape(pat)
+            expect.extend([ (0x1000 + match.start(), pid) for match in re.finditer(regex, bytez) ])
+
+        hits = [ (va, pid) for pid, va in mem.searchMemoryMulti(pats) ]
+        self.assertEqual(hits, sorted(expect))
+        self.assertTrue(len(hits) > 200)
+
+    def test_envi_memory_write_inplace(self):
+        mem = e_mem.MemoryObject()
+        mem.addMemoryMap(0x1000, e_mem.MM_RWX, 'a', 'A' * 0x100)
+        snap = mem.getMemorySnap()
+
+        mem.writeMemory(0x1010, 'hi\x00')
+        mem.writeMemory(0x1011, 'o')
+        mem.writeMemory(0x10fe, 'zz')
+        self.assertEqual(mem.readMemory(0x100f, 5), 'Aho\x00A')
+        self.assertEqual(type(mem.readMemory(0x1010, 2)), str)
+        self.assertEqual(mem.readMemString(0x1010), 'ho')
+        self.assertEqual(type(mem.readMemString(0x1010)), str)
+
+        # getByteView gives a read-only view of the written map
+        off, bytez = mem.getByteView(0x1010)
+        self.assertEqual((off, bytez[off], bytez[off:off+2], len(bytez)), (0x10, 'h', 'ho', 0x100))
+        self.assertEqual(e_mem.findBytes(bytez, '\x00', off), 0x12)
+        self.assertEqual(e_mem.findBytes(bytez, 'q', off), -1)
+        self.assertEqual(e_mem.findBytes('AAho\x00', '\x00', 1), 4)
+
+        # ...and getByteDef a str (copied again after the next write)
+        off, bytez = mem.getByteDef(0x1010)
+        self.assertEqual((off, type(bytez), bytez.find('\x00', off)), (0x10, str, 0x12))
+        self.assertTrue(mem.getByteDef(0x1020)[1] is bytez)
+        mem.writeMemory(0x1012, 'p')
+        self.assertEqual(mem.getByteDef(0x1010)[1].find('\x00', off), -1)
+        mem.writeMemory(0x1012, '\x00')
+
+        # snapshots are not changed by later writes
+        snap2 = mem.getMemorySnap()
+        mem.writeMemory(0x1010, 'xx')
+        mem.setMemorySnap(snap2)
+        self.assertEqual(mem.readMemory(0x1010, 2), 'ho')
+        mem.setMemorySnap(snap)
+        self.assertEqual(mem.readMemory(0x1010, 2), 'AA')
+
+    def test_envi_memory_parse_written(self):
+        # the disassemblers take the getByteView() view of written maps
+        tests = (
+            ('i386', 0x1000, '\x55\x8b\xec\xe8\x10\x00\x00\x00'),
+            ('amd64', 0x1000, '\x48\x8b\x44\x24\x08\xc3'),
+            ('arm', 0x1000, '\x04\x00\x91\xe5'),
+            ('thumb', 0x1001, '\x01\x30\x70\x47'),
+            ('msp430', 0x1000, '\x3f\x40\x34\x12'),
+            ('h8', 0x1000, '\x79\x00\x12\x34'),
+        )
+        for archname, va, opbytes in tests:
+            arch = envi.getArchModule(archname)
+            mem = e_mem.MemoryObject()
+            mem.addMemoryMap(0x1000, e_mem.MM_RWX, 'code', '\x00' * 0x100)
+            mem.writeMemory(0x1000, opbytes)
+
+            off, bytez = mem.getByteView(va)
+            self.assertEqual(type(bytez), buffer)
+            op = arch.archParseOpcode(bytez, off, va)
+            self.assertEqual(repr(op), repr(arch.archParseOpcode(opbytes, off, va)))
+            self.assertEqual(len(op), len(arch.archParseOpcode(opbytes, off, va)))
+
+    def test_envi_memory_cow(self):
+        mem = e_mem.CowMemoryObject(pagesize=0x100)
+        mem.addMemoryMap(0x1000, e_mem.MM_RWX, 'a', 'A' * 0x380)
+        mem.addMemoryMap(0x1380, e_mem.MM_RWX, 'b', 'B' * 0x80)
+        mem.addMemoryMap(0x2000, e_mem.MM_READ, 'c', 'C' * 0x10)
+
+        snap = mem.getMemorySnap()
+        self.assertTrue(mem.getMemorySnap() is snap)
+
+        # (across a page boundary and on into the next map)
+        mem.writeMemory(0x10fe, 'xyz')
+        mem.writeMemory(0x137e, 'qrst')
+        self.assertEqual(mem.readMemory(0x10fd, 5), 'Axyz' + 'A')
+        self.assertEqual(mem.readMemory(0x137c, 4), 'AAqr')
+        self.assertEqual(mem.readMemory(0x1380, 3), 'stB')
+        self.assertEqual(mem.getByteDef(0x10ff), (0xff, 'A' * 0xfe + 'xyz' + 'A' * 0x27d + 'qr'))
+        self.assertEqual(mem.readMemString(0x10fe, 5), 'xyzAA')
+        self.assertRaises(envi.SegmentationViolation, mem.writeMemory, 0x2000, 'x')
+
+        stats = mem.getMemorySnapStats()
+        self.assertEqual(stats['pages_copied'], 4)
+        self.assertEqual(stats['bytes_copied'], 0x100 * 2 + 0x80 * 2)
+
+        snap2 = mem.getMemorySnap()
+        mem.writeMemory(0x1100, 'Q')
+        self.assertEqual(mem.getMemorySnapStats()['pages_copied'], 5)
+
+        mem.setMemorySnap(snap)
+        self.assertEqual(mem.readMemory(0x10fe, 3), 'AAA')
+        self.assertEqual(mem.getByteDef(0x1000), (0, 'A' * 0x380))
+        mem.setMemorySnap(snap2)
+        self.assertEqual(mem.readMemory(0x10fe, 3), 'xyz')
+
+        # maps added after a snapshot go away when it is restored
+        mem.addMemoryMap(0x3000, e_mem.MM_RWX, 'd', 'D' * 0x10)
+        mem.setMemorySnap(snap)
+        self.assertEqual(mem.getMemoryMap(0x3000), None)
+
+    def test_envi_memory_cow_matches(self):
+        # random writes/snapshots/restores must match a plain MemoryObject
+        rand = random.Random(0x434f57)
+        mems = [ e_mem.MemoryObject(), e_mem.CowMemoryObject(pagesize=0x40) ]
+        for mem in mems:
+            mem.addMemoryMap(0x1000, e_mem.MM_RWX, 'a', 'A' * 0x300)
+            mem.addMemoryMap(0x1300, e_mem.MM_RWX, 'b', 'B' * 0x123)
+
+        snaps = []
+        for i in xrange(2000):
+            va = rand.randrange(0x1000, 0x1423)
+            action = rand.random()
+            if action < 0.7:
+                # (MemoryObject extends a map on a write past its end)
+                bytez = chr(rand.randrange(256)) * rand.randint(1, 0x50)
+                mva, msize = mems[0].getMemoryMap(va)[:2]
+                bytez = bytez[:mva + msize - va]
+                for mem in mems:
+                    mem.writeMemory(va, bytez)
+            elif action < 0.8:
+                snaps.append([ mem.getMemorySnap() for mem in mems ])
+            elif action < 0.9 and snaps:
+                for mem, snap in zip(mems, rand.choice(snaps)):
+                    mem.setMemorySnap(snap)
+            else:
+                size = rand.randint(1, 0x80)
+                self.assertEqual(mems[0].readMemory(va, size), mems[1].readMemory(va, size))
+                self.assertEqual(mems[0].readMemString(va), mems[1].readMemString(va))
+
+        for va in (0x1000, 0x1300):
+            self.assertEqual(str(mems[0].getByteDef(va)[1]), mems[1].getByteDef(va)[1])
+
+    def test_envi_memory_emu_snap(self):
+        emu = envi.getArchModule('i386').getEmulator()
+        emu.addMemoryMap(0x41410000, e_mem.MM_READ_WRITE, 'stack', '\xfe' * 0x8000)
+        emu.setRegisterByName('esp', 0x41418000)
+
+        snap = emu.getEmuSnap()
+        emu.writeMemoryFormat(0x41417ffc, '<I', 0x41414141)
+        emu.setRegisterByName('esp', 0x41417ffc)
+        self.assertEqual(emu.readMemoryFormat(0x41417ffc, '<I'), (0x41414141,))
+
+        emu.setEmuSnap(snap)
+        self.assertEqual(emu.getRegisterByName('esp'), 0x41418000)
+        self.assertEqual(emu.readMemory(0x41417ffc, 4), '\xfe' * 4)
+
+        stats = emu.getEmuStats()
+        self.assertEqual((stats['snapshots'], stats['restores']), (1, 1))
+        self.assertEqual((stats['pages_copied'], stats['bytes_copied']), (1, 4096))
@@ -0,0 +1,76 @@
+import random
+import unittest
+
+import envi.pagelookup as e_page
+
+class IntervalLookupTest(unittest.TestCase):
+
+    def test_interval_lookup_basic(self):
+        il = e_page.IntervalLookup()
+        il.initMapLookup(0x1000, 0x100)
+        il.initMapLookup(0x2000, 0x100)
+
+        loc = (0x1010, 8, 0, None)
+        il.setMapLookup(0x1010, 8, loc)
+        self.assertIsNone(il.getMapLookup(0x100f))
+        self.assertEqual(il.getMapLookup(0x1010), loc)
+        self.assertEqual(il.getMapLookup(0x1017), loc)
+        self.assertIsNone(il.getMapLookup(0x1018))
+
+        # clipped to the end of the containing map
+        il.setMapLookup(0x10f0, 0x20, 'tail')
+        self.assertEqual(il.getMapLookup(0x10ff), 'tail')
+        self.assertIsNone(il.getMapLookup(0x1100))
+
+        il.setMapLookup(0x1010, 8, None)
+        self.assertIsNone(il.getMapLookup(0x1010))
+        self.assertEqual(len(il), 1)
+
+        self.assertRaises(Exception, il.setMapLookup, 0x3000, 4, 'nope')
+
+    def test_interval_lookup_prev(self):
+        il = e_page.IntervalLookup()
+        il.initMapLookup(0x1000, 0x100)
+        self.assertIsNone(il.getPrevMapLookup(0x1050))
+        il.setMapLookup(0x1010, 4, 'a')
+        il.setMapLookup(0x1020, 4, 'b')
+        self.assertEqual(il.getPrevMapLookup(0x1012), 'a')
+        self.assertEqual(il.getPrevMapLookup(0x101f), 'a')
+        self.assertEqual(il.getPrevMapLookup(0x10ff), 'b')
+        self.assertIsNone(il.getPrevMapLookup(0x100f))
+
+    def test_interval_lookup_ranges(self):
+        il = e_page.IntervalLookup()
+        il.initMapLookup(0x1000, 0x100)
+        il.setMapLookup(0x1010, 8, 'a')
+        il.setMapLookup(0x1014, 8, 'b')
+        il.setMapLookup(0x1040, 4, 'c')
+        self.assertEqual(il.getMapRanges(), [(0x1010, 0x1014, 'a'), (0x1014, 0x101c, 'b'), (0x1040, 0x1044, 'c')])
+        self.assertEqual(il.getMapRanges(0x1012, 4), [(0x1010, 0x1014, 'a'), (0x1014, 0x101c, 'b')])
+        self.assertEqual(il.getMapRanges(0x1020, 0x20), [])
+
+    def test_interval_lookup_matches_maplookup(self):
+        # overlapping sets/clears must behave exactly like the per-byte MapLookup
+        rand = random.Random(0x56)
+        ml = e_page.MapLookup()
+        il = e_page.IntervalLookup()
+        for mva, msize in ((0x1000, 0x200), (0x1200, 0x80), (0x4000, 0x100)):
+            ml.initMapLookup(mva, msize)
+            il.initMapLookup(mva, msize)
+
+        vas = range(0x1000, 0x1280) + range(0x4000, 0x4100)
+        for i in xrange(2000):
+            va = rand.choice(vas)
+            size = rand.randint(1, 24)
+            obj = None
+            if rand.random() > 0.3:
+                obj = (va, size, i)
+            ml.setMapLookup(va, size, obj)
+            il.setMapLookup(va, size, obj)
+
+        for va in xrange(0xff0, 0x4110):
+            self.assertEqual(ml.getMapLookup(va), il.getMapLookup(va))
+
+        for mva, msize in ((0x1000, 0x200), (0x1200, 0x80), (0x4000, 0x100)):
+            covered = [ va for va in xrange(mva, mva + msize) if ml.getMapLookup(va) is not None ]
+            self.assertEqual(il.getMapCoverage(mva), len(covered))
@@ -118,7 +118,7 @@ class ChunkQueue:
             self.event.clear()
 
         self.event.wait(timeout=timeout)
-        if self.shut: raise QueueShutdown()
+        # (items put before a shutdown are still handed out)
         with self.lock:
             self.last = time.time()
             if not self.items and self.shut:
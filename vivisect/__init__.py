@@ -38,6 +38,10 @@ import vstruct.cparse as vs_cparse
 import vstruct.primitives as vs_prims
 
 import vivisect.base as viv_base
+import vivisect.compact as viv_compact
+import vivisect.snapshot as viv_snapshot
+import vivisect.storage as viv_storage
+import vivisect.storage.blobstore as viv_blobs
 import vivisect.parsers as viv_parsers
 import vivisect.codegraph as viv_codegraph
 import vivisect.impemu.lookup as viv_imp_lookup
@@ -69,12 +73,19 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         self.saved = True
         self.rchan = None
         self.server = None
+        self._server_batch = False  # Does our server have _fireEvents?
         self.verbose = False
         self.chanids = itertools.count()
 
         self.arch = None  # The placeholder for the Envi architecture module
         self.psize = None  # Used so much, optimization is appropriate
 
+        # LRU cache of parsed opcodes keyed by (va, arch)
+        self._op_cache = collections.OrderedDict()
+        self._op_cache_archs = set()
+        self._op_cache_hits = 0
+        self._op_cache_misses = 0
+
         cfgpath = os.path.join(self.vivhome, 'viv.json')
         self.config = e_config.EnviConfig(filename=cfgpath, defaults=defconfig, docs=docconfig)
 
@@ -87,7 +98,10 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         self._dead_data = []
         self.iscode = {}
 
-        self.xrefs = []
+        # Xref tuples (in the order they were added, and by type which
+        # is also used for dedup)
+        self.xrefs = viv_base.IndexedList()
+        self.xrefs_by_type = collections.defaultdict(viv_base.IndexedList)
         self.xrefs_by_to = {}
         self.xrefs_by_from = {}
 
@@ -96,6 +110,7 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
 
         self.metadata = {}
         self.comments = {}  # Comment by VA.
+        self.comment_index = viv_base.VaRangeIndex(self.comments)
         self.symhints = {}
 
         self.filemeta = {}  # Metadata Dicts stored by filename
@@ -105,6 +120,7 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
 
         self.va_by_name = {}
         self.name_by_va = {}
+        self.name_index = viv_base.VaRangeIndex(self.name_by_va)
         self.codeblocks_by_funcva = {}
         self.exports_by_va = {}
         self.colormaps = {}
@@ -187,16 +203,52 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
 
         return vivGuid
 
-    def loadWorkspace(self, wsname):
-        mname = self.getMeta("StorageModule")
-        mod = self.loadModule(mname)
-        mod.loadWorkspace(self, wsname)
+    def loadWorkspace(self, wsname, progress=None):
+        '''
+        Load the given workspace file.  Events are applied a chunk at a
+        time as they are read and the optional progress callback is
+        called as progress(count, rate) with the number of events loaded
+        so far and the events/sec rate (see importWorkspaceChunks()).
+
+        If the workspace has a valid snapshot (see the viv.SaveSnapshots
+        option) the derived indexes are restored from it and only the
+        events saved since are replayed.
+        '''
+        self._loadWorkspaceEvents(wsname, progress=progress)
+
         self.setMeta("StorageName", wsname)
         # The event list thusfar came *only* from the load...
         self._createSaveMark()
         # Snapin our analysis modules
         self._snapInAnalysisModules()
 
+    def _loadWorkspaceEvents(self, wsname, progress=None):
+        '''
+        Apply the events (or snapshot) from the given workspace file
+        without firing any events of our own (see loadWorkspace()).
+        '''
+        mname = viv_storage.guessStorageModule(wsname)
+        if mname == None:
+            mname = self.getMeta("StorageModule")
+        mod = self.loadModule(mname)
+
+        # Snapshots may only replace the state of an empty workspace
+        snapname = viv_snapshot.getSnapshotName(wsname)
+        if not self._map_defs and os.path.isfile(snapname):
+            if hasattr(mod, 'vivEventChunksFromFile'):
+                chunks = mod.vivEventChunksFromFile(wsname)
+            else:
+                chunks = viv_storage.iterEventChunks(mod.vivEventsFromFile(wsname))
+
+            chunks = viv_blobs.importChunks(viv_blobs.getWorkspaceStore(self), chunks)
+            rest = viv_snapshot.loadSnapshot(self, wsname, chunks)
+            if rest != None:
+                logger.info('loaded snapshot of %d events', len(self._event_list))
+                self.importWorkspaceChunks(rest, progress=progress)
+                return
+
+        mod.loadWorkspace(self, wsname, progress=progress)
+
     def addFref(self, fva, va, idx, val):
         """
         Add a reference from the operand at virtual address 'va'
@@ -492,11 +544,25 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
             local = True
 
         # Process the events from the import data...
-        fe = self._fireEvent
-        for event, einfo in wsevents:
-            fe(event, einfo, local=local)
+        self._fireEvents(wsevents, local=local)
         return
 
+    def importWorkspaceChunks(self, chunks, progress=None):
+        '''
+        Import the events from an iterable (usually a generator) of event
+        lists, applying each list as it arrives so the full event list
+        never needs to exist outside the workspace.
+
+        If specified, progress(count, rate) is called periodically with
+        the number of events imported so far and the events/sec rate.
+
+        Example:
+            chunks = viv_basicfile.vivEventChunksFromFile('foo.viv')
+            vw.importWorkspaceChunks(chunks)
+        '''
+        for events in viv_storage.iterProgress(chunks, progress):
+            self.importWorkspace(events)
+
     def exportWorkspace(self):
         '''
         Return the (probably big) list of events which define this
@@ -521,6 +587,12 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         self.server = remotevw
         self.rchan = remotevw.createEventChannel()
 
+        # (older servers only take one event at a time)
+        try:
+            self._server_batch = getattr(remotevw, '_fireEvents', None) != None
+        except Exception, e:
+            self._server_batch = False
+
         self.server.vprint('%s connecting...' % uname)
         wsevents = self.server.exportWorkspace()
         self.importWorkspace(wsevents)
@@ -539,8 +611,8 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
             raise Exception("_clientThread() with no server?!?!")
 
         while self.server != None:
-            event, einfo = self.server.waitForEvent(self.rchan)
-            self._fireEvent(event, einfo, local=True)
+            events = self.server.waitForEvents(self.rchan)
+            self._fireEvents(events, local=True)
 
     def waitForEvent(self, chanid, timeout=None):
         """
@@ -551,6 +623,23 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
             raise Exception("Invalid Channel")
         return q.get(timeout=timeout)
 
+    def waitForEvents(self, chanid, timeout=None):
+        """
+        Wait for at least one event and return a list of all the
+        (event, eventinfo) tuples currently pending on the channel.
+        """
+        q = self.chan_lookup.get(chanid)
+        if q == None:
+            raise Exception("Invalid Channel")
+
+        ret = [ q.get(timeout=timeout) ]
+        try:
+            while True:
+                ret.append(q.get_nowait())
+        except Queue.Empty:
+            pass
+        return ret
+
     def deleteEventChannel(self, chanid):
         """
         Remove a previously allocated event channel from
@@ -681,6 +770,9 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         stats = {
             'functions': len(self.funcmeta),
             'relocations': len(self.relocations),
+            'opcode_cache_hits': self._op_cache_hits,
+            'opcode_cache_misses': self._op_cache_misses,
+            'opcode_cache_size': len(self._op_cache),
         }
         return stats
 
@@ -708,33 +800,58 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         """
         disc = 0
         undisc = 0
-        for mva, msz, mperms, mname in self.getMemoryMaps():
-            if not self.isExecutable(mva):
+        for mva, msz, mperms, mname, mdisc in self.getMemoryMapCoverage():
+            if not mperms & e_mem.MM_EXEC:
                 continue
 
-            off = 0
-            while off < msz:
-                loc = self.getLocation(mva+off)
-                if loc == None:
-                    off += 1
-                    undisc += 1
-                else:
-                    off += loc[L_SIZE]
-                    disc += loc[L_SIZE]
-
-        numXrefs = len(self.getXrefs())
-        numLocs = len(self.getLocations())
-        numFuncs = len(self.getFunctions())
-        numBlocks = len(self.getCodeBlocks())
-        numOps = len(self.getLocations(LOC_OP))
-        numUnis = len(self.getLocations(LOC_UNI))
-        numStrings = len(self.getLocations(LOC_STRING))
-        numNumbers = len(self.getLocations(LOC_NUMBER))
-        numPointers = len(self.getLocations(LOC_POINTER))
-        numVtables = len(self.getLocations(LOC_VFTABLE))
+            disc += mdisc
+            undisc += msz - mdisc
+
+        numXrefs = self.getXrefCount()
+        numLocs = self.getLocationCount()
+        numFuncs = len(self.funcmeta)
+        numBlocks = len(self.codeblocks)
+        numOps = self.getLocationCount(LOC_OP)
+        numUnis = self.getLocationCount(LOC_UNI)
+        numStrings = self.getLocationCount(LOC_STRING)
+        numNumbers = self.getLocationCount(LOC_NUMBER)
+        numPointers = self.getLocationCount(LOC_POINTER)
+        numVtables = self.getLocationCount(LOC_VFTABLE)
 
         return disc, undisc, numXrefs, numLocs, numFuncs, numBlocks, numOps, numUnis, numStrings, numNumbers, numPointers, numVtables
 
+    def getMemoryMapCoverage(self):
+        """
+        Return a list of (va, size, perms, fname, discbytes) tuples giving
+        the number of bytes covered by locations in each memory map.  The
+        counts are maintained as locations come and go, so this is cheap.
+
+        Example:
+            for mva, msize, mperm, mname, disc in vw.getMemoryMapCoverage():
+                print('%s: %d%%' % (mname, disc * 100 / msize))
+        """
+        ret = []
+        for mva, msize, mperms, mname in self.getMemoryMaps():
+            ret.append((mva, msize, mperms, mname, self.locmap.getMapCoverage(mva)))
+        return ret
+
+    def getSegmentCoverage(self):
+        """
+        Return a list of (va, size, name, filename, discbytes) tuples giving
+        the number of bytes covered by locations in each segment (section).
+
+        Example:
+            for sva, ssize, sname, sfile, disc in vw.getSegmentCoverage():
+                print('%s %s: %d / %d' % (sfile, sname, disc, ssize))
+        """
+        ret = []
+        for sva, ssize, sname, sfile in self.getSegments():
+            undisc = 0
+            for uva, usize in self.iterUndefinedRanges(sva, ssize):
+                undisc += usize
+            ret.append((sva, ssize, sname, sfile, ssize - undisc))
+        return ret
+
     def getImports(self):
         """
         Return a list of imports in location tuple format.
@@ -803,26 +920,21 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
 
         for mva, msize, mperm, mname in self.getMemoryMaps():
 
-            offset, bytes = self.getByteDef(mva)
+            moff, bytes = self.getByteDef(mva)
             maxsize = len(bytes) - size
 
-            while offset + size < maxsize:
-                dbg = 0
-                va = mva + offset
-
-                loctup = self.getLocation(va)
-                if loctup != None:
-                    offset += loctup[L_SIZE]
-                    continue
-
-                x = e_bits.parsebytes(bytes, offset, size, bigend=self.bigend)
-                if self.isValidPointer(x):
-                    ret.append((va, x))
-                    offset += size
-                    continue
+            for uva, usize in self.iterUndefinedRanges(mva, msize):
+                offset = uva - mva
+                endoff = min(offset + usize, maxsize - size)
 
+                while offset < endoff:
+                    x = e_bits.parsebytes(bytes, offset, size, bigend=self.bigend)
+                    if self.isValidPointer(x):
+                        ret.append((mva + offset, x))
+                        offset += size
+                        continue
 
-                offset += 1
+                    offset += 1
 
         if cache:
             self.setTransMeta('findPointers', ret)
@@ -966,8 +1078,10 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         Example: op = m.parseOpcode(0x7c773803)
 
         note: differs from the IMemory interface by checking loclist
+
+        Parsed opcodes are kept in an LRU cache (see the viv.OpcodeCacheSize
+        config option) which is invalidated by writeMemory/addMemoryMap.
         '''
-        off, b = self.getByteDef(va)
         if arch == envi.ARCH_DEFAULT:
             loctup = self.getLocation(va)
             # XXX - in the case where we've set a location on what should be an
@@ -976,7 +1090,60 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
             if loctup is not None and loctup[L_TINFO] and loctup[L_LTYPE] == LOC_OP:
                 arch = loctup[L_TINFO]
 
-        return self.imem_archs[(arch & envi.ARCH_MASK) >> 16].archParseOpcode(b, off, va)
+        arch &= envi.ARCH_MASK
+        key = (va, arch)
+        op = self._op_cache.pop(key, None)
+        if op is not None:
+            self._op_cache_hits += 1
+            self._op_cache[key] = op
+            return op
+
+        self._op_cache_misses += 1
+        off, b = self.getByteView(va)
+        op = self.imem_archs[arch >> 16].archParseOpcode(b, off, va)
+
+        maxsize = self.config.viv.OpcodeCacheSize
+        if maxsize > 0:
+            self._op_cache[key] = op
+            self._op_cache_archs.add(arch)
+            while len(self._op_cache) > maxsize:
+                self._op_cache.popitem(last=False)
+
+        return op
+
+    def clearOpcodeCache(self, va=None, size=None):
+        '''
+        Drop cached opcodes.  If va/size are specified, only opcodes which
+        may overlap the given range are dropped.
+
+        Example:
+            vw.clearOpcodeCache(0x41414141, 4)
+        '''
+        if va == None or size > 4096 or size > len(self._op_cache):
+            self._op_cache.clear()
+            self._op_cache_archs.clear()
+            return
+
+        # no supported arch has an opcode longer than 16 bytes
+        for arch in self._op_cache_archs:
+            for opva in xrange(va - 15, va + size):
+                self._op_cache.pop((opva, arch), None)
+
+    def getOpcodeCacheStats(self):
+        '''
+        Return a (hits, misses, size) tuple for the opcode cache.
+        '''
+        return self._op_cache_hits, self._op_cache_misses, len(self._op_cache)
+
+    def writeMemory(self, va, bytes):
+        e_mem.MemoryObject.writeMemory(self, va, bytes)
+        if self._op_cache:
+            self.clearOpcodeCache(va, len(bytes))
+
+    def setMemArchitecture(self, arch):
+        e_mem.MemoryObject.setMemArchitecture(self, arch)
+        # (ARCH_DEFAULT opcodes are cached under the old default arch)
+        self.clearOpcodeCache()
 
     def iterJumpTable(self, startva, step=None, maxiters=None):
         if not step:
@@ -1527,9 +1694,8 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
             if self.getFunctionMeta(fva, 'Thunk') == name:
                 ret.extend( self.getCallers( fva ) )
 
-        for lva,lsize,ltype,tinfo in self.getLocations(LOC_IMPORT):
-            if tinfo == name:
-                ret.extend( self.getCallers( lva ) )
+        for lva,lsize,ltype,tinfo in self.getLocations(LOC_IMPORT, name):
+            ret.extend( self.getCallers( lva ) )
 
         return ret
 
@@ -1543,8 +1709,33 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         Return the entire list of XREF tuples for this workspace.
         """
         if rtype:
-            return [ xtup for xtup in self.xrefs if xtup[XR_RTYPE] == rtype ]
-        return self.xrefs
+            xrefs = self.xrefs_by_type.get(rtype)
+            if xrefs == None:
+                return []
+            return xrefs.tolist()
+        return self.xrefs.tolist()
+
+    def getXrefCount(self, rtype=None):
+        """
+        Return the number of xrefs in the workspace (optionally of
+        the given type) without building a list of them.
+        """
+        if rtype:
+            xrefs = self.xrefs_by_type.get(rtype)
+            if xrefs == None:
+                return 0
+            return len(xrefs)
+        return len(self.xrefs)
+
+    def isXref(self, xref):
+        """
+        Return True if the given (fromva, tova, rtype, rflags) xref
+        tuple exists in the workspace.
+        """
+        xrefs = self.xrefs_by_type.get(xref[XR_RTYPE])
+        if xrefs == None:
+            return False
+        return xref in xrefs
 
     def getXrefsFrom(self, va, rtype=None):
         """
@@ -1569,7 +1760,6 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         Get a list of xrefs which point to the given va. Optionally,
         specify an rtype to get only xrefs of that type.
         """
-        # FIXME make xrefs use MapLookup!
         ret = []
         xrefs = self.xrefs_by_to.get(va, None)
         if xrefs == None:
@@ -1660,7 +1850,7 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         tova, reftype, rflags = self.arch.archModifyXrefAddr(tova, reftype, rflags)
 
         ref = (fromva, tova, reftype, rflags)
-        if ref in self.getXrefsFrom(fromva):
+        if self.isXref(ref):
             return
         self._fireEvent(VWE_ADDXREF, (fromva, tova, reftype, rflags))
 
@@ -1669,8 +1859,8 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         Remove the given xref.  This *will* exception if the
         xref doesn't already exist...
         """
-        if ref not in self.getXrefsFrom(ref[XR_FROM]):
-            raise Exception("Unknown Xref: %x %x %d" % ref)
+        if not self.isXref(ref):
+            raise Exception("Unknown Xref: %x %x %d %r" % ref)
         self._fireEvent(VWE_DELXREF, ref)
 
     def analyzePointer(self, va):
@@ -1953,8 +2143,8 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         at the specified location (or -1 if no terminator
         is found in the memory map)
         """
-        offset, bytez = self.getByteDef(va)
-        foff = bytez.find('\x00', offset)
+        offset, bytez = self.getByteView(va)
+        foff = e_mem.findBytes(bytez, '\x00', offset)
         if foff == -1:
             return foff
         return (foff - offset) + 1
@@ -1965,8 +2155,8 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         at the specified location (or -1 if no terminator
         is found in the memory map)
         """
-        offset, bytez = self.getByteDef(va)
-        foff = bytez.find('\x00\x00', offset)
+        offset, bytez = self.getByteView(va)
+        foff = e_mem.findBytes(bytez, '\x00\x00', offset)
         if foff == -1:
             return foff
         return (foff - offset) + 2
@@ -1986,15 +2176,54 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
     def getLocations(self, ltype=None, linfo=None):
         """
         Return a list of location objects from the workspace
-        of a particular type.
+        of a particular type (in the order they were added).
         """
         if ltype == None:
-            return list(self.loclist)
+            return self.loclist.tolist()
+
+        locs = self.locs_by_type.get(ltype)
+        if locs == None:
+            return []
 
         if linfo == None:
-            return [ loc for loc in self.loclist if loc[2] == ltype ]
+            return locs.tolist()
 
-        return [ loc for loc in self.loclist if (loc[2] == ltype and loc[3] == linfo) ]
+        return [ loc for loc in locs if loc[L_TINFO] == linfo ]
+
+    def iterLocations(self, ltype=None, linfo=None):
+        """
+        Iterate the location objects from the workspace (optionally
+        of a particular type) without copying the location index.
+
+        NOTE: do not add or delete locations while iterating, use
+              getLocations() for that.
+
+        Example:
+            for lva, lsize, ltype, linfo in vw.iterLocations(LOC_STRING):
+                dostuff(lva)
+        """
+        if ltype == None:
+            locs = self.loclist
+        else:
+            locs = self.locs_by_type.get(ltype, ())
+
+        for loc in locs:
+            if linfo != None and loc[L_TINFO] != linfo:
+                continue
+            yield loc
+
+    def getLocationCount(self, ltype=None):
+        """
+        Return the number of locations in the workspace (optionally
+        of a particular type) without building a list of them.
+        """
+        if ltype == None:
+            return len(self.loclist)
+
+        locs = self.locs_by_type.get(ltype)
+        if locs == None:
+            return 0
+        return len(locs)
 
     def isLocation(self, va, range=False):
         """
@@ -2034,26 +2263,43 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         """
         ret = []
         endva = va+size
-        undefva = None
         while va < endva:
             ltup = self.getLocation(va)
             if ltup == None:
-                if undefva == None:
-                    undefva = va
-                va += 1
+                # The undefined run goes until the next location (or endva)
+                for uva, usize in self.iterUndefinedRanges(va, endva-va):
+                    break
+                ret.append((va, usize, LOC_UNDEF, None))
+                va += usize
             else:
-                if undefva != None:
-                    ret.append((undefva, va-undefva, LOC_UNDEF, None))
-                    undefva = None
                 ret.append(ltup)
                 va += ltup[L_SIZE]
 
-        # Mop up any hanging udefs
-        if undefva != None:
-            ret.append((undefva, va-undefva, LOC_UNDEF, None))
-
         return ret
 
+    def iterUndefinedRanges(self, va=None, size=None):
+        """
+        Yield (va, size) tuples for each run of undefined (no location)
+        bytes in the given range, or in every memory map if no range is
+        specified.  Runs are pulled from the location index, so walking
+        undefined space costs O(locations) rather than a lookup per byte.
+
+        The index is re-checked after each yield, so callers may make new
+        locations as they go.
+
+        Example:
+            for uva, usize in vw.iterUndefinedRanges():
+                dostuff(uva, usize)
+        """
+        if va == None:
+            ranges = [ (mva, msize) for mva, msize, mperm, mname in self.getMemoryMaps() ]
+        else:
+            ranges = [ (va, size) ]
+
+        for rva, rsize in ranges:
+            for uva, usize in self.locmap.getUnsetRanges(rva, rsize):
+                yield uva, usize
+
     def delLocation(self, va):
         """
         Delete the given Location object from the binary
@@ -2077,41 +2323,26 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         code and is considered "tightly coupled" with the asmview
         code.  (and is therefore subject to change).
         """
-        locs = []
         funcs = {}
-        names = {}
-        comments = {}
         extras = {}
 
-        for loc in self.getLocationRange(va, size):
-            lva, lsize, ltype, tinfo = loc
-            locs.append(loc)
+        locs = self.getLocationRange(va, size)
+        if locs:
+            # The first/last locations may hang off either end of the range
+            lva, lsize, ltype, tinfo = locs[-1]
+            endva = max(va + size, lva + lsize)
+            va = min(va, locs[0][L_VA])
+            size = endva - va
+
+        names = dict(self.getNamesInRange(va, size))
+        comments = dict(self.getCommentsInRange(va, size))
 
-            name = self.getName(lva)
-            isfunc = self.isFunction(lva)
-            cmnt = self.getComment(lva)
+        for lva, lsize, ltype, tinfo in locs:
 
-            if name != None:
-                names[lva] = name
-            if isfunc == True:
+            if self.isFunction(lva):
                 funcs[lva] = True
-            if cmnt != None:
-                comments[lva] = cmnt
-
-            if ltype == LOC_UNDEF:
-                # Expand out all undefs so we can send all the info
-                endva = lva + lsize
-                while lva < endva:
-                    uname = self.getName(lva)
-                    ucmnt = self.getComment(lva)
-                    if uname != None:
-                        names[lva] = uname
-                    if ucmnt != None:
-                        comments[lva] = ucmnt
-                    #ret.append(((lva, 1, LOC_UNDEF, None), self.getName(lva), False, self.getComment(lva)))
-                    lva += 1
-
-            elif ltype == LOC_OP:
+
+            if ltype == LOC_OP:
                 extras[lva] = self.parseOpcode(lva)
 
             elif ltype == LOC_STRUCT:
@@ -2119,6 +2350,32 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
 
         return locs, funcs, names, comments, extras
 
+    def getRenderInfoBatch(self, windows):
+        """
+        Get the render info (see getRenderInfo) for a list of (va, size)
+        windows in one call.  This saves remote (cobra) clients a round
+        trip per window.
+
+        Example:
+            for locs, funcs, names, cmnts, extras in vw.getRenderInfoBatch(windows):
+                dostuff()
+        """
+        return [ self.getRenderInfo(va, size) for va, size in windows ]
+
+    def getNamesInRange(self, va, size):
+        """
+        Return a sorted list of (va, name) tuples for the names which
+        fall in [va, va+size).
+        """
+        return [ (nva, self.name_by_va[nva]) for nva in self.name_index.getRange(va, size) ]
+
+    def getCommentsInRange(self, va, size):
+        """
+        Return a sorted list of (va, comment) tuples for the comments
+        which fall in [va, va+size).
+        """
+        return [ (cva, self.comments[cva]) for cva in self.comment_index.getRange(va, size) ]
+
     def getPrevLocation(self, va, adjacent=True):
         """
         Get the previous location behind this one.  If adjacent
@@ -2127,18 +2384,9 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         you find one or hit the edge of the segment.
         """
         va -= 1
-        ret = self.locmap.getMapLookup(va)
-        if ret != None:
-            return ret
         if adjacent:
-            return None
-        va -= 1
-        while va > 0:
-            ret = self.locmap.getMapLookup(va)
-            if ret != None:
-                return ret
-            va -= 1
-        return None
+            return self.locmap.getMapLookup(va)
+        return self.locmap.getPrevMapLookup(va)
 
     def vaByName(self, name):
         return self.va_by_name.get(name, None)
@@ -2232,7 +2480,12 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         return name
 
     def saveWorkspace(self, fullsave=True):
-
+        '''
+        Save the workspace using the configured StorageModule.  A full
+        save writes a compacted copy of the event list (see
+        compactWorkspace()) but leaves the workspace event list (and
+        the indexes of events within it) alone.
+        '''
         if self.server != None:
             return
 
@@ -2247,15 +2500,46 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         mod = self.loadModule(modname)
 
         # If they specified a full save, *or* this event list
-        # has never been saved before, do a full save.
-        if fullsave:
-            mod.saveWorkspace(self, filename)
+        # has been compacted since the last save, do a full save.
+        if fullsave or self._event_compacted:
+            events = viv_compact.compactEvents(self, self._event_list[:])
+            logger.info('compacted workspace events: %d -> %d', len(self._event_list), len(events))
+            mod.saveWorkspace(self, filename, events=events)
+            if self.config.viv.SaveSnapshots:
+                viv_snapshot.saveSnapshot(self, filename, events=len(events))
+            else:
+                viv_snapshot.removeSnapshot(filename)
         else:
             mod.saveWorkspaceChanges(self, filename)
 
         self._createSaveMark()
 
+    def compactWorkspace(self):
+        '''
+        Rewrite the workspace event list into the minimal equivalent
+        list of events (dropping events which later events overwrite or
+        undo).  The next save will be a full save.
+
+        NOTE: this changes the indexes of events in exportWorkspace()
+              (saveWorkspace() doesn't need it to write compacted files)
+
+        Returns a (before, after) tuple of event counts.
+
+        Example:
+            before, after = vw.compactWorkspace()
+        '''
+        if self.server != None:
+            raise Exception("Cannot compact a workspace client's events!")
+
+        before = len(self._event_list)
+        events = viv_compact.compactEvents(self, self._event_list[:before])
+        if len(events) != before:
+            # (in place, keeping any events fired while we compacted)
+            self._event_list[:before] = events
+            self._event_saved = 0
+            self._event_compacted = True
 
+        return before, len(events)
 
     def loadFromFd(self, fd, fmtname=None, baseaddr=None):
         """
@@ -2339,7 +2623,8 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
             return self.normFileName(filename)
 
         mod = viv_parsers.getParserModule(fmtname)
-        fname = mod.parseFile(self, filename, baseaddr=baseaddr)
+        with self.bulkEvents():
+            fname = mod.parseFile(self, filename, baseaddr=baseaddr)
 
         self.initMeta("StorageName", filename+".viv")
 
@@ -2360,7 +2645,8 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
 
         # TODO: Load workspace from memory?
         mod = viv_parsers.getParserModule(fmtname)
-        mod.parseMemory(self, memobj, baseaddr)
+        with self.bulkEvents():
+            mod.parseMemory(self, memobj, baseaddr)
 
         mapva, mapsize, mapperm, mapfname = memobj.getMemoryMap(baseaddr)
         if not mapfname:
@@ -2470,11 +2756,8 @@ class VivWorkspace(e_mem.MemoryObject, viv_base.VivWorkspaceCore):
         loctot = 0
         ret = {}
         for i in xrange(LOC_MAX):
-            cnt = 0
-            size = 0
-            for lva,lsize,ltype,tinfo in self.getLocations(i):
-                cnt += 1
-                size += lsize
+            cnt = self.getLocationCount(i)
+            size = self.locsize_by_type.get(i, 0)
             loctot += size
 
             tname = loc_type_names.get(i, 'Unknown')
@@ -10,6 +10,11 @@ dh_group1 = "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74020
 
 dh_group2 = "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7EDEE386BFB5A899FA5AE9F24117C4B1FE649286651ECE65381FFFFFFFFFFFFFFFF".decode("hex")
 
+dh_groups = {
+    "DH Well-Known MODP Group 1": dh_group1,
+    "DH Well-Known MODP Group 2": dh_group2,
+}
+
 md5_inits = [0x67452301,0xefcdab89,0x98badcfe,0x10325476]
 md5_xform = [
     3614090360, 3905402710, 606105819,  3250441966, 4118548399, 1200080426,
@@ -66,11 +71,8 @@ def analyze(vw):
         if md5_xform_score == len(md5_xform):
             rows.append((fva, "MD5 Transform"))
 
-    for va in vw.searchMemory(dh_group1):
-        rows.append((va, "DH Well-Known MODP Group 1"))
-
-    for va in vw.searchMemory(dh_group2):
-        rows.append((va, "DH Well-Known MODP Group 2"))
+    for name, va in vw.searchMemoryMulti(dh_groups):
+        rows.append((va, name))
 
     if len(rows):
         vw.vprint("Adding VA Set: %s" % vlname)
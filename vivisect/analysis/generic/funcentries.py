@@ -19,38 +19,39 @@ def analyze(vw):
     brute force find other function entry points based on the
     entry signatures db.
     """
-    # FIXME make the below code an undefined space iterator
-    # and use in findPointers too
     for mapva,mapsize,mapflags,fname in vw.getMemoryMaps():
 
         # Segment permissions check for likely code stuff at all
         if not mapflags & e_mem.MM_EXEC:
             continue
 
-        i = 0
-        maxsize = mapsize - 4
-        while i < maxsize:
-            va = mapva + i
-            loctup = vw.getLocation(va)
-            if loctup != None:
-                i += loctup[vivisect.L_SIZE]
-                continue
-
-            i+=1
-
-            try:
-
-                if vw.isFunctionSignature(va):
-                    #print "MATCH MATCH MATCH: 0x%.8x" % va
-                    vw.makeFunction(va)
-
-            except vivisect.InvalidLocation, msg:
-                if vw.verbose: vw.vprint("InvalidLocation: %s" % msg)
-            except envi.InvalidInstruction, e:
-                continue
-            except envi.EnviException, msg:
-                if vw.verbose: vw.vprint("%s: %s" % (msg.__class__.__name__,msg))
-            except Exception, msg:
-                traceback.print_exc()
-                continue
+        for uva, usize in vw.iterUndefinedRanges(mapva, mapsize - 4):
+
+            va = uva
+            endva = uva + usize
+            while va < endva:
+                # Functions made below may have eaten into this range
+                loctup = vw.getLocation(va)
+                if loctup != None:
+                    va = loctup[vivisect.L_VA] + loctup[vivisect.L_SIZE]
+                    continue
+
+                sigva = va
+                va += 1
+
+                try:
+
+                    if vw.isFunctionSignature(sigva):
+                        #print "MATCH MATCH MATCH: 0x%.8x" % sigva
+                        vw.makeFunction(sigva)
+
+                except vivisect.InvalidLocation, msg:
+                    if vw.verbose: vw.vprint("InvalidLocation: %s" % msg)
+                except envi.InvalidInstruction, e:
+                    continue
+                except envi.EnviException, msg:
+                    if vw.verbose: vw.vprint("%s: %s" % (msg.__class__.__name__,msg))
+                except Exception, msg:
+                    traceback.print_exc()
+                    continue
 
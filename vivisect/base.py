@@ -1,4 +1,5 @@
 import Queue
+import bisect
 import logging
 import traceback
 import threading
@@ -27,6 +28,15 @@ from vivisect.const import *
 
 logger = logging.getLogger(__name__)
 
+class BulkState(threading.local):
+    '''
+    Per-thread bulkEvents() state (only the thread inside the with
+    block defers publishing its events).
+    '''
+    def __init__(self):
+        self.depth = 0
+        self.pending = [] # (local, skip, events) tuples
+
 """
 Mostly this is a place to scuttle away some of the inner workings
 of a workspace, so the outer facing API is a little cleaner.
@@ -154,14 +164,145 @@ def ddict():
     return collections.defaultdict(dict)
 
 
+class VaRangeIndex(object):
+    '''
+    A sorted index over the keys of a va keyed dictionary (such as
+    name_by_va) which allows every key in [va, va+size) to be found
+    with a bisect.  The dictionary is the source of truth: additions
+    are buffered and merged on the next query, and removed keys are
+    simply filtered out until enough of them pile up to rebuild.
+    '''
+    def __init__(self, vadict):
+        self._vadict = vadict
+        self._vas = []
+        self._pending = set()
+        self._stale = 0
+
+    def add(self, va):
+        self._pending.add(va)
+
+    def remove(self, va):
+        self._pending.discard(va)
+        self._stale += 1
+
+    def _isStale(self):
+        return self._stale > 1024 + len(self._vas) / 2
+
+    def _merge(self):
+        vas = self._vas
+        pending = self._pending
+        if len(pending) < 64 and not self._isStale():
+            for va in pending:
+                idx = bisect.bisect_left(vas, va)
+                if idx == len(vas) or vas[idx] != va:
+                    vas.insert(idx, va)
+        else:
+            self._vas = sorted(self._vadict.iterkeys())
+            self._stale = 0
+        pending.clear()
+
+    def getRange(self, va, size):
+        '''
+        Return a sorted list of the keys which fall in [va, va+size).
+        '''
+        if self._pending or self._isStale():
+            self._merge()
+
+        vas = self._vas
+        lo = bisect.bisect_left(vas, va)
+        hi = bisect.bisect_left(vas, va + size, lo)
+
+        vadict = self._vadict
+        return [ v for v in vas[lo:hi] if v in vadict ]
+
+
+class IndexedList(object):
+    '''
+    An insertion ordered list of (hashable) items which supports
+    O(1) membership tests and amortized O(1) removal.  Removed
+    slots are left as None and the list is compacted once enough
+    of them pile up, so items must never be None themselves.
+
+    Like a list, the same item may be appended more than once and
+    remove() drops the first occurrence.
+    '''
+    def __init__(self, items=()):
+        self._items = []
+        self._pos = {}      # item -> index of its first live occurrence
+        self._dups = {}     # item -> number of *extra* live occurrences
+        self._dead = 0
+        for item in items:
+            self.append(item)
+
+    def __len__(self):
+        return len(self._items) - self._dead
+
+    def __contains__(self, item):
+        return item in self._pos
+
+    def __iter__(self):
+        for item in self._items:
+            if item is not None:
+                yield item
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+    def tolist(self):
+        if not self._dead:
+            return list(self._items)
+        return [ item for item in self._items if item is not None ]
+
+    def count(self, item):
+        if item not in self._pos:
+            return 0
+        return self._dups.get(item, 0) + 1
+
+    def append(self, item):
+        if item in self._pos:
+            self._dups[item] = self._dups.get(item, 0) + 1
+        else:
+            self._pos[item] = len(self._items)
+        self._items.append(item)
+
+    def remove(self, item):
+        idx = self._pos.pop(item, None)
+        if idx is None:
+            raise ValueError('IndexedList.remove(x): x not in list')
+
+        self._items[idx] = None
+        self._dead += 1
+
+        dups = self._dups.pop(item, 0)
+        if dups:
+            self._pos[item] = self._items.index(item, idx + 1)
+            if dups > 1:
+                self._dups[item] = dups - 1
+
+        if self._dead > 1024 and self._dead > len(self._items) / 2:
+            self._compact()
+
+    def _compact(self):
+        self._items = [ item for item in self._items if item is not None ]
+        self._dead = 0
+        pos = {}
+        for idx in xrange(len(self._items) - 1, -1, -1):
+            pos[self._items[idx]] = idx
+        self._pos = pos
+
+
 class VivWorkspaceCore(object, viv_impapi.ImportApi):
 
     def __init__(self):
         viv_impapi.ImportApi.__init__(self)
-        self.loclist = []
+        # Location tuples (in the order they were added, and by type)
+        # and a running total of their sizes by type
+        self.loclist = IndexedList()
+        self.locs_by_type = collections.defaultdict(IndexedList)
+        self.locsize_by_type = collections.defaultdict(int)
         self.bigend   = False
-        self.locmap   = e_page.MapLookup()
-        self.blockmap = e_page.MapLookup()
+        self.locmap   = e_page.IntervalLookup()
+        self.blockmap = e_page.IntervalLookup()
         self._mods_loaded = False
 
         # Storage for function local symbols
@@ -175,6 +316,10 @@ class VivWorkspaceCore(object, viv_impapi.ImportApi):
 
         self._event_list = []
         self._event_saved = 0 # The index of the last "save" event...
+        self._event_compacted = False # Must the next save be a full save?
+
+        # Events applied during bulkEvents() which are not yet published
+        self._bulk = BulkState()
 
         # Give ourself a structure namespace!
         self.vsbuilder = vs_builder.VStructBuilder()
@@ -197,6 +342,36 @@ class VivWorkspaceCore(object, viv_impapi.ImportApi):
         length of the event list (called after successful save)..
         '''
         self._event_saved = len(self._event_list)
+        self._event_compacted = False
+
+    @contextlib.contextmanager
+    def bulkEvents(self):
+        '''
+        Apply events as usual but defer publishing them to the server
+        and event channels until the (outermost) with block exits, at
+        which point they are sent along in one chunk.
+
+        NOTE: only the calling thread's events are deferred.  Events fired
+              by other threads meanwhile are published right away, so the
+              server and event channels may receive them *before* events
+              this thread applied earlier (the workspace event list keeps
+              the order they were applied in).  This thread's events stay
+              in order, and a transient (VTE_MASK) event first publishes
+              the events deferred ahead of it.
+
+        Example:
+            with vw.bulkEvents():
+                for va, size in stuff:
+                    vw.addLocation(va, size, LOC_NUMBER)
+        '''
+        bulk = self._bulk
+        bulk.depth += 1
+        try:
+            yield
+        finally:
+            bulk.depth -= 1
+            if not bulk.depth:
+                self._flushBulkEvents()
 
     @contextlib.contextmanager
     def getAdminRights(self):
@@ -208,6 +383,8 @@ class VivWorkspaceCore(object, viv_impapi.ImportApi):
         lva, lsize, ltype, linfo = loc
         self.locmap.setMapLookup(lva, lsize, loc)
         self.loclist.append(loc)
+        self.locs_by_type[ltype].append(loc)
+        self.locsize_by_type[ltype] += lsize
 
         # A few special handling cases...
         if ltype == LOC_IMPORT:
@@ -220,6 +397,8 @@ class VivWorkspaceCore(object, viv_impapi.ImportApi):
         lva, lsize, ltype, linfo = loc
         self.locmap.setMapLookup(lva, lsize, None)
         self.loclist.remove(loc)
+        self.locs_by_type[ltype].remove(loc)
+        self.locsize_by_type[ltype] -= lsize
 
     def _handleADDSEGMENT(self, einfo):
         self.segments.append(einfo)
@@ -343,6 +522,10 @@ class VivWorkspaceCore(object, viv_impapi.ImportApi):
 
     def _handleADDXREF(self, einfo):
         fromva, tova, reftype, rflags = einfo
+        xrefs = self.xrefs_by_type[reftype]
+        if einfo in xrefs:
+            return
+
         xr_to = self.xrefs_by_to.get(tova, None)
         xr_from = self.xrefs_by_from.get(fromva, None)
         if xr_to == None:
@@ -353,27 +536,41 @@ class VivWorkspaceCore(object, viv_impapi.ImportApi):
             xr_from = []
             self.xrefs_by_from[fromva] = xr_from
 
-        if einfo not in xr_to: # Just check one for now
-            xr_to.append(einfo)
-            xr_from.append(einfo)
-            self.xrefs.append(einfo)
+        xr_to.append(einfo)
+        xr_from.append(einfo)
+        xrefs.append(einfo)
+        self.xrefs.append(einfo)
 
     def _handleDELXREF(self, einfo):
         fromva, tova, reftype, refflags = einfo
-        self.xrefs_by_to[tova].remove(einfo)
-        self.xrefs_by_from[fromva].remove(einfo)
+        self.xrefs_by_type[reftype].remove(einfo)
+        self.xrefs.remove(einfo)
+
+        xr_to = self.xrefs_by_to[tova]
+        xr_to.remove(einfo)
+        if not xr_to:
+            self.xrefs_by_to.pop(tova)
+
+        xr_from = self.xrefs_by_from[fromva]
+        xr_from.remove(einfo)
+        if not xr_from:
+            self.xrefs_by_from.pop(fromva)
 
     def _handleSETNAME(self, einfo):
         va,name = einfo
         if name == None:
             oldname = self.name_by_va.pop(va, None)
             self.va_by_name.pop(oldname, None)
+            if oldname != None:
+                self.name_index.remove(va)
 
         else:
             curname = self.name_by_va.get(va)
             if curname != None:
                 logger.debug( 'replacing 0x%x: %r -> %r', va, curname, name)
                 self.va_by_name.pop(curname)
+            else:
+                self.name_index.add(va)
 
             self.va_by_name[name] = va
             self.name_by_va[va] = name
@@ -385,6 +582,7 @@ class VivWorkspaceCore(object, viv_impapi.ImportApi):
     def _handleADDMMAP(self, einfo):
         va, perms, fname, mbytes = einfo
         e_mem.MemoryObject.addMemoryMap(self, va, perms, fname, mbytes)
+        self.clearOpcodeCache()
 
         blen = len(mbytes)
         self.locmap.initMapLookup(va, blen)
@@ -413,8 +611,11 @@ class VivWorkspaceCore(object, viv_impapi.ImportApi):
     def _handleCOMMENT(self, einfo):
         va,comment = einfo
         if comment is None:
-            self.comments.pop(va, None)
+            if self.comments.pop(va, None) is not None:
+                self.comment_index.remove(va)
         else:
+            if va not in self.comments:
+                self.comment_index.add(va)
             self.comments[va] = comment
 
     def _handleADDFILE(self, einfo):
@@ -560,11 +761,16 @@ class VivWorkspaceCore(object, viv_impapi.ImportApi):
 
         try:
             if event & VTE_MASK:
+                self._flushBulkEvents()
                 return self._fireTransEvent(event, einfo)
 
             # Do our main event processing
             self.ehand[event](einfo)
 
+            if self._bulk.depth:
+                self._event_list.append((event, einfo))
+                return self._deferEvents([(event, einfo)], local, skip)
+
             # If we're supposed to call a server, do that.
             if self.server != None and local == False:
                 self.server._fireEvent(event, einfo, skip=self.rchan)
@@ -584,6 +790,87 @@ class VivWorkspaceCore(object, viv_impapi.ImportApi):
         except Exception, e:
             traceback.print_exc()
 
+    def _fireEvents(self, events, local=False, skip=None):
+        '''
+        Fire a list of (event, einfo) tuples.  Each event is applied
+        exactly as _fireEvent would, but the server and the event
+        channels each receive the whole list in one go.
+        '''
+        ehand = self.ehand
+        done = []
+        for event, einfo in events:
+            if event & VTE_MASK:
+                self._publishEvents(done, local, skip)
+                done = []
+                self._fireEvent(event, einfo, local=local, skip=skip)
+                continue
+
+            try:
+                ehand[event](einfo)
+            except Exception, e:
+                traceback.print_exc()
+                continue
+
+            done.append((event, einfo))
+
+        self._publishEvents(done, local, skip)
+
+    def _publishEvents(self, events, local=False, skip=None):
+        '''
+        Record an (already applied) list of events and send it along
+        to the server and event channels.
+        '''
+        if not events:
+            return
+
+        self._event_list.extend(events)
+        if self._bulk.depth:
+            return self._deferEvents(events, local, skip)
+
+        self._sendEvents(events, local, skip)
+
+    def _sendEvents(self, events, local, skip):
+        try:
+            if self.server != None and local == False:
+                if self._server_batch:
+                    self.server._fireEvents(events, skip=self.rchan)
+                else:
+                    for event, einfo in events:
+                        self.server._fireEvent(event, einfo, skip=self.rchan)
+        except Exception, e:
+            traceback.print_exc()
+
+        for id,q in self.chan_lookup.items():
+            if id == skip:
+                continue
+            try:
+                for etup in events:
+                    q.put_nowait(etup)
+            except Queue.Full, e:
+                print "FULL QUEUE DO SOMETHING"
+
+    def _deferEvents(self, events, local, skip):
+        # Group runs of events which share local/skip so they flush together
+        pending = self._bulk.pending
+        if pending:
+            plocal, pskip, pevents = pending[-1]
+            if plocal == local and pskip == skip:
+                pevents.extend(events)
+                return
+        pending.append((local, skip, list(events)))
+
+    def _flushBulkEvents(self):
+        '''
+        Publish any events deferred by bulkEvents().
+        '''
+        pending = self._bulk.pending
+        if not pending:
+            return
+
+        self._bulk.pending = []
+        for local, skip, events in pending:
+            self._sendEvents(events, local, skip)
+
     def _fireTransEvent(self, event, einfo):
         for q in self.chan_lookup.values():
             q.put((event, einfo))
@@ -604,6 +891,7 @@ class VivWorkspaceCore(object, viv_impapi.ImportApi):
 
     def setEndian(self, endian):
         self.bigend = endian
+        self.clearOpcodeCache()
         for arch in self.imem_archs:
             arch.setEndian(self.bigend)
 
@@ -616,12 +904,7 @@ class VivWorkspaceCore(object, viv_impapi.ImportApi):
 #  setMeta key callbacks
 #
     def _mcb_Architecture(self, name, value):
-        # This is for legacy stuff...
-        self.arch = envi.getArchModule(value)
-        self.psize = self.arch.getPointerSize()
-
-        archid = envi.getArchByName(value)
-        self.setMemArchitecture(archid)
+        self._initArchitecture(value)
 
         # Default calling convention for architecture
         # This will be superceded by Platform and Parser settings
@@ -629,6 +912,14 @@ class VivWorkspaceCore(object, viv_impapi.ImportApi):
         if defcall:
             self.setMeta('DefaultCall', defcall)
 
+    def _initArchitecture(self, value):
+        # This is for legacy stuff...
+        self.arch = envi.getArchModule(value)
+        self.psize = self.arch.getPointerSize()
+
+        archid = envi.getArchByName(value)
+        self.setMemArchitecture(archid)
+
     def _mcb_bigend(self, name, value):
         self.setEndian(bool(value))
 
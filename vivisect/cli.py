@@ -3,6 +3,7 @@ The vivisect CLI.
 """
 
 import sys
+import time
 import shlex
 import pprint
 import socket
@@ -207,6 +208,44 @@ class VivCli(e_cli.EnviCli, vivisect.VivWorkspace):
         self.saveWorkspace()
         self.vprint("...save complete!")
 
+    def do_compact(self, line):
+        """
+        Compact the workspace event list into the minimal equivalent set
+        of events and save the workspace.
+
+        Usage: compact [options]
+        -t Time replaying the event list (before and after) as a load would
+        -n Do not save the workspace after compacting
+        """
+        parser = e_cli.VOptionParser()
+        parser.add_option('-t', action='store_true', dest='timeit')
+        parser.add_option('-n', action='store_true', dest='nosave')
+        argv = shlex.split(line)
+        try:
+            options, argv = parser.parse_args(argv)
+        except Exception as e:
+            self.vprint(repr(e))
+            return self.do_help('compact')
+
+        def replaytime(events):
+            vw = vivisect.VivWorkspace()
+            start = time.time()
+            vw.importWorkspace(events)
+            return time.time() - start
+
+        if options.timeit:
+            oldtime = replaytime(self.exportWorkspace())
+
+        before, after = self.compactWorkspace()
+        self.vprint('Events: %d -> %d (%d removed)' % (before, after, before - after))
+
+        if options.timeit:
+            newtime = replaytime(self.exportWorkspace())
+            self.vprint('Load Time: %.2f sec -> %.2f sec' % (oldtime, newtime))
+
+        if not options.nosave:
+            self.do_save('')
+
     def do_xrefs(self, line):
         """
         Show xrefs for a particular location.
@@ -300,7 +339,7 @@ class VivCli(e_cli.EnviCli, vivisect.VivWorkspace):
 
         else:
             # the whole workspace is our oyster
-            valist = [va for va, lvsz, ltype, ltinfo in self.getLocations(LOC_OP)]
+            valist = [va for va, lvsz, ltype, ltinfo in self.iterLocations(LOC_OP)]
 
         res = []
         canv = e_canvas.StringMemoryCanvas(self)
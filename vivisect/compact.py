@@ -0,0 +1,244 @@
+'''
+Event list compaction for vivisect workspaces.
+
+The workspace event list is append-only, so a name which was changed ten
+times (or a location which was added, removed and added again) is replayed
+in full on every load.  compactEvents() rewrites an event list into a
+smaller list which replays to the same workspace state by dropping events
+whose effects are completely overwritten or undone by later events.
+
+Events are only ever dropped (never synthesized or reordered), and event
+types which are not understood here are kept verbatim.
+'''
+import envi.pagelookup as e_page
+
+from vivisect.const import *
+
+# Events whose handlers are no-ops (legacy / deprecated)
+dead_events = set([
+    VWE_ADDMODULE,
+    VWE_DELMODULE,
+    VWE_ADDFMODULE,
+    VWE_DELFMODULE,
+    VWE_ADDFSIG,
+    VWE_FOLLOWME,
+])
+
+# Meta keys which are read by other event handlers during replay
+replay_meta = set([
+    'NoReturnApis',
+])
+
+def _hkey(x):
+    # msgpack (remote workspaces) hands us lists rather than tuples
+    if isinstance(x, list):
+        x = tuple(x)
+    try:
+        hash(x)
+    except TypeError:
+        return None
+    return x
+
+def compactEvents(vw, events):
+    '''
+    Return a new list containing the minimal subset of the given
+    (event, einfo) list which replays to the same workspace state.
+
+    The workspace is only consulted for meta callbacks and pointer size.
+
+    Example:
+        events = vivisect.compact.compactEvents(vw, vw.exportWorkspace())
+    '''
+    keep = [ True ] * len(events)
+
+    lastwins = {}       # (event class, key) -> index of the last setter
+    deletes = set()     # (event class, key) whose last setter removes state
+    vasetdels = set()   # vaset names which ended up deleted
+
+    paint = e_page.IntervalLookup()
+    liveloc = {}        # loc -> index of the ADDLOCATION which made it
+    stuckloc = set()    # locations whose events must not be cancelled
+    livexref = {}       # xref -> index of the ADDXREF which made it
+    stuckva = set()     # from vas with xrefs/locations made by relocations
+    imagebase = {}
+    firstname = {}      # va -> index of the first SETNAME (see below)
+    funcvas = set()
+
+    def setlast(cls, key, i, isdel=False):
+        prev = lastwins.get((cls, key))
+        if prev is not None:
+            keep[prev] = False
+        lastwins[(cls, key)] = i
+        if isdel:
+            deletes.add((cls, key))
+        else:
+            deletes.discard((cls, key))
+
+    for i, (event, einfo) in enumerate(events):
+
+        if event in dead_events:
+            keep[i] = False
+
+        elif event == VWE_ADDMMAP:
+            va, perms, fname, mbytes = einfo
+            paint.initMapLookup(va, len(mbytes))
+
+        elif event == VWE_ADDFILE:
+            normname, baseaddr, md5sum = einfo
+            imagebase[normname] = baseaddr
+
+        elif event == VWE_ADDRELOC:
+            # BASEPTR relocations make a pointer location and xref without
+            # firing events, so nothing touching them may be cancelled.
+            if len(einfo) == 4 and einfo[2] == RTYPE_BASEPTR:
+                rva = imagebase.get(einfo[0], 0) + einfo[1]
+                stuckva.add(rva)
+                try:
+                    paint.setMapLookup(rva, vw.psize, ('reloc', rva))
+                except Exception:
+                    pass
+                stuckloc.add(('reloc', rva))
+
+        elif event == VWE_ADDLOCATION:
+            loc = _hkey(einfo)
+            if loc is None:
+                continue
+
+            lva, lsize, ltype, linfo = loc
+            if ltype == LOC_IMPORT or lva in stuckva or loc in liveloc:
+                stuckloc.add(loc)
+
+            # overlapping locations clobber each other in the locmap
+            try:
+                olocs = paint.getMapLookups(lva, lsize)
+                if olocs:
+                    stuckloc.add(loc)
+                    stuckloc.update(olocs)
+                paint.setMapLookup(lva, lsize, loc)
+            except Exception:
+                stuckloc.add(loc)
+
+            liveloc[loc] = i
+
+        elif event == VWE_DELLOCATION:
+            loc = _hkey(einfo)
+            if loc is None:
+                continue
+
+            lva, lsize, ltype, linfo = loc
+            try:
+                paint.setMapLookup(lva, lsize, None)
+            except Exception:
+                pass
+
+            addidx = liveloc.pop(loc, None)
+            if addidx is not None and loc not in stuckloc:
+                keep[addidx] = False
+                keep[i] = False
+
+        elif event == VWE_ADDXREF:
+            xref = _hkey(einfo)
+            if xref is None:
+                continue
+            # the handler ignores xrefs we already have
+            if xref in livexref:
+                keep[i] = False
+                continue
+            livexref[xref] = i
+
+        elif event == VWE_DELXREF:
+            xref = _hkey(einfo)
+            if xref is None:
+                continue
+            addidx = livexref.pop(xref, None)
+            if addidx is not None and xref[0] not in stuckva:
+                keep[addidx] = False
+                keep[i] = False
+
+        elif event == VWE_SETNAME:
+            # ADDFUNCTION uses the name the function had at the time, so
+            # the first name given to a va is always kept.
+            va, name = einfo
+            if firstname.setdefault(va, i) != i:
+                setlast(VWE_SETNAME, va, i, isdel=(name == None))
+
+        elif event == VWE_ADDFUNCTION:
+            funcvas.add(einfo[0])
+
+        elif event == VWE_COMMENT:
+            va, comment = einfo
+            setlast(VWE_COMMENT, va, i, isdel=(comment == None))
+
+        elif event == VWE_SYMHINT:
+            va, idx, hint = einfo
+            setlast(VWE_SYMHINT, (va, idx), i, isdel=(hint == None))
+
+        elif event in (VWE_ADDFREF, VWE_DELFREF):
+            va, idx, val = einfo
+            setlast(VWE_ADDFREF, (va, idx), i, isdel=(event == VWE_DELFREF))
+
+        elif event == VWE_ADDCOLOR:
+            setlast(VWE_ADDCOLOR, _hkey(einfo[0]), i)
+
+        elif event == VWE_DELCOLOR:
+            setlast(VWE_ADDCOLOR, _hkey(einfo), i, isdel=True)
+
+        elif event == VWE_SETFUNCARGS:
+            fva, args = einfo
+            setlast(VWE_SETFUNCARGS, fva, i)
+
+        elif event == VWE_SETMETA:
+            name, value = einfo
+            # meta with callbacks (or which other handlers read) is kept
+            if name in replay_meta:
+                continue
+            if getattr(vw, '_mcb_%s' % name.split(':')[0], None) != None:
+                continue
+            setlast(VWE_SETMETA, name, i)
+
+        elif event == VWE_SETFUNCMETA:
+            fva, name, value = einfo
+            if getattr(vw, '_fmcb_%s' % name.split(':')[0], None) != None:
+                continue
+            setlast(VWE_SETFUNCMETA, (fva, name), i)
+
+        elif event == VWE_SETFILEMETA:
+            fname, key, value = einfo
+            if key == 'imagebase':
+                imagebase[fname] = value
+                continue
+            setlast(VWE_SETFILEMETA, (fname, key), i)
+
+        elif event == VWE_SETVASETROW:
+            name, row = einfo
+            setlast(VWE_SETVASETROW, (name, _hkey(row[0])), i)
+
+        elif event == VWE_DELVASETROW:
+            # NOTE: not a "delete" which may be dropped, the row may have
+            # been given to us by ADDVASET
+            name, va = einfo
+            setlast(VWE_SETVASETROW, (name, _hkey(va)), i)
+
+        elif event == VWE_ADDVASET:
+            vasetdels.discard(einfo[0])
+
+        elif event == VWE_DELVASET:
+            vasetdels.add(einfo)
+
+    # Things which ended up removed never need to exist at all...
+    for cls, key in deletes:
+        if cls == VWE_SETNAME:
+            if key in funcvas:
+                continue
+            keep[firstname[key]] = False
+        keep[lastwins[(cls, key)]] = False
+
+    if vasetdels:
+        for i, (event, einfo) in enumerate(events):
+            if event in (VWE_ADDVASET, VWE_SETVASETROW, VWE_DELVASETROW):
+                if einfo[0] in vasetdels:
+                    keep[i] = False
+            elif event == VWE_DELVASET and einfo in vasetdels:
+                keep[i] = False
+
+    return [ events[i] for i in xrange(len(events)) if keep[i] ]
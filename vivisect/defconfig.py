@@ -4,6 +4,13 @@ defconfig = {
     'viv':{
 
         'SymbolCacheSave':True,
+        'OpcodeCacheSize':10000,
+        'SaveSnapshots':False,
+        'BlobStore':'',
+        'CompressCodec':'zlib',
+        'CompressLevel':6,
+        'CompressWorkers':0,
+        'MapInputFiles':False,
 
         'parsers':{
             'pe':{
@@ -44,6 +51,13 @@ docconfig = {
     'viv':{
 
         'SymbolCacheSave':'Save vivisect names to the vdb configured symbol cache?',
+        'OpcodeCacheSize':'How many parsed opcodes should parseOpcode keep cached? (0 disables)',
+        'SaveSnapshots':'Save a snapshot of the derived workspace indexes (foo.viv.vsnap) on full saves so loading may skip event replay?',
+        'BlobStore':'Directory of a shared, content-addressed store for memory map bytes (empty to keep them in the workspace file)',
+        'CompressCodec':'Codec for the compressedfile storage module (zlib, bz2 or lzma if available)',
+        'CompressLevel':'Compression level (0-9) for the compressedfile storage module',
+        'CompressWorkers':'Worker threads used to (de)compress compressedfile chunks (0 for one per cpu)',
+        'MapInputFiles':'Back memory maps with read-only mmaps of the input file (for inputs too big to read into memory)?',
 
         'parsers':{
             'pe':{
@@ -533,7 +533,7 @@ class WorkspaceEmulator:
         if self._safe_mem and not probeok:
             return
 
-        return e_mem.MemoryObject.writeMemory(self, va, bytes)
+        return e_mem.CowMemoryObject.writeMemory(self, va, bytes)
 
     def logUninitRegUse(self, regid):
         self.uninit_use[regid] = True
@@ -561,7 +561,7 @@ class WorkspaceEmulator:
         if self._safe_mem and not probeok:
             return 'A' * size
 
-        return e_mem.MemoryObject.readMemory(self, va, size)
+        return e_mem.CowMemoryObject.readMemory(self, va, size)
 
     # Some APIs for telling if pointers are in runtime memory regions
 
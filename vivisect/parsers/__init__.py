@@ -11,12 +11,16 @@ for vivisect.  Each parser module must implement the following functions:
 """
 # Some parser utilities
 
+import os
 import md5
 import sys
+import mmap
 import struct
 
 import vstruct.defs.macho as vs_macho
 
+import vivisect.storage as viv_storage
+
 def md5File(filename):
     d = md5.md5()
     f = file(filename,"rb")
@@ -31,6 +35,41 @@ def md5Bytes(bytes):
     d.update(bytes)
     return d.hexdigest()
 
+def mapFileBytes(vw, fd, offset, size):
+    '''
+    If the viv.MapInputFiles option is set, return a read-only mmap of
+    size bytes of the (real) file at offset (or a buffer() view of one
+    if offset isn't mmap aligned) to use as memory map bytes.  The OS
+    then pages the input in as it is used rather than the parser reading
+    it all into memory, and the first write to such a map gives it a
+    private copy (see MemoryObject.writeMemory).
+
+    Returns None if the option is not set or the range can't be mapped
+    (so the parser should read the bytes as usual).
+
+    Example:
+        bytez = mapFileBytes(vw, fd, secoff, secsize)
+        if bytez == None:
+            fd.seek(secoff)
+            bytez = fd.read(secsize)
+    '''
+    if not vw.config.viv.MapInputFiles or size <= 0:
+        return None
+
+    try:
+        fileno = fd.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None # (StringIO etc)
+
+    if offset < 0 or offset + size > os.fstat(fileno).st_size:
+        return None
+
+    delta = offset % mmap.ALLOCATIONGRANULARITY
+    mbytes = mmap.mmap(fileno, size + delta, access=mmap.ACCESS_READ, offset=offset - delta)
+    if delta:
+        return buffer(mbytes, delta, size)
+    return mbytes
+
 macho_magics = (
     vs_macho.MH_MAGIC,
     vs_macho.MH_CIGAM,
@@ -44,6 +83,9 @@ def guessFormat(bytes):
     if bytes.startswith('VIV'):
         return 'viv'
 
+    if viv_storage.isSqliteWorkspace(bytes):
+        return 'viv'
+
     if bytes.startswith("MZ"):
         return 'pe'
 
@@ -63,7 +105,7 @@ def guessFormat(bytes):
     return 'blob'
 
 def guessFormatFilename(filename):
-    bytez = file(filename, "rb").read(32)
+    bytez = file(filename, "rb").read(72)
     return guessFormat(bytez)
 
 def getParserModule(fmt):
@@ -1,3 +1,4 @@
+import os
 import envi
 import vivisect
 import vivisect.parsers as v_parsers
@@ -53,7 +54,10 @@ def parseFile(vw, filename, baseaddr=None):
     vw.setMeta('DefaultCall', archcalls.get(arch,'unknown'))
 
     fname = vw.addFile(filename, baseaddr, v_parsers.md5File(filename))
-    bytez =  file(filename, "rb").read()
+    with file(filename, "rb") as fd:
+        bytez = v_parsers.mapFileBytes(vw, fd, 0, os.path.getsize(filename))
+        if bytez == None:
+            bytez = fd.read()
     vw.addMemoryMap(baseaddr, 7, filename, bytez)
     vw.addSegment( baseaddr, len(bytez), '%.8x' % baseaddr, 'blob' )
 
@@ -186,8 +186,12 @@ def loadElfIntoWorkspace(vw, elf, filename=None, baseaddr=None):
             if pgm.p_memsz == 0:
                 continue
             logger.info('Loading: %s', repr(pgm))
-            bytez = elf.readAtOffset(pgm.p_offset, pgm.p_filesz)
-            bytez += "\x00" * (pgm.p_memsz - pgm.p_filesz)
+            bytez = None
+            if pgm.p_memsz == pgm.p_filesz:
+                bytez = v_parsers.mapFileBytes(vw, elf.fd, pgm.p_offset, pgm.p_filesz)
+            if bytez == None:
+                bytez = elf.readAtOffset(pgm.p_offset, pgm.p_filesz)
+                bytez += "\x00" * (pgm.p_memsz - pgm.p_filesz)
             pva = pgm.p_vaddr
             if addbase:
                 pva += baseaddr
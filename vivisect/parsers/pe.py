@@ -287,8 +287,12 @@ def loadPeIntoWorkspace(vw, pe, filename=None, baseaddr=None):
             readsize = sec.SizeOfRawData if sec.SizeOfRawData < sec.VirtualSize else sec.VirtualSize
 
             secoff = pe.rvaToOffset(secrva)
-            secbytes = pe.readAtOffset(secoff, readsize)
-            secbytes += "\x00" * plen
+            secbytes = None
+            if plen <= 0:
+                secbytes = v_parsers.mapFileBytes(vw, pe.fd, secoff, readsize)
+            if secbytes == None:
+                secbytes = pe.readAtOffset(secoff, readsize)
+                secbytes += "\x00" * plen
             vw.addMemoryMap(secbase, mapflags, fname, secbytes)
             vw.addSegment(secbase, len(secbytes), secname, fname)
 
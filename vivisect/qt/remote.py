@@ -9,6 +9,7 @@ import vqt.tree as vq_tree
 import envi.threads as e_threads
 import cobra.remoteapp as c_remoteapp
 import vivisect.remote.server as viv_server
+import vivisect.storage.blobstore as viv_blobs
 
 from vqt.basics import *
 
@@ -192,7 +193,8 @@ def saveToServer(vw, parent=None):
 @e_threads.firethread
 def sendServerWorkspace(vw, wsname, wsserver):
     try:
-        events = vw.exportWorkspace()
+        # (the server gets the bytes, not our blob store references)
+        events = list(viv_blobs.exportEvents(None, vw.exportWorkspace()))
         server = viv_server.connectToServer(wsserver)
         server.addNewWorkspace(wsname, events)
     except Exception, e:
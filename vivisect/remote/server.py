@@ -2,12 +2,16 @@ import os
 import sys
 import time
 import cobra
+import hashlib
 import Queue
+import logging
 import optparse
 import threading
 
 import vivisect
 import vivisect.cli as viv_cli
+import vivisect.snapshot as viv_snapshot
+import vivisect.storage as viv_storage
 import vivisect.storage.basicfile as viv_basicfile
 
 import cobra.dcode
@@ -15,6 +19,8 @@ import envi.threads as e_threads
 
 from vivisect.const import *
 
+logger = logging.getLogger(__name__)
+
 viv_port = 0x4074
 
 viv_s_ip = '224.56.56.56'
@@ -27,18 +33,51 @@ timeo_aban  = 120   # 2 minute timeout for abandon
 # This should *only* rev when they're truly incompatible
 server_version = 20130820
 
+# The most bytes returned by one readTransfer() call
+transfer_chunk = 4 * 1024 * 1024
+
+# Rebuild a workspace snapshot once this much of the file is newer
+snapshot_stale = 0.10
+
+def _md5File(filename, size=None):
+    md5 = hashlib.md5()
+    with file(filename, 'rb') as f:
+        _md5Update(md5, f, size)
+    return md5.hexdigest()
+
+def _md5Update(md5, f, size=None):
+    while size == None or size > 0:
+        buf = f.read(1024 * 1024 if size == None else min(size, 1024 * 1024))
+        if not buf:
+            break
+        md5.update(buf)
+        if size != None:
+            size -= len(buf)
+
 class VivServerClient:
     '''
     Implement "glue" methods for the vivisect workspace client to
     talk to the server...
     '''
-    def __init__(self, vw, server, wsname):
+    def __init__(self, vw, server, wsname, cachedir=None):
         self.vw = vw
         self.chan = None
         self.wsname = wsname
         self.server = server
         self.eoffset = 0
         self.q = Queue.Queue()  # The actual local Q we deliver to
+        self.transferred = False
+
+        # (older servers only take one event at a time)
+        try:
+            self.batch = getattr(server, '_fireEvents', None) != None
+        except Exception, e:
+            self.batch = False
+
+        # Where we keep the workspace files we transfer from the server
+        if cachedir == None:
+            cachedir = os.path.join(vw.vivhome, 'remote')
+        self.cachedir = cachedir
 
     @e_threads.firethread
     def _eatServerEvents(self):
@@ -52,18 +91,124 @@ class VivServerClient:
     def _fireEvent(self, event, einfo, local=False, skip=None):
         return self.server._fireEvent(self.wsname, event, einfo, local=local, skip=skip)
 
+    def _fireEvents(self, events, local=False, skip=None):
+        if not self.batch:
+            for event, einfo in events:
+                self.server._fireEvent(self.wsname, event, einfo, local=local, skip=skip)
+            return
+        return self.server._fireEvents(self.wsname, events, local=local, skip=skip)
+
     def createEventChannel(self):
-        self.chan = self.server.createEventChannel(self.wsname)
+        try:
+            wspath, chan = self._transferWorkspace()
+        except Exception, e:
+            # (probably an older server, fall back to streaming events)
+            self.vw.vprint('workspace transfer failed (%s), streaming events' % e)
+            self.chan = self.server.createEventChannel(self.wsname)
+        else:
+            # Load what we transferred (only events from the transfer
+            # point on come through the channel)
+            self.vw._loadWorkspaceEvents(wspath)
+            self.transferred = True
+            self.chan = chan
+
         self._eatServerEvents()
         return self.chan
 
+    def _getCachePath(self, name):
+        wspath = os.path.join(self.cachedir, hashlib.md5(self.wsname).hexdigest() + '.viv')
+        if name == 'snapshot':
+            return viv_snapshot.getSnapshotName(wspath)
+        return wspath
+
+    def _transferWorkspace(self):
+        '''
+        Bring our cached copy of the workspace file (and its snapshot)
+        up to date with the server and return (wspath, chan).
+        '''
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+
+        xferid, files = self.server.openTransfer(self.wsname)
+        for idx, (name, size) in enumerate(files):
+            self._transferFile(xferid, idx, size, self._getCachePath(name))
+
+        if 'snapshot' not in [ name for name, size in files ]:
+            snapname = self._getCachePath('snapshot')
+            if os.path.isfile(snapname):
+                os.unlink(snapname)
+
+        chan = self.server.finishTransfer(xferid)
+        return self._getCachePath('workspace'), chan
+
+    def _transferFile(self, xferid, idx, size, lpath):
+        # Resume from the bytes we already have if they still match
+        # (workspace files are only appended to)
+        have = 0
+        if os.path.isfile(lpath):
+            have = os.path.getsize(lpath)
+            if have > size or self.server.getTransferDigest(xferid, idx, have) != _md5File(lpath):
+                have = 0
+
+        with file(lpath, 'r+b' if have else 'wb') as f:
+            f.seek(have)
+            while have < size:
+                buf = self.server.readTransfer(xferid, idx, have, transfer_chunk)
+                if not buf:
+                    raise Exception('workspace transfer ended early (%d of %d bytes)' % (have, size))
+                f.write(buf)
+                have += len(buf)
+
     def exportWorkspace(self):
-        # Retrieve the big initial list of viv events
-        return self.server.getNextEvents(self.chan)
+        '''
+        Return the events to import when connecting to the workspace.
+        If the workspace was transferred, this is empty (the file was
+        loaded by createEventChannel()).  Otherwise this blocks until
+        every event the server streamed for the workspace has arrived.
+        '''
+        # If we transferred the workspace, the rest of the events will
+        # arrive through our normal event queue...
+        if self.transferred:
+            return []
+
+        try:
+            getStreamCount = getattr(self.server, 'getStreamCount', None)
+        except Exception, e:
+            getStreamCount = None
+
+        # (older servers send the whole workspace as the first batch)
+        if getStreamCount == None:
+            return self.waitForEvents(self.chan)
+
+        events = []
+        while True:
+            count = getStreamCount(self.chan)
+            events.extend(self._getQueued())
+            if count != None and len(events) >= count:
+                return events
+
+            try:
+                events.append(self.q.get(timeout=1))
+            except Queue.Empty:
+                pass
+
+    def _getQueued(self):
+        ret = []
+        try:
+            while True:
+                ret.append(self.q.get_nowait())
+        except Queue.Empty:
+            pass
+        return ret
 
     def waitForEvent(self, chan):
         return self.q.get()
 
+    def waitForEvents(self, chan):
+        ret = [ self.q.get() ]
+        ret.extend(self._getQueued())
+        return ret
+
 class VivServer:
 
     def __init__(self, dirname=""):
@@ -71,8 +216,13 @@ class VivServer:
 
         self.wsdict = {}
         self.chandict = {}
+        self.chanstream = {}    # chan -> streamed event count (or error)
         self.wslock = threading.Lock()
 
+        self.xfers = {}
+        self.snaplock = threading.Lock()
+        self.snapbusy = set()
+
         self._loadWorkspaces()
         self._maintThread()
         self._saveWorkspaceThread()
@@ -96,21 +246,32 @@ class VivServer:
             if queue.abandoned(timeo_aban):
                 # Remove from our chandict
                 self.chandict.pop(chan, None)
+                self.chanstream.pop(chan, None)
                 # Remove from the workspace clients
                 lock, fpath, pevents, users = wsinfo
                 with lock:
                     users.pop(chan,None)
 
+        for xferid in self.xfers.keys():
+            xfer = self.xfers.get(xferid)
+            if xfer == None:
+                continue
+
+            xlock, chan, files = xfer
+            if chan not in self.chandict:
+                self._closeTransfer(xferid)
+
     @e_threads.maintthread(30)
     def _saveWorkspaceThread(self):
         for wsinfo in self.wsdict.values():
             lock,path,events,users = wsinfo
             if events:
+                # NOTE: append under the lock so the file and the pending
+                # events list always add up to the whole workspace
                 with lock:
                     wsinfo[2] = []  # start a new events list...
+                    viv_basicfile.vivEventsAppendFile(path, events)
 
-                viv_basicfile.vivEventsAppendFile(path, events)
-                
     def _req_wsinfo(self, wsname):
         wsinfo = self.wsdict.get(wsname)
         if wsinfo == None:
@@ -157,7 +318,8 @@ class VivServer:
                 if not os.path.isfile(wspath):
                     continue
 
-                if not file(wspath,'rb').read(3) == 'VIV':
+                sig = file(wspath,'rb').read(8)
+                if not sig.startswith('VIV') or sig == viv_snapshot.vivsig_snapshot:
                     continue
 
                 wsinfo = self.wsdict.get(wsname)
@@ -176,6 +338,21 @@ class VivServer:
             raise Exception('Invalid Channel: %s' % chan)
         return chaninfo[1].get(timeout=timeo_wait)
 
+    def getStreamCount(self, chan):
+        '''
+        Return how many events were streamed onto the given event channel
+        (see createEventChannel()) when loading the workspace, or None if
+        it is still loading.  Raises an exception if the load failed.
+        Clients use this to tell when the whole workspace has arrived.
+        '''
+        if chan not in self.chandict:
+            raise Exception('Invalid Channel: %s' % chan)
+
+        count = self.chanstream.get(chan)
+        if isinstance(count, Exception):
+            raise count
+        return count
+
     # All APIs from here down are basically mirrors of the workspace APIs
     # used with remote workspaces, with a prepended wsname first argument
 
@@ -189,25 +366,215 @@ class VivServer:
             # SPEED HACK
             [ q.append(evtup) for (chan,q) in users.items() if chan != skip ]
 
-    def createEventChannel(self, wsname):
+    def _fireEvents(self, wsname, events, local=False, skip=None):
+        lock, fpath, pevents, users = self._req_wsinfo(wsname)
+        with lock:
+            # Transient events do not get saved
+            pevents.extend([ evtup for evtup in events if not evtup[0] & VTE_MASK ])
+            [ q.extend(events) for (chan,q) in users.items() if chan != skip ]
+
+    def createEventChannel(self, wsname, progress=None):
+        '''
+        Create an event channel for the given workspace.  The saved
+        events are streamed onto the channel a chunk at a time (so the
+        client may begin consuming them while the file is still being
+        read) and progress(count, rate) is called as they load.  See
+        getStreamCount() for when they have all been streamed.
+        '''
         wsinfo = self._req_wsinfo(wsname)
         chan = os.urandom(16).encode('hex')
 
+        queue = e_threads.ChunkQueue()
+        self.chandict[chan] = [ wsinfo, queue ]
+        self._streamEventChannel(wsinfo, chan, queue, progress)
+        return chan
+
+    def openTransfer(self, wsname):
+        '''
+        Begin a bulk transfer of the given workspace.  Returns (xferid,
+        files) where files is a list of (name, size) tuples for the
+        workspace file and its snapshot (if it has one) as of now.
+
+        Clients read the files with readTransfer() (resuming from any
+        bytes they kept from an earlier transfer, see getTransferDigest())
+        and then call finishTransfer() for an event channel which carries
+        every event from the transfer point on.
+
+        Example:
+            xferid, files = server.openTransfer('foo.viv')
+            for idx, (name, size) in enumerate(files):
+                off = 0
+                while off < size:
+                    buf = server.readTransfer(xferid, idx, off, 0x100000)
+                    off += len(buf)
+            chan = server.finishTransfer(xferid)
+        '''
+        wsinfo = self._req_wsinfo(wsname)
         lock, fpath, pevents, users = wsinfo
+
+        chan = os.urandom(16).encode('hex')
+        queue = e_threads.ChunkQueue()
+
+        files = []
         with lock:
-            events = []
-            events.extend( viv_basicfile.vivEventsFromFile( fpath ) )
-            events.extend(pevents)
-            # These must reference the same actual list object...
-            queue = e_threads.ChunkQueue(items=events)
+            # The file is only appended to (under the lock) so the bytes
+            # up to its current size are ours to send no matter what.
+            f = file(fpath, 'rb')
+            files.append(('workspace', f, os.fstat(f.fileno()).st_size))
+
+            snapname = viv_snapshot.getSnapshotName(fpath)
+            if os.path.isfile(snapname):
+                f = file(snapname, 'rb')
+                files.append(('snapshot', f, os.fstat(f.fileno()).st_size))
+
+            # events not yet in the file go first on the channel
+            queue.extend(pevents)
             users[chan] = queue
-            self.chandict[chan] = [ wsinfo, queue ]
 
+        self.chandict[chan] = [ wsinfo, queue ]
+
+        xferid = os.urandom(16).encode('hex')
+        self.xfers[xferid] = [ threading.Lock(), chan, files ]
+
+        self._checkSnapshot(wsinfo)
+        return xferid, [ (name, size) for name, f, size in files ]
+
+    def _req_xfer(self, xferid):
+        xfer = self.xfers.get(xferid)
+        if xfer == None:
+            raise Exception('Invalid Transfer: %s' % xferid)
+
+        # reading a transfer keeps its channel from being abandoned
+        chaninfo = self.chandict.get(xfer[1])
+        if chaninfo != None:
+            chaninfo[1].last = time.time()
+        return xfer
+
+    def readTransfer(self, xferid, idx, offset, size):
+        '''
+        Return (up to) size bytes from the given offset of the file at
+        index idx of the transfer (an empty string at the end).
+        '''
+        xlock, chan, files = self._req_xfer(xferid)
+        name, f, fsize = files[idx]
+        size = min(size, transfer_chunk, fsize - offset)
+        if size <= 0:
+            return ''
+
+        with xlock:
+            f.seek(offset)
+            return f.read(size)
+
+    def getTransferDigest(self, xferid, idx, size):
+        '''
+        Return the md5 hex digest of the first size bytes of the file at
+        index idx of the transfer (or None if the file is smaller).
+        '''
+        xlock, chan, files = self._req_xfer(xferid)
+        name, f, fsize = files[idx]
+        if size > fsize:
+            return None
+
+        md5 = hashlib.md5()
+        with xlock:
+            f.seek(0)
+            _md5Update(md5, f, size)
+        return md5.hexdigest()
+
+    def finishTransfer(self, xferid):
+        '''
+        Complete the transfer and return the event channel for the
+        events which follow the transferred files.
+        '''
+        xlock, chan, files = self._req_xfer(xferid)
+        self._closeTransfer(xferid)
         return chan
 
-def getServerWorkspace(server, wsname):
+    def _closeTransfer(self, xferid):
+        xfer = self.xfers.pop(xferid, None)
+        if xfer == None:
+            return
+
+        xlock, chan, files = xfer
+        with xlock:
+            for name, f, fsize in files:
+                f.close()
+
+    def _checkSnapshot(self, wsinfo):
+        '''
+        Rebuild the snapshot for the workspace (in the background) if it
+        is missing or too much of the file is newer than it.
+        '''
+        fpath = wsinfo[1]
+        fsize = os.path.getsize(fpath)
+        header = viv_snapshot.getSnapshotHeader(fpath)
+        if header != None and header.get('version') == viv_snapshot.snapshot_version:
+            if fsize - header.get('filesize', 0) <= fsize * snapshot_stale:
+                return
+
+        with self.snaplock:
+            if fpath in self.snapbusy:
+                return
+            self.snapbusy.add(fpath)
+
+        self._refreshSnapshot(wsinfo)
+
+    @e_threads.firethread
+    def _refreshSnapshot(self, wsinfo):
+        lock, fpath = wsinfo[:2]
+        try:
+            # Read the events under the lock so they match the file size
+            with lock:
+                fsize = os.path.getsize(fpath)
+                events = viv_basicfile.vivEventsFromFile(fpath)
+
+            vw = vivisect.VivWorkspace()
+            vw.importWorkspace(events)
+            viv_snapshot.saveSnapshot(vw, fpath, filesize=fsize, events=len(events))
+
+        except Exception, e:
+            self.vprint('failed to snapshot %s: %s' % (fpath, e))
+
+        finally:
+            with self.snaplock:
+                self.snapbusy.discard(fpath)
+
+    @e_threads.firethread
+    def _streamEventChannel(self, wsinfo, chan, queue, progress):
+        lock = wsinfo[0]
+        # Hold the lock for the duration so events fired while we load
+        # are queued behind the saved ones.
+        with lock:
+            lock, fpath, pevents, users = wsinfo
+            count = 0
+            try:
+                chunks = viv_basicfile.vivEventChunksFromFile(fpath)
+                for events in viv_storage.iterProgress(chunks, progress):
+                    queue.extend(events)
+                    count += len(events)
+                queue.extend(pevents)
+                count += len(pevents)
+            except e_threads.QueueShutdown:
+                return
+            except Exception, e:
+                # (shut the channel down so the client gets an error
+                # rather than waiting forever on a partial workspace)
+                logger.exception('failed to stream %s', fpath)
+                self.chanstream[chan] = Exception('failed to stream %s: %s' % (fpath, e))
+                queue.shutdown()
+                return
+            users[chan] = queue
+            self.chanstream[chan] = count
+
+def getServerWorkspace(server, wsname, cachedir=None):
+    '''
+    Return a VivCli workspace which is a client of the given workspace
+    on the server.  The workspace file is transferred into (and kept in)
+    cachedir (~/.viv/remote by default) so later connects only transfer
+    what is new.
+    '''
     vw = vivisect.cli.VivCli()
-    cliproxy = VivServerClient(vw, server, wsname)
+    cliproxy = VivServerClient(vw, server, wsname, cachedir=cachedir)
     vw.initWorkspaceClient( cliproxy )
     return vw
 
@@ -0,0 +1,264 @@
+'''
+Snapshots of the derived workspace indexes.
+
+Opening a workspace normally replays every event through the _handleXXX
+handlers to rebuild the locmap, xref dicts, call graph and so on.  A
+snapshot saves those derived structures beside the workspace file (as
+foo.viv.vsnap) along with the number of events they cover and a digest
+of the workspace file bytes which held those events.  loadSnapshot() only
+restores them if the snapshot schema version and the digest match, in
+which case just the events appended after the snapshot are replayed.
+
+The digest covers every byte of the snapshotted part of the file, and a
+full save which doesn't write a new snapshot removes the old one.
+
+Bump snapshot_version whenever a handler changes what it builds.
+'''
+import os
+import hashlib
+import itertools
+import logging
+import cPickle as pickle
+
+import vivisect.storage.blobstore as viv_blobs
+
+logger = logging.getLogger(__name__)
+
+vivsig_snapshot = 'VIVSNAP\x00'
+snapshot_version = 5
+
+# Bytes read at a time while hashing the workspace file
+snapshot_readsize = 1024 * 1024
+
+# Workspace attributes which are built (only) by event handlers
+snapshot_attrs = (
+    '_map_defs',
+    'bigend',
+    'locmap',
+    'blockmap',
+    'loclist',
+    'locs_by_type',
+    'locsize_by_type',
+    'localsyms',
+    'segments',
+    'exports',
+    'exports_by_va',
+    'codeblocks',
+    'codeblocks_by_funcva',
+    'relocations',
+    'reloc_by_va',
+    '_dead_data',
+    'xrefs',
+    'xrefs_by_type',
+    'xrefs_by_to',
+    'xrefs_by_from',
+    'metadata',
+    'comments',
+    'comment_index',
+    'symhints',
+    'filemeta',
+    'va_by_name',
+    'name_by_va',
+    'name_index',
+    'colormaps',
+    'vasetdefs',
+    'vasets',
+    'func_args',
+    'funcmeta',
+    'frefs',
+)
+
+# ...and those of the workspace helper objects (which aren't picklable)
+snapshot_subattrs = (
+    ('cfctx', ('_funcs', '_fcalls', '_cf_noret', '_cf_noflow')),
+    ('_call_graph', ('nodes', 'edges', 'edge_by_from', 'edge_by_to', 'nodeprops', 'edgeprops', 'formnodes', 'metadata')),
+)
+
+def getSnapshotName(filename):
+    return filename + '.vsnap'
+
+def _hashFile(filename, size):
+    '''
+    Return the md5 hex digest of the first size bytes of the file (or
+    None if the file is shorter than that).
+    '''
+    if os.path.getsize(filename) < size:
+        return None
+
+    md5 = hashlib.md5()
+    with file(filename, 'rb') as f:
+        left = size
+        while left:
+            buf = f.read(min(left, snapshot_readsize))
+            if not buf:
+                return None
+            md5.update(buf)
+            left -= len(buf)
+    return md5.hexdigest()
+
+def saveSnapshot(vw, filename, filesize=None, events=None):
+    '''
+    Save a snapshot of the derived indexes for the (just saved) workspace
+    file filename.  Every event in the workspace must be in the file (or
+    in its first filesize bytes if the file has been appended to since).
+    If the workspace was built from the file events (rather than saved
+    to it) specify how many events the file held.
+
+    Example:
+        vw.saveWorkspace()
+        vivisect.snapshot.saveSnapshot(vw, vw.getMeta('StorageName'))
+    '''
+    if filesize == None:
+        filesize = os.path.getsize(filename)
+    if events == None:
+        events = len(vw._event_list)
+    header = {
+        'version': snapshot_version,
+        'events': events,
+        'filesize': filesize,
+        'digest': _hashFile(filename, filesize),
+    }
+
+    state = {}
+    for name in snapshot_attrs:
+        state[name] = getattr(vw, name)
+
+    # memory map bytes from the blob store are saved as BlobRefs
+    store = viv_blobs.getWorkspaceStore(vw)
+    state['_map_defs'] = [ [mva, mmaxva, mmap, viv_blobs.exportBytes(store, mbytes)]
+                           for mva, mmaxva, mmap, mbytes in vw._map_defs ]
+
+    for objname, names in snapshot_subattrs:
+        obj = getattr(vw, objname)
+        state[objname] = dict([ (name, getattr(obj, name)) for name in names ])
+
+    snapname = getSnapshotName(filename)
+    tmpname = snapname + '.tmp'
+    with file(tmpname, 'wb') as f:
+        f.write(vivsig_snapshot)
+        pickle.dump(header, f, protocol=2)
+        # one pickle so objects shared between indexes stay shared
+        pickle.dump(state, f, protocol=2)
+
+    if os.name == 'nt' and os.path.exists(snapname):
+        os.unlink(snapname)
+    os.rename(tmpname, snapname)
+
+def removeSnapshot(filename):
+    '''
+    Remove the snapshot for the given workspace file (if there is one).
+    Used when the workspace file is rewritten without a new snapshot.
+    '''
+    snapname = getSnapshotName(filename)
+    if os.path.exists(snapname):
+        os.unlink(snapname)
+
+def _loadHeader(f, filename):
+    if f.read(len(vivsig_snapshot)) != vivsig_snapshot:
+        return None
+
+    header = pickle.load(f)
+    if header.get('version') != snapshot_version:
+        logger.info('snapshot version mismatch (%r), replaying events', header.get('version'))
+        return None
+
+    if _hashFile(filename, header['filesize']) != header.get('digest'):
+        logger.info('snapshot digest mismatch, replaying events')
+        return None
+
+    return header
+
+def getSnapshotHeader(filename):
+    '''
+    Return the header (a dict of version, events, filesize and digest)
+    of the snapshot for the given workspace file or None if there isn't
+    one.  Unlike loadSnapshot(), the digest is *not* verified.
+    '''
+    snapname = getSnapshotName(filename)
+    if not os.path.isfile(snapname):
+        return None
+
+    try:
+        with file(snapname, 'rb') as f:
+            if f.read(len(vivsig_snapshot)) != vivsig_snapshot:
+                return None
+            return pickle.load(f)
+    except Exception, e:
+        logger.warning('failed to read snapshot %s: %s', snapname, e)
+        return None
+
+def loadSnapshot(vw, filename, chunks):
+    '''
+    Restore the derived indexes for the given workspace file from its
+    snapshot (if there is a valid one).  chunks is an iterable of the
+    (blob store imported) event lists from the file.  The events which
+    the snapshot covers only go into the event list, and an iterator of
+    the event lists which the caller must replay is returned (or None if
+    the snapshot could not be used, in which case chunks may have been
+    partly consumed).
+
+    Example:
+        chunks = viv_basicfile.vivEventChunksFromFile(filename)
+        rest = loadSnapshot(vw, filename, chunks)
+        if rest != None:
+            vw.importWorkspaceChunks(rest)
+    '''
+    snapname = getSnapshotName(filename)
+    if not os.path.isfile(snapname):
+        return None
+
+    try:
+        with file(snapname, 'rb') as f:
+            header = _loadHeader(f, filename)
+            if header == None:
+                return None
+            state = pickle.load(f)
+
+        store = viv_blobs.getWorkspaceStore(vw)
+        for mdef in state['_map_defs']:
+            mdef[3] = viv_blobs.importBytes(store, mdef[3])
+
+    except Exception, e:
+        logger.warning('failed to load snapshot %s: %s', snapname, e)
+        return None
+
+    # Skip over the events the snapshot covers (keeping the rest of
+    # the chunk they end in for the caller)
+    count = header['events']
+    chunks = iter(chunks)
+    head = []
+    tail = []
+    while len(head) < count:
+        events = next(chunks, None)
+        if events == None:
+            logger.info('snapshot covers more events than %s holds, replaying events', filename)
+            return None
+
+        need = count - len(head)
+        head.extend(events[:need])
+        tail = events[need:]
+
+    for objname, names in snapshot_subattrs:
+        obj = getattr(vw, objname)
+        for name, value in state.pop(objname).items():
+            setattr(obj, name, value)
+
+    # (through setMemorySnap() so the map index is rebuilt)
+    vw.setMemorySnap(state.pop('_map_defs'))
+    for name, value in state.items():
+        setattr(vw, name, value)
+
+    # re-apply meta callback side effects (without firing events)
+    arch = vw.metadata.get('Architecture')
+    if arch != None:
+        vw._initArchitecture(arch)
+    vw.setEndian(vw.bigend)
+
+    for name, value in vw.metadata.items():
+        if name.startswith('ustruct:'):
+            vw._mcb_ustruct(name, value)
+
+    vw._event_list = head
+    if tail:
+        return itertools.chain([tail], chunks)
+    return chunks
@@ -3,4 +3,83 @@ Each sub-module here is capable of saving or loading
 a workspace.  the saveWorkspace and loadWorkspace functions
 each take a string for "backing info"
 """
+import time
 
+# File signatures for the storage modules which write them
+storage_sigs = (
+    ('VIVIDX\x00\x00', 'vivisect.storage.indexfile'),
+    ('VIVJRNL\x00', 'vivisect.storage.journalfile'),
+    ('VIVZ\x00\x00\x00\x00', 'vivisect.storage.compressedfile'),
+    ('VIV\x00\x00\x00\x00\x00', 'vivisect.storage.basicfile'),
+)
+
+def guessStorageModule(filename):
+    '''
+    Return the name of the storage module which wrote the given
+    workspace file (or None if it can't be determined).
+    '''
+    with open(filename, 'rb') as f:
+        sig = f.read(72)
+
+    for storsig, modname in storage_sigs:
+        if sig[:8] == storsig:
+            return modname
+
+    if isSqliteWorkspace(sig):
+        return 'vivisect.storage.sqlitefile'
+    return None
+
+def isSqliteWorkspace(bytez):
+    '''
+    Return True if the given file header is that of an sqlitefile
+    workspace (an sqlite database with our application_id).
+    '''
+    return bytez.startswith('SQLite format 3\x00') and bytez[68:72] == 'VIV\x00'
+
+# The number of events per chunk when streaming events to/from storage
+chunk_size = 50000
+
+def iterEventChunks(events, size=chunk_size):
+    '''
+    Yield lists of (at most) size events from the given event iterable.
+    '''
+    chunk = []
+    for evt in events:
+        chunk.append(evt)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iterProgress(chunks, progress=None, interval=1.0):
+    '''
+    Pass through the given iterable of event lists, calling
+    progress(count, rate) with the number of events seen so far and
+    the events/sec rate at most once every interval seconds (and once
+    more when the chunks run out).
+
+    Example:
+        def progress(count, rate):
+            print('%d events (%d/sec)' % (count, rate))
+
+        for events in iterProgress(chunks, progress):
+            vw.importWorkspace(events)
+    '''
+    if progress == None:
+        for chunk in chunks:
+            yield chunk
+        return
+
+    count = 0
+    start = time.time()
+    last = start
+    for chunk in chunks:
+        yield chunk
+        count += len(chunk)
+        now = time.time()
+        if now - last >= interval:
+            last = now
+            progress(count, count / max(now - start, 0.000001))
+
+    progress(count, count / max(time.time() - start, 0.000001))
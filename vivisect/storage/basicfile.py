@@ -1,17 +1,22 @@
 import cPickle as pickle
 import vivisect
+import vivisect.storage as viv_storage
+import vivisect.storage.blobstore as viv_blobs
 
 vivsig_cpickle = 'VIV'.ljust(8,'\x00')
 
 def saveWorkspaceChanges(vw, filename):
     elist = vw.exportWorkspaceChanges()
     if len(elist):
+        elist = list(viv_blobs.exportEvents(viv_blobs.getWorkspaceStore(vw), elist))
         f = file(filename, 'ab')
         pickle.dump(elist, f, protocol=2)
         f.close()
 
-def saveWorkspace(vw, filename):
-    events = vw.exportWorkspace()
+def saveWorkspace(vw, filename, events=None):
+    if events == None:
+        events = vw.exportWorkspace()
+    events = list(viv_blobs.exportEvents(viv_blobs.getWorkspaceStore(vw), events))
     vivEventsToFile(filename, events)
 
 def vivEventsAppendFile(filename, events):
@@ -24,32 +29,46 @@ def vivEventsToFile(filename, events):
     f = file(filename, 'wb')
     # Mime type for the basic workspace
     f.write(vivsig_cpickle)
-    pickle.dump(events, f, protocol=2)
+    # Write the events as a series of pickled lists (just like appended
+    # changes) so they may be loaded a chunk at a time.
+    for i in xrange(0, max(len(events), 1), viv_storage.chunk_size):
+        pickle.dump(events[i:i+viv_storage.chunk_size], f, protocol=2)
     f.close()
 
-def vivEventsFromFile(filename):
+def vivEventChunksFromFile(filename):
+    '''
+    Yield the lists of events from the given workspace file one pickled
+    list at a time (without ever holding the whole event list).
+    '''
     f = file(filename, "rb")
-    vivsig = f.read(8)
+    try:
+        vivsig = f.read(8)
 
-    # check for various viv serial formats
-    if vivsig == vivsig_cpickle:
-        pass
+        # check for various viv serial formats
+        if vivsig == vivsig_cpickle:
+            pass
 
-    else: # FIXME legacy file format.... ( eventually remove )
-        f.seek(0)
+        else: # FIXME legacy file format.... ( eventually remove )
+            f.seek(0)
 
-    events = []
-    # Incremental changes are saved to the file by appending more pickled
-    # lists of exported events
-    while True:
-        try:
-            events.extend( pickle.load(f) )
-        except EOFError, e:
-            break
-        except pickle.UnpicklingError, e:
-            raise vivisect.InvalidWorkspace(filename, "invalid workspace file")
+        # Incremental changes are saved to the file by appending more pickled
+        # lists of exported events
+        while True:
+            try:
+                events = pickle.load(f)
+            except EOFError, e:
+                break
+            except pickle.UnpicklingError, e:
+                raise vivisect.InvalidWorkspace(filename, "invalid workspace file")
+            yield events
 
-    f.close()
+    finally:
+        f.close()
+
+def vivEventsFromFile(filename):
+    events = []
+    for chunk in vivEventChunksFromFile(filename):
+        events.extend(chunk)
 
     # FIXME - diagnostics to hunt msgpack unsave values
     #for event in events:
@@ -61,8 +80,9 @@ def vivEventsFromFile(filename):
 
     return events
 
-def loadWorkspace(vw, filename):
-    events = vivEventsFromFile(filename)
-    vw.importWorkspace(events)
+def loadWorkspace(vw, filename, progress=None):
+    chunks = vivEventChunksFromFile(filename)
+    chunks = viv_blobs.importChunks(viv_blobs.getWorkspaceStore(vw), chunks)
+    vw.importWorkspaceChunks(chunks, progress=progress)
     return
 
@@ -0,0 +1,195 @@
+'''
+A content-addressed store for memory map bytes shared between workspaces.
+
+When the viv.BlobStore option names a directory, the storage modules write
+each memory map's bytes into it once (as <dir>/<ab>/<sha256>) and save a
+BlobRef in the ADDMMAP event in place of the bytes.  Loading replaces each
+BlobRef with a read-only mmap of the blob, so workspaces of the same
+binary share both the disk space and the page cache.  The store only
+keeps weak references to the mmaps it hands out, so each one is closed
+once the last workspace using it goes away.
+
+The mmap objects behave like the strings they replace for reads (slices,
+find, struct/re) and writes to the workspace memory simply replace them
+with a bytearray copy (see MemoryObject.writeMemory).
+'''
+import os
+import mmap
+import weakref
+import hashlib
+import tempfile
+import threading
+import collections
+
+import vivisect
+
+from vivisect.const import *
+
+BlobRef = collections.namedtuple('BlobRef', 'digest size')
+
+# BlobStore instances by (real) directory path
+_stores = {}
+_stores_lock = threading.Lock()
+
+class BlobMap(mmap.mmap):
+    '''
+    A read-only mmap of a blob which knows its BlobRef (so saving it
+    again doesn't re-hash the bytes).
+    '''
+    blobref = None
+
+class BlobStore:
+    '''
+    A directory of blobs named by the sha256 of their contents.
+
+    Example:
+        store = getBlobStore('/archive/blobs')
+        ref = store.putBlob(bytez)
+        mbytes = store.getBlob(ref)
+    '''
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.lock = threading.Lock()
+        # digest -> BlobMap (for as long as something else uses it)
+        self._maps = weakref.WeakValueDictionary()
+
+    def _blobPath(self, digest):
+        return os.path.join(self.dirname, digest[:2], digest)
+
+    def putBlob(self, bytez):
+        '''
+        Store the given bytes (if they aren't already) and return a BlobRef.
+        '''
+        if isinstance(bytez, BlobMap) and os.path.isfile(self._blobPath(bytez.blobref.digest)):
+            return bytez.blobref
+
+        ref = BlobRef(hashlib.sha256(bytez).hexdigest(), len(bytez))
+        path = self._blobPath(ref.digest)
+        if os.path.isfile(path):
+            return ref
+
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # (someone else made it)
+                if not os.path.isdir(dirname):
+                    raise
+
+        # write to a temp file and rename so readers never see a partial blob
+        fd, tmpname = tempfile.mkstemp(dir=dirname)
+        try:
+            os.write(fd, bytez)
+        finally:
+            os.close(fd)
+        os.chmod(tmpname, 0444)
+        if os.name == 'nt' and os.path.exists(path):
+            os.unlink(tmpname)
+        else:
+            os.rename(tmpname, path)
+
+        return ref
+
+    def getBlob(self, ref):
+        '''
+        Return a read-only mmap (a BlobMap) of the blob for the given
+        BlobRef.
+        '''
+        with self.lock:
+            mbytes = self._maps.get(ref.digest)
+            if mbytes != None:
+                return mbytes
+
+            path = self._blobPath(ref.digest)
+            if not os.path.isfile(path):
+                raise vivisect.InvalidWorkspace(path, 'blob %s not in blob store %s' % (ref.digest, self.dirname))
+
+            if ref.size == 0:
+                # (zero length files can't be mapped)
+                return ''
+
+            with file(path, 'rb') as f:
+                mbytes = BlobMap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            if len(mbytes) != ref.size:
+                mbytes.close()
+                raise vivisect.InvalidWorkspace(path, 'blob %s has the wrong size' % ref.digest)
+
+            mbytes.blobref = ref
+            self._maps[ref.digest] = mbytes
+            return mbytes
+
+def getBlobStore(dirname):
+    '''
+    Return the (per process) BlobStore for the given directory.
+    '''
+    dirname = os.path.realpath(dirname)
+    with _stores_lock:
+        store = _stores.get(dirname)
+        if store == None:
+            store = BlobStore(dirname)
+            _stores[dirname] = store
+        return store
+
+def getWorkspaceStore(vw):
+    '''
+    Return the BlobStore configured for the workspace (or None).
+    '''
+    dirname = vw.config.viv.BlobStore
+    if not dirname:
+        return None
+    return getBlobStore(os.path.expanduser(dirname))
+
+def exportBytes(store, bytez):
+    '''
+    Return the BlobRef to save in place of the given memory map bytes.
+    If store is None, mmap'd (or buffer or written to) bytes are turned
+    back into a string.
+    '''
+    if isinstance(bytez, bytearray):
+        bytez = str(bytez)
+    if store != None:
+        return store.putBlob(bytez)
+    if isinstance(bytez, (mmap.mmap, buffer)):
+        return bytez[:]
+    return bytez
+
+def importBytes(store, bytez):
+    '''
+    Return the memory map bytes for a (possible) BlobRef.
+    '''
+    if not isinstance(bytez, BlobRef):
+        return bytez
+    if store == None:
+        raise vivisect.InvalidWorkspace(bytez.digest, 'workspace uses a blob store (set viv.BlobStore)')
+    return store.getBlob(bytez)
+
+def exportEvents(store, events):
+    '''
+    Yield the given events with the ADDMMAP bytes moved into the store
+    (replaced by BlobRefs).
+    '''
+    for event, einfo in events:
+        if event == VWE_ADDMMAP:
+            va, perms, fname, mbytes = einfo
+            einfo = (va, perms, fname, exportBytes(store, mbytes))
+        yield event, einfo
+
+def importEvents(store, events):
+    '''
+    Yield the given events with any BlobRefs replaced by mmaps of the
+    blobs from the store.
+    '''
+    for event, einfo in events:
+        if event == VWE_ADDMMAP:
+            va, perms, fname, mbytes = einfo
+            einfo = (va, perms, fname, importBytes(store, mbytes))
+        yield event, einfo
+
+def importChunks(store, chunks):
+    '''
+    Like importEvents() for an iterable of event lists.
+    '''
+    for events in chunks:
+        yield list(importEvents(store, events))
@@ -0,0 +1,351 @@
+'''
+A compressed workspace storage module.
+
+The events are saved as a series of independently compressed chunks:
+
+    <codec:u8> <kind:u8> <clen:u64> <rlen:u64> <count:u32> <crc32:u32> <payload>
+
+where the payload of an events chunk is a compressed, pickled list of
+count events.  Memory map bytes make up most of a big workspace, so each
+ADDMMAP event gets a chunk to itself, and the bytes of a map bigger than
+map_chunk_size are saved as a series of map bytes chunks (of the raw
+bytes) right after it, with a MapBytes placeholder in the event.
+Because chunks don't depend on each other, they are pickled/compressed
+(and decompressed/unpickled) by a pool of worker threads (zlib, bz2 and
+lzma all release the GIL while they work), and a reader may walk the
+chunk headers (see iterChunkIndex()) to seek to any chunk without
+inflating the rest of the file.
+
+Incremental saves append more chunks.
+
+The codec, level and number of workers come from the viv.CompressCodec,
+viv.CompressLevel and viv.CompressWorkers options.
+
+Use it with: vivbin -s compressedfile ...
+'''
+import bz2
+import zlib
+import struct
+import collections
+import multiprocessing
+import multiprocessing.pool
+import cPickle as pickle
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+import vivisect
+import vivisect.storage.blobstore as viv_blobs
+
+from vivisect.const import *
+
+vivsig_compressed = 'VIVZ\x00\x00\x00\x00'
+
+chunk_fmt = '<BBQQII'       # codec, kind, compressed length, raw length, event count, crc32
+chunk_hdr_size = struct.calcsize(chunk_fmt)
+
+# Chunk kinds
+CHUNK_EVENTS = 0            # a pickled list of events
+CHUNK_MAPBYTES = 1          # (part of) the bytes of a memory map
+
+# The number of events per chunk (smaller than the plain storage
+# chunks so the work spreads across the pool)
+events_per_chunk = 8192
+
+# Memory maps bigger than this are split into map bytes chunks
+map_chunk_size = 16 * 1024 * 1024
+
+ChunkInfo = collections.namedtuple('ChunkInfo', 'offset codec kind clen rlen count first')
+
+# Saved in an ADDMMAP event in place of bytes which follow as map bytes chunks
+MapBytes = collections.namedtuple('MapBytes', 'size')
+
+def _lzmaCompress(bytez, level):
+    return lzma.compress(bytez, preset=level)
+
+# codec name -> (codec id, compress(bytez, level), decompress(bytez))
+codecs = {
+    'zlib': (1, zlib.compress, zlib.decompress),
+    'bz2': (2, bz2.compress, bz2.decompress),
+}
+if lzma != None:
+    codecs['lzma'] = (3, _lzmaCompress, lzma.decompress)
+
+codecs_by_id = dict([ (cid, (name, comp, decomp)) for name, (cid, comp, decomp) in codecs.items() ])
+
+def _crc(bytez):
+    return zlib.crc32(bytez) & 0xffffffff
+
+def _clampLevel(codec, level):
+    # bz2 levels are 1-9 (zlib and lzma accept 0)
+    if codec == 'bz2':
+        return max(1, min(level, 9))
+    return max(0, min(level, 9))
+
+def _packChunk(args):
+    codec, level, kind, data = args
+    cid, comp, decomp = codecs[codec]
+    if kind == CHUNK_EVENTS:
+        raw = pickle.dumps(data, protocol=2)
+        count = len(data)
+    else:
+        raw = data
+        count = 0
+    payload = comp(raw, level)
+    return struct.pack(chunk_fmt, cid, kind, len(payload), len(raw), count, _crc(payload)) + payload
+
+def _unpackChunk(args):
+    '''
+    Return a (kind, data) tuple for the chunk (data is the list of
+    events or the map bytes).
+    '''
+    filename, cid, kind, payload, rlen, crc = args
+    if _crc(payload) != crc:
+        raise vivisect.InvalidWorkspace(filename, 'compressed chunk crc mismatch')
+
+    codec = codecs_by_id.get(cid)
+    if codec == None:
+        raise vivisect.InvalidWorkspace(filename, 'unknown (or unavailable) compression codec: %d' % cid)
+
+    raw = codec[2](payload)
+    if len(raw) != rlen:
+        raise vivisect.InvalidWorkspace(filename, 'compressed chunk length mismatch')
+
+    if kind == CHUNK_MAPBYTES:
+        return kind, raw
+    if kind != CHUNK_EVENTS:
+        raise vivisect.InvalidWorkspace(filename, 'unknown compressed chunk kind: %d' % kind)
+    return kind, pickle.loads(raw)
+
+def _joinMapBytes(filename, chunks):
+    '''
+    Yield the lists of events from an iterator of (kind, data) chunks,
+    putting the map bytes chunks back into their ADDMMAP events.
+    '''
+    chunks = iter(chunks)
+    for kind, events in chunks:
+        if kind != CHUNK_EVENTS:
+            raise vivisect.InvalidWorkspace(filename, 'unexpected memory map bytes chunk')
+
+        for i, (event, einfo) in enumerate(events):
+            if event != VWE_ADDMMAP or not isinstance(einfo[3], MapBytes):
+                continue
+
+            parts = []
+            left = einfo[3].size
+            while left > 0:
+                kind, bytez = next(chunks, (None, None))
+                if kind != CHUNK_MAPBYTES or len(bytez) > left:
+                    raise vivisect.InvalidWorkspace(filename, 'missing memory map bytes chunk')
+                parts.append(bytez)
+                left -= len(bytez)
+
+            events[i] = (event, einfo[:3] + (''.join(parts),))
+
+        yield events
+
+def getWorkerCount(workers=0):
+    '''
+    Return the number of worker threads to use (0 means one per cpu).
+    '''
+    if workers > 0:
+        return workers
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def _imapWindow(func, items, workers):
+    '''
+    Like pool.imap(func, items) but with at most a few items in flight
+    (so we never read/build the whole file in memory).
+    '''
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    pool = multiprocessing.pool.ThreadPool(workers)
+    try:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+
+    finally:
+        pool.terminate()
+
+def _iterSaveChunks(events):
+    '''
+    Split the events into (kind, data) chunks (each ADDMMAP event in its
+    own chunk, followed by the map bytes chunks of a big map).
+    '''
+    chunk = []
+    for evt in events:
+        if evt[0] == VWE_ADDMMAP:
+            if chunk:
+                yield CHUNK_EVENTS, chunk
+                chunk = []
+
+            va, perms, fname, mbytes = evt[1]
+            if isinstance(mbytes, viv_blobs.BlobRef) or len(mbytes) <= map_chunk_size:
+                yield CHUNK_EVENTS, [evt]
+                continue
+
+            yield CHUNK_EVENTS, [(VWE_ADDMMAP, (va, perms, fname, MapBytes(len(mbytes))))]
+            for off in xrange(0, len(mbytes), map_chunk_size):
+                yield CHUNK_MAPBYTES, str(mbytes[off:off + map_chunk_size])
+            continue
+
+        chunk.append(evt)
+        if len(chunk) >= events_per_chunk:
+            yield CHUNK_EVENTS, chunk
+            chunk = []
+
+    if chunk:
+        yield CHUNK_EVENTS, chunk
+
+def _writeChunks(f, events, codec, level, workers):
+    if codec not in codecs:
+        raise Exception('Unknown (or unavailable) compression codec: %s' % codec)
+
+    level = _clampLevel(codec, level)
+    args = ( (codec, level, kind, data) for kind, data in _iterSaveChunks(events) )
+    for bytez in _imapWindow(_packChunk, args, getWorkerCount(workers)):
+        f.write(bytez)
+
+def _readChunkHeader(f, filename):
+    hdr = f.read(chunk_hdr_size)
+    if not hdr:
+        return None
+    if len(hdr) < chunk_hdr_size:
+        raise vivisect.InvalidWorkspace(filename, 'truncated compressed chunk')
+    return struct.unpack(chunk_fmt, hdr)
+
+def _openFile(filename):
+    f = file(filename, 'rb')
+    if f.read(len(vivsig_compressed)) != vivsig_compressed:
+        f.close()
+        raise vivisect.InvalidWorkspace(filename, 'not a compressedfile workspace')
+    return f
+
+def iterChunkIndex(filename):
+    '''
+    Yield a ChunkInfo (offset, codec, kind, clen, rlen, count, first)
+    for each chunk in the file by reading only the chunk headers.  first
+    is the index of the chunk's first event in the workspace event list
+    (map bytes chunks have no events).
+
+    Example:
+        for info in iterChunkIndex('foo.viv'):
+            if info.first + info.count > 1000:
+                events = readChunk('foo.viv', info)
+                break
+    '''
+    f = _openFile(filename)
+    try:
+        first = 0
+        while True:
+            offset = f.tell()
+            hdr = _readChunkHeader(f, filename)
+            if hdr == None:
+                return
+
+            cid, kind, clen, rlen, count, crc = hdr
+            yield ChunkInfo(offset, codecs_by_id.get(cid, (cid,))[0], kind, clen, rlen, count, first)
+            first += count
+            f.seek(clen, 1)
+
+    finally:
+        f.close()
+
+def readChunk(filename, info):
+    '''
+    Return the list of events in the (events) chunk described by the
+    given ChunkInfo (from iterChunkIndex()).  The bytes of a big memory
+    map are read from the map bytes chunks which follow it.
+    '''
+    payloads = _iterPayloads(filename, offset=info.offset)
+    try:
+        chunks = ( _unpackChunk(args) for args in payloads )
+        return next(_joinMapBytes(filename, chunks))
+    finally:
+        payloads.close()
+
+def _iterPayloads(filename, offset=None):
+    f = _openFile(filename)
+    try:
+        if offset != None:
+            f.seek(offset)
+
+        while True:
+            hdr = _readChunkHeader(f, filename)
+            if hdr == None:
+                return
+
+            cid, kind, clen, rlen, count, crc = hdr
+            payload = f.read(clen)
+            if len(payload) < clen:
+                raise vivisect.InvalidWorkspace(filename, 'truncated compressed chunk')
+            yield filename, cid, kind, payload, rlen, crc
+
+    finally:
+        f.close()
+
+def vivEventChunksFromFile(filename, workers=0):
+    '''
+    Yield the lists of events from the file (decompressing ahead with
+    the given number of worker threads).
+    '''
+    chunks = _imapWindow(_unpackChunk, _iterPayloads(filename), getWorkerCount(workers))
+    for events in _joinMapBytes(filename, chunks):
+        yield events
+
+def vivEventsFromFile(filename, workers=0):
+    events = []
+    for chunk in vivEventChunksFromFile(filename, workers=workers):
+        events.extend(chunk)
+    return events
+
+def vivEventsToFile(filename, events, codec='zlib', level=6, workers=0):
+    with file(filename, 'wb') as f:
+        f.write(vivsig_compressed)
+        _writeChunks(f, events, codec, level, workers)
+
+def vivEventsAppendFile(filename, events, codec='zlib', level=6, workers=0):
+    with file(filename, 'ab') as f:
+        _writeChunks(f, events, codec, level, workers)
+
+def _getOptions(vw):
+    cfg = vw.config.viv
+    return {
+        'codec': cfg.CompressCodec,
+        'level': cfg.CompressLevel,
+        'workers': cfg.CompressWorkers,
+    }
+
+def saveWorkspaceChanges(vw, filename):
+    elist = vw.exportWorkspaceChanges()
+    if len(elist):
+        elist = viv_blobs.exportEvents(viv_blobs.getWorkspaceStore(vw), elist)
+        vivEventsAppendFile(filename, elist, **_getOptions(vw))
+
+def saveWorkspace(vw, filename, events=None):
+    if events == None:
+        events = vw.exportWorkspace()
+    events = viv_blobs.exportEvents(viv_blobs.getWorkspaceStore(vw), events)
+    vivEventsToFile(filename, events, **_getOptions(vw))
+
+def loadWorkspace(vw, filename, progress=None):
+    chunks = vivEventChunksFromFile(filename, workers=vw.config.viv.CompressWorkers)
+    chunks = viv_blobs.importChunks(viv_blobs.getWorkspaceStore(vw), chunks)
+    vw.importWorkspaceChunks(chunks, progress=progress)
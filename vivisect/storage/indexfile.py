@@ -0,0 +1,517 @@
+'''
+An indexed, memory mappable workspace storage module.
+
+Rather than one giant pickled event list, the workspace events are split
+into sections of fixed size records (memory maps, locations, xrefs, names,
+functions and meta) with sorted index sections for lookups by address.
+Python objects (names, location info, function meta, ...) are pickled one
+at a time into a shared blob section so they may be loaded individually.
+
+Loading replays the events in their original order (each record carries
+its event sequence number), but IndexedWorkspaceFile may also be used to
+query a (large) saved workspace through mmap without replaying anything:
+
+    ifile = IndexedWorkspaceFile('foo.viv')
+    print ifile.getName(0x41414141)
+    print ifile.getXrefsTo(0x41414141)
+
+NOTE: the indexes only help IndexedWorkspaceFile queries, and only as of
+      the last full save:
+      * loadWorkspace() still replays every event (so loading is no
+        faster than basicfile).
+      * Changes saved with saveWorkspaceChanges() are appended to the
+        file as pickled event lists (exactly like basicfile).  They are
+        replayed by load, but they are not indexed, so the
+        IndexedWorkspaceFile queries don't reflect them until the next
+        full save.
+
+Use it with: vivbin -s indexfile ...
+'''
+import mmap
+import array
+import bisect
+import itertools
+import struct
+import cPickle as pickle
+
+import envi
+import vivisect
+import vivisect.storage as viv_storage
+
+from vivisect.const import *
+
+vivsig_index = 'VIVIDX\x00\x00'
+index_version = 1
+
+hdr_fmt = '<8sIIQ'          # sig, version, section count, journal offset
+sect_fmt = '<8sQQQ'         # name, offset, size, record count
+
+# Record formats (all records start with the event sequence number)
+loc_fmt = '<QQIIBQI'        # seq, va, size, ltype, live, objoff, objlen (linfo)
+xref_fmt = '<QQQIQB'        # seq, fromva, tova, rtype, rflags, live
+name_fmt = '<QQQI'          # seq, va, objoff, objlen (name)
+func_fmt = '<QQBQI'         # seq, va, live, objoff, objlen (meta)
+mmap_fmt = '<QQIQQQI'       # seq, va, perms, dataoff, datasize, objoff, objlen (fname)
+obj_fmt = '<QQI'            # seq, objoff, objlen ((name,value) or (event,einfo))
+
+# Locations/xrefs which exist in the workspace without an event of their
+# own (relocations make some) get records with this seq for the lookup
+# indexes.  They are not replayed.
+derived_seq = 0xffffffffffffffff
+
+# The exclusive upper bound of each (unsigned) record field type
+field_limits = { 'B': 1 << 8, 'I': 1 << 32, 'Q': 1 << 64 }
+
+sect_names = ('mmaps', 'locs', 'xrefs', 'names', 'funcs', 'meta', 'events',
+              'locidx', 'xrfidx', 'xrtidx', 'namidx', 'fncidx', 'blob')
+
+class _Table:
+    '''
+    A section of fixed size records read directly out of the mmap.
+    '''
+    def __init__(self, mm, fmt, offset, count):
+        self.mm = mm
+        self.fmt = fmt
+        self.rsize = struct.calcsize(fmt)
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        return struct.unpack_from(self.fmt, self.mm, self.offset + (idx * self.rsize))
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self[i]
+
+class _Index:
+    '''
+    A sorted list of record indexes into a _Table (sorted by the
+    given record field).
+    '''
+    def __init__(self, mm, offset, count, table, field):
+        self.mm = mm
+        self.offset = offset
+        self.count = count
+        self.table = table
+        self.field = field
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        # bisect wants the sort key...
+        return self.getRecord(idx)[self.field]
+
+    def getRecord(self, idx):
+        ridx = struct.unpack_from('<I', self.mm, self.offset + (idx * 4))[0]
+        return self.table[ridx]
+
+    def iterRecords(self, key):
+        idx = bisect.bisect_left(self, key)
+        while idx < self.count:
+            rec = self.getRecord(idx)
+            if rec[self.field] != key:
+                break
+            yield rec
+            idx += 1
+
+class IndexedWorkspaceFile:
+    '''
+    Read access to an indexfile workspace through mmap.  Nothing is
+    loaded until it is asked for.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = file(filename, 'rb')
+        self.mm = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+        sig, version, nsect, self.journal = struct.unpack_from(hdr_fmt, self.mm, 0)
+        if sig != vivsig_index:
+            raise vivisect.InvalidWorkspace(filename, 'not an indexfile workspace')
+        if version != index_version:
+            raise vivisect.InvalidWorkspace(filename, 'unknown indexfile version: %d' % version)
+
+        self.sects = {}
+        off = struct.calcsize(hdr_fmt)
+        ssize = struct.calcsize(sect_fmt)
+        for i in xrange(nsect):
+            name, soff, size, count = struct.unpack_from(sect_fmt, self.mm, off + (i * ssize))
+            self.sects[name.rstrip('\x00')] = (soff, size, count)
+
+        self.blob = self.sects['blob'][0]
+
+        self.mmaps = self._table('mmaps', mmap_fmt)
+        self.locs = self._table('locs', loc_fmt)
+        self.xrefs = self._table('xrefs', xref_fmt)
+        self.names = self._table('names', name_fmt)
+        self.funcs = self._table('funcs', func_fmt)
+        self.meta = self._table('meta', obj_fmt)
+        self.events = self._table('events', obj_fmt)
+
+        self.locidx = self._index('locidx', self.locs, 1)
+        self.xrfidx = self._index('xrfidx', self.xrefs, 1)
+        self.xrtidx = self._index('xrtidx', self.xrefs, 2)
+        self.namidx = self._index('namidx', self.names, 1)
+        self.fncidx = self._index('fncidx', self.funcs, 1)
+
+        self._metadict = None
+
+    def _table(self, name, fmt):
+        soff, size, count = self.sects[name]
+        return _Table(self.mm, fmt, soff, count)
+
+    def _index(self, name, table, field):
+        soff, size, count = self.sects[name]
+        return _Index(self.mm, soff, count, table, field)
+
+    def _loadObj(self, objoff, objlen):
+        if not objlen:
+            return None
+        off = self.blob + objoff
+        return pickle.loads(self.mm[off:off+objlen])
+
+    def close(self):
+        self.mm.close()
+        self.fd.close()
+
+    def getMeta(self, name, default=None):
+        if self._metadict is None:
+            self._metadict = dict([ self._loadObj(objoff, objlen) for seq, objoff, objlen in self.meta ])
+        return self._metadict.get(name, default)
+
+    def getMemoryMaps(self):
+        '''
+        Return a list of (va, size, perms, fname) tuples.
+        '''
+        ret = []
+        for seq, va, perms, dataoff, datasize, objoff, objlen in self.mmaps:
+            ret.append((va, datasize, perms, self._loadObj(objoff, objlen)))
+        return ret
+
+    def readMemory(self, va, size):
+        for seq, mva, perms, dataoff, datasize, objoff, objlen in self.mmaps:
+            if va >= mva and va + size <= mva + datasize:
+                off = self.blob + dataoff + (va - mva)
+                return self.mm[off:off+size]
+        raise envi.SegmentationViolation(va)
+
+    def _mkloc(self, rec):
+        seq, va, size, ltype, live, objoff, objlen = rec
+        return (va, size, ltype, self._loadObj(objoff, objlen))
+
+    def getLocation(self, va):
+        '''
+        Return the location tuple which contains va (or None).
+        '''
+        idx = bisect.bisect_right(self.locidx, va) - 1
+        if idx < 0:
+            return None
+        rec = self.locidx.getRecord(idx)
+        if va >= rec[1] + rec[2]:
+            return None
+        return self._mkloc(rec)
+
+    def iterLocations(self):
+        '''
+        Yield location tuples in address order.
+        '''
+        for i in xrange(len(self.locidx)):
+            yield self._mkloc(self.locidx.getRecord(i))
+
+    def getXrefsFrom(self, va):
+        return [ (fromva, tova, rtype, rflags) for seq, fromva, tova, rtype, rflags, live in self.xrfidx.iterRecords(va) ]
+
+    def getXrefsTo(self, va):
+        return [ (fromva, tova, rtype, rflags) for seq, fromva, tova, rtype, rflags, live in self.xrtidx.iterRecords(va) ]
+
+    def getName(self, va):
+        name = None
+        # names are sorted by (va, seq) so the last one wins
+        for seq, nva, objoff, objlen in self.namidx.iterRecords(va):
+            name = self._loadObj(objoff, objlen)
+        return name
+
+    def getNames(self):
+        '''
+        Return a list of (va, name) tuples in address order.
+        '''
+        ret = {}
+        for i in xrange(len(self.namidx)):
+            seq, va, objoff, objlen = self.namidx.getRecord(i)
+            ret[va] = self._loadObj(objoff, objlen)
+        return [ (va, name) for (va, name) in sorted(ret.items()) if name != None ]
+
+    def getFunctions(self):
+        return [ self.fncidx[i] for i in xrange(len(self.fncidx)) ]
+
+    def getFunctionMeta(self, fva):
+        for seq, va, live, objoff, objlen in self.fncidx.iterRecords(fva):
+            return self._loadObj(objoff, objlen)
+        return None
+
+    def _iterTable(self, table, mkevent):
+        for rec in table:
+            if rec[0] == derived_seq:
+                break
+            yield rec[0], mkevent(rec)
+
+    def iterEvents(self):
+        '''
+        Yield (event, einfo) tuples in their original order.
+        '''
+        ld = self._loadObj
+        blob = self.blob
+        mm = self.mm
+        gens = [
+            self._iterTable(self.mmaps, lambda r: (VWE_ADDMMAP, (r[1], r[2], ld(r[5], r[6]), mm[blob+r[3]:blob+r[3]+r[4]]))),
+            self._iterTable(self.locs, lambda r: (VWE_ADDLOCATION, self._mkloc(r))),
+            self._iterTable(self.xrefs, lambda r: (VWE_ADDXREF, r[1:5])),
+            self._iterTable(self.names, lambda r: (VWE_SETNAME, (r[1], ld(r[2], r[3])))),
+            self._iterTable(self.funcs, lambda r: (VWE_ADDFUNCTION, (r[1], ld(r[3], r[4])))),
+            self._iterTable(self.meta, lambda r: (VWE_SETMETA, ld(r[1], r[2]))),
+            self._iterTable(self.events, lambda r: ld(r[1], r[2])),
+        ]
+
+        # every table is in sequence order, so merge them back together
+        cur = []
+        for gen in gens:
+            for seq, evt in gen:
+                cur.append([seq, evt, gen])
+                break
+
+        while cur:
+            low = min(cur)
+            yield low[1]
+            for seq, evt in low[2]:
+                low[0] = seq
+                low[1] = evt
+                break
+            else:
+                cur.remove(low)
+
+    def iterJournal(self):
+        '''
+        Yield the (event, einfo) tuples appended by saveWorkspaceChanges.
+        '''
+        fd = file(self.filename, 'rb')
+        fd.seek(self.journal)
+        try:
+            while True:
+                try:
+                    events = pickle.load(fd)
+                except EOFError, e:
+                    break
+                except pickle.UnpicklingError, e:
+                    raise vivisect.InvalidWorkspace(self.filename, 'invalid workspace journal')
+                for evt in events:
+                    yield evt
+        finally:
+            fd.close()
+
+def _pack(fmt, recs):
+    return ''.join([ struct.pack(fmt, *rec) for rec in recs ])
+
+def _checkRecord(fmt, rec):
+    '''
+    Raise ValueError unless each value in rec is an integer which fits
+    its field of the record format (rec may leave off trailing fields).
+    '''
+    for code, val in zip(fmt[1:], rec):
+        if not isinstance(val, (int, long)) or not 0 <= val < field_limits[code]:
+            raise ValueError('%r does not fit a %s record field' % (val, code))
+
+def vivEventsToFile(filename, events, vw=None):
+    '''
+    Write the given events to an indexfile.  If the workspace is given,
+    it is used to flag which location/xref/function records are still
+    "live" (for the lookup indexes).
+    '''
+    locs = []
+    xrefs = []
+    names = []
+    funcs = []
+    mmaps = []
+    meta = []
+    other = []
+
+    f = file(filename, 'wb')
+
+    hsize = struct.calcsize(hdr_fmt) + (len(sect_names) * struct.calcsize(sect_fmt))
+    f.write('\x00' * hsize)
+
+    # The blob goes first so everybody else knows their offsets
+    blobstart = f.tell()
+    bloboff = [ 0 ]
+
+    def addobj(obj):
+        if obj is None:
+            return 0, 0
+        b = pickle.dumps(obj, protocol=2)
+        off = bloboff[0]
+        f.write(b)
+        bloboff[0] += len(b)
+        return off, len(b)
+
+    livelocs = set()
+    livexrefs = set()
+    livefuncs = {}
+
+    for seq, (event, einfo) in enumerate(events):
+        try:
+            if event == VWE_ADDMMAP:
+                va, perms, fname, mbytes = einfo
+                _checkRecord(mmap_fmt, (seq, va, perms, 0, len(mbytes)))
+                dataoff = bloboff[0]
+                f.write(mbytes)
+                bloboff[0] += len(mbytes)
+                mmaps.append((seq, va, perms, dataoff, len(mbytes)) + addobj(fname))
+                continue
+
+            if event == VWE_ADDLOCATION:
+                lva, lsize, ltype, linfo = einfo
+                live = 1
+                if vw is not None:
+                    live = int(vw.getLocation(lva) == einfo)
+                rec = (seq, lva, lsize, ltype, live)
+                _checkRecord(loc_fmt, rec)
+                locs.append(rec + addobj(linfo))
+                if live:
+                    livelocs.add(tuple(einfo))
+                continue
+
+            if event == VWE_ADDXREF:
+                xref = tuple(einfo)
+                live = int(xref not in livexrefs and (vw is None or vw.isXref(xref)))
+                rec = (seq,) + xref + (live,)
+                _checkRecord(xref_fmt, rec)
+                if live:
+                    livexrefs.add(xref)
+                xrefs.append(rec)
+                continue
+
+            if event == VWE_SETNAME:
+                va, name = einfo
+                _checkRecord(name_fmt, (seq, va))
+                names.append((seq, va) + addobj(name))
+                continue
+
+            if event == VWE_ADDFUNCTION:
+                va, fmeta = einfo
+                _checkRecord(func_fmt, (seq, va))
+                # only the last definition of a function is live
+                live = int(vw is None or vw.isFunction(va))
+                if live:
+                    prev = livefuncs.get(va)
+                    if prev is not None:
+                        funcs[prev] = funcs[prev][:2] + (0,) + funcs[prev][3:]
+                    livefuncs[va] = len(funcs)
+                funcs.append((seq, va, live) + addobj(fmeta))
+                continue
+
+            if event == VWE_SETMETA:
+                meta.append((seq,) + addobj(tuple(einfo)))
+                continue
+
+        except (TypeError, ValueError), e:
+            # anything which doesn't fit the tables goes in with the rest
+            pass
+
+        other.append((seq,) + addobj((event, einfo)))
+
+    # Live records which never made it into the tables (the ones which
+    # don't fit are left to the replayed events)
+    if vw is not None:
+        for loc in vw.getLocations():
+            loc = tuple(loc)
+            if loc not in livelocs and vw.getLocation(loc[L_VA]) == loc:
+                rec = (derived_seq, loc[L_VA], loc[L_SIZE], loc[L_LTYPE], 1)
+                try:
+                    _checkRecord(loc_fmt, rec)
+                except (TypeError, ValueError), e:
+                    continue
+                locs.append(rec + addobj(loc[L_TINFO]))
+
+        for xref in vw.getXrefs():
+            xref = tuple(xref)
+            if xref not in livexrefs:
+                rec = (derived_seq,) + xref + (1,)
+                try:
+                    _checkRecord(xref_fmt, rec)
+                except (TypeError, ValueError), e:
+                    continue
+                xrefs.append(rec)
+
+    blobsize = bloboff[0]
+
+    sects = [
+        ('blob', blobstart, blobsize, 0),
+    ]
+
+    def addsect(name, data, count):
+        sects.append((name, f.tell(), len(data), count))
+        f.write(data)
+
+    addsect('mmaps', _pack(mmap_fmt, mmaps), len(mmaps))
+    addsect('locs', _pack(loc_fmt, locs), len(locs))
+    addsect('xrefs', _pack(xref_fmt, xrefs), len(xrefs))
+    addsect('names', _pack(name_fmt, names), len(names))
+    addsect('funcs', _pack(func_fmt, funcs), len(funcs))
+    addsect('meta', _pack(obj_fmt, meta), len(meta))
+    addsect('events', _pack(obj_fmt, other), len(other))
+
+    liveloc = [ i for i in xrange(len(locs)) if locs[i][4] ]
+    livexr = [ i for i in xrange(len(xrefs)) if xrefs[i][5] ]
+    livefn = [ i for i in xrange(len(funcs)) if funcs[i][2] ]
+
+    def idxsect(name, idxs, key):
+        idxs = sorted(idxs, key=key)
+        addsect(name, array.array('I', idxs).tostring(), len(idxs))
+
+    idxsect('locidx', liveloc, lambda i: locs[i][1])
+    idxsect('xrfidx', livexr, lambda i: xrefs[i][1])
+    idxsect('xrtidx', livexr, lambda i: xrefs[i][2])
+    idxsect('namidx', xrange(len(names)), lambda i: names[i][:2][::-1])
+    idxsect('fncidx', livefn, lambda i: funcs[i][1])
+
+    journal = f.tell()
+
+    f.seek(0)
+    f.write(struct.pack(hdr_fmt, vivsig_index, index_version, len(sects), journal))
+    for name, soff, size, count in sects:
+        f.write(struct.pack(sect_fmt, name, soff, size, count))
+    f.close()
+
+def vivEventsFromFile(filename):
+    ifile = IndexedWorkspaceFile(filename)
+    try:
+        events = list(ifile.iterEvents())
+        events.extend(ifile.iterJournal())
+    finally:
+        ifile.close()
+    return events
+
+def vivEventsAppendFile(filename, events):
+    f = file(filename, 'ab')
+    pickle.dump(events, f, protocol=2)
+    f.close()
+
+def saveWorkspaceChanges(vw, filename):
+    elist = vw.exportWorkspaceChanges()
+    if len(elist):
+        vivEventsAppendFile(filename, elist)
+
+def saveWorkspace(vw, filename, events=None):
+    if events == None:
+        events = vw.exportWorkspace()
+    vivEventsToFile(filename, events, vw=vw)
+
+def loadWorkspace(vw, filename, progress=None):
+    ifile = IndexedWorkspaceFile(filename)
+    try:
+        events = itertools.chain(ifile.iterEvents(), ifile.iterJournal())
+        vw.importWorkspaceChunks(viv_storage.iterEventChunks(events), progress=progress)
+    finally:
+        ifile.close()
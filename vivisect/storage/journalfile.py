@@ -0,0 +1,233 @@
+'''
+A crash safe, journaled workspace storage module.
+
+The file is a sequence of length prefixed, CRC checked records:
+
+    <rtype:u8> <length:u32> <crc32:u32> <payload>
+
+Event records hold a pickled list of events.  Every save ends with a
+(fixed size) checkpoint record and only events which are followed by a
+checkpoint are ever loaded.  If the process dies mid-write, the torn tail
+(anything after the last good checkpoint) is truncated away on the next
+load/save rather than making the whole workspace unreadable.
+
+Full saves write a new file beside the old one and rename it into place.
+Incremental saves are appended (and fsync'd) so they may be done often.
+Once the journal holds more events than the base image, the next
+incremental save rewrites the file as a new base image.
+
+Use it with: vivbin -s journalfile ...
+'''
+import os
+import zlib
+import struct
+import logging
+import cPickle as pickle
+
+import vivisect
+import vivisect.storage as viv_storage
+import vivisect.storage.blobstore as viv_blobs
+
+logger = logging.getLogger(__name__)
+
+vivsig_journal = 'VIVJRNL\x00'
+
+rec_fmt = '<BII'            # record type, payload length, payload crc32
+rec_size = struct.calcsize(rec_fmt)
+
+REC_EVENTS = 1
+REC_CHECKPOINT = 2
+
+ckpt_fmt = '<QQ'            # total events, events since the base image
+ckpt_size = rec_size + struct.calcsize(ckpt_fmt)
+
+def _crc(payload):
+    return zlib.crc32(payload) & 0xffffffff
+
+def _writeRecord(f, rtype, payload):
+    f.write(struct.pack(rec_fmt, rtype, len(payload), _crc(payload)))
+    f.write(payload)
+
+def _writeEvents(f, events):
+    for i in xrange(0, len(events), viv_storage.chunk_size):
+        _writeRecord(f, REC_EVENTS, pickle.dumps(events[i:i+viv_storage.chunk_size], protocol=2))
+
+def _writeCheckpoint(f, total, journal):
+    _writeRecord(f, REC_CHECKPOINT, struct.pack(ckpt_fmt, total, journal))
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+def _iterRecords(f):
+    '''
+    Yield (offset, rtype, payload) for each intact record from the
+    current file position (stopping at the first torn/corrupt one).
+    '''
+    while True:
+        off = f.tell()
+        hdr = f.read(rec_size)
+        if len(hdr) < rec_size:
+            return
+
+        rtype, length, crc = struct.unpack(rec_fmt, hdr)
+        if rtype not in (REC_EVENTS, REC_CHECKPOINT):
+            return
+
+        payload = f.read(length)
+        if len(payload) < length or _crc(payload) != crc:
+            return
+
+        yield off, rtype, payload
+
+def _readCheckpoint(f):
+    '''
+    Return (end offset, total, journal) for the last good checkpoint
+    in the file by scanning (and CRC checking) every record.
+    '''
+    f.seek(0)
+    if f.read(len(vivsig_journal)) != vivsig_journal:
+        raise vivisect.InvalidWorkspace(f.name, 'not a journalfile workspace')
+
+    ckpt = None
+    for off, rtype, payload in _iterRecords(f):
+        if rtype == REC_CHECKPOINT:
+            total, journal = struct.unpack(ckpt_fmt, payload)
+            ckpt = (f.tell(), total, journal)
+
+    if ckpt == None:
+        raise vivisect.InvalidWorkspace(f.name, 'no valid checkpoint in journalfile')
+    return ckpt
+
+def _lastCheckpoint(f):
+    '''
+    Return (end offset, total, journal) for the checkpoint at the end
+    of the file (or None if the file doesn't end in a good one).
+    '''
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    if end < len(vivsig_journal) + ckpt_size:
+        return None
+
+    f.seek(end - ckpt_size)
+    for off, rtype, payload in _iterRecords(f):
+        if rtype == REC_CHECKPOINT and f.tell() == end:
+            total, journal = struct.unpack(ckpt_fmt, payload)
+            return end, total, journal
+    return None
+
+def _recover(filename, verify=True, readonly=False):
+    '''
+    Return (end offset, total, journal) for the last good checkpoint and
+    truncate anything after it.  The file is only opened for writing if
+    there is a torn tail to truncate (and unless readonly is set, failing
+    to do so is an error).
+    '''
+    with file(filename, 'rb') as f:
+        ckpt = None
+        if not verify:
+            ckpt = _lastCheckpoint(f)
+        if ckpt == None:
+            ckpt = _readCheckpoint(f)
+
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+
+    end = ckpt[0]
+    if size != end:
+        logger.warning('truncating torn journal in %s (%d bytes)', filename, size - end)
+        try:
+            with file(filename, 'r+b') as f:
+                f.truncate(end)
+                _sync(f)
+        except IOError, e:
+            if not readonly:
+                raise
+            logger.warning('can not truncate %s: %s', filename, e)
+
+    return ckpt
+
+def recoverFile(filename, verify=True):
+    '''
+    Truncate anything after the last good checkpoint from the given
+    journalfile and return (total, journal) event counts.
+
+    Unless verify is set, a file which ends in a good checkpoint is
+    assumed to be intact (without checking every record).
+    '''
+    end, total, journal = _recover(filename, verify=verify)
+    return total, journal
+
+def vivEventsToFile(filename, events):
+    tmpname = filename + '.tmp'
+    with file(tmpname, 'wb') as f:
+        f.write(vivsig_journal)
+        _writeEvents(f, events)
+        _writeCheckpoint(f, len(events), 0)
+        _sync(f)
+
+    # NOTE: windows won't rename over an existing file
+    if os.name == 'nt' and os.path.exists(filename):
+        os.unlink(filename)
+    os.rename(tmpname, filename)
+
+def vivEventsAppendFile(filename, events):
+    total, journal = recoverFile(filename, verify=False)
+    with file(filename, 'ab') as f:
+        _writeEvents(f, events)
+        _writeCheckpoint(f, total + len(events), journal + len(events))
+        _sync(f)
+
+def vivEventChunksFromFile(filename):
+    '''
+    Yield the lists of events which are covered by a checkpoint (after
+    truncating any torn tail from the file if it is writable).
+    '''
+    # (a read-only file loads fine, any torn tail is just skipped)
+    end, total, journal = _recover(filename, readonly=True)
+    with file(filename, 'rb') as f:
+        f.seek(len(vivsig_journal))
+        count = 0
+        for off, rtype, payload in _iterRecords(f):
+            if off >= end:
+                break
+            if rtype == REC_EVENTS:
+                events = pickle.loads(payload)
+                count += len(events)
+                yield events
+
+        if count != total:
+            raise vivisect.InvalidWorkspace(filename, 'journalfile event count mismatch')
+
+def vivEventsFromFile(filename):
+    events = []
+    for chunk in vivEventChunksFromFile(filename):
+        events.extend(chunk)
+    return events
+
+def saveWorkspaceChanges(vw, filename):
+    elist = vw.exportWorkspaceChanges()
+    if not len(elist):
+        return
+
+    if not os.path.exists(filename):
+        return saveWorkspace(vw, filename)
+
+    total, journal = recoverFile(filename, verify=False)
+    # Once the journal outgrows the base image, start a new one
+    if journal + len(elist) > total - journal:
+        return saveWorkspace(vw, filename)
+
+    elist = list(viv_blobs.exportEvents(viv_blobs.getWorkspaceStore(vw), elist))
+    vivEventsAppendFile(filename, elist)
+
+def saveWorkspace(vw, filename, events=None):
+    if events == None:
+        events = vw.exportWorkspace()
+    events = list(viv_blobs.exportEvents(viv_blobs.getWorkspaceStore(vw), events))
+    vivEventsToFile(filename, events)
+
+def loadWorkspace(vw, filename, progress=None):
+    chunks = vivEventChunksFromFile(filename)
+    chunks = viv_blobs.importChunks(viv_blobs.getWorkspaceStore(vw), chunks)
+    vw.importWorkspaceChunks(chunks, progress=progress)
@@ -0,0 +1,807 @@
+'''
+An SQLite backed workspace storage module.
+
+Besides the event list, the file holds indexed tables of the workspace
+locations, xrefs, functions, code blocks, names, va sets and comments.
+Loading the file with loadWorkspace() replays the events like any other
+storage module, but openWorkspace() returns a read-only SqliteWorkspace
+which only replays the (small) events which describe the memory maps,
+files, relocations and meta data.  Its location/xref/function/name/va set
+accessors query the tables instead, faulting records in as they are used,
+so batch jobs which only look at a few functions only read the rows they
+need.  Any number of readers (threads or processes) may share one file.
+
+Incremental saves append the new events and update the tables in one
+transaction, so readers never see a half saved workspace.
+
+Use it with: vivbin -s sqlitefile ...
+'''
+import os
+import bisect
+import sqlite3
+import threading
+import cPickle as pickle
+
+import vivisect
+import vivisect.storage as viv_storage
+import vivisect.storage.blobstore as viv_blobs
+
+from vivisect.const import *
+
+# SQLite files begin with 'SQLite format 3\x00', ours also set the
+# application_id (at offset 68 of the header) to 'VIV\x00'
+vivsig_sqlite = 'SQLite format 3\x00'
+viv_application_id = 0x56495600
+
+# sqlite integers are signed 64 bits, so vas are stored offset by 2**63
+# (which keeps them in order for range queries)
+va_bias = 0x8000000000000000
+
+schema = (
+    'CREATE TABLE events (seq INTEGER PRIMARY KEY, event INTEGER, einfo BLOB)',
+    'CREATE INDEX events_event ON events (event)',
+
+    # every location (loclist) and the ranges of the location map
+    'CREATE TABLE locations (va INTEGER, size INTEGER, ltype INTEGER, tinfo BLOB)',
+    'CREATE INDEX locations_va ON locations (va)',
+    'CREATE INDEX locations_ltype ON locations (ltype)',
+    'CREATE TABLE locspans (start INTEGER PRIMARY KEY, end INTEGER, va INTEGER, size INTEGER, ltype INTEGER, tinfo BLOB)',
+
+    'CREATE TABLE xrefs (fromva INTEGER, tova INTEGER, rtype INTEGER, rflags INTEGER)',
+    'CREATE UNIQUE INDEX xrefs_from ON xrefs (fromva, tova, rtype, rflags)',
+    'CREATE INDEX xrefs_to ON xrefs (tova)',
+    'CREATE INDEX xrefs_rtype ON xrefs (rtype)',
+
+    'CREATE TABLE names (va INTEGER PRIMARY KEY, name BLOB, nkey BLOB)',
+    'CREATE INDEX names_nkey ON names (nkey)',
+
+    'CREATE TABLE functions (va INTEGER PRIMARY KEY, meta BLOB)',
+
+    # every code block and the ranges of the block map
+    'CREATE TABLE codeblocks (va INTEGER, size INTEGER, funcva INTEGER)',
+    'CREATE INDEX codeblocks_va ON codeblocks (va)',
+    'CREATE INDEX codeblocks_funcva ON codeblocks (funcva)',
+    'CREATE TABLE blockspans (start INTEGER PRIMARY KEY, end INTEGER, va INTEGER, size INTEGER, funcva INTEGER)',
+
+    'CREATE TABLE vasets (name BLOB PRIMARY KEY, vname BLOB, defs BLOB)',
+    'CREATE TABLE vasetrows (name BLOB, rkey BLOB, row BLOB, PRIMARY KEY (name, rkey))',
+
+    'CREATE TABLE comments (va INTEGER PRIMARY KEY, comment BLOB)',
+)
+
+# Events whose state lives in the tables (which openWorkspace() skips)
+table_events = (
+    VWE_ADDLOCATION, VWE_DELLOCATION,
+    VWE_ADDXREF, VWE_DELXREF,
+    VWE_SETNAME,
+    VWE_ADDFUNCTION, VWE_DELFUNCTION, VWE_SETFUNCMETA,
+    VWE_ADDCODEBLOCK, VWE_DELCODEBLOCK,
+    VWE_ADDVASET, VWE_DELVASET, VWE_SETVASETROW, VWE_DELVASETROW,
+    VWE_COMMENT,
+)
+
+def _sva(va):
+    return va - va_bias
+
+def _uva(sva):
+    return sva + va_bias
+
+def _dump(obj):
+    return sqlite3.Binary(pickle.dumps(obj, protocol=2))
+
+def _load(blob):
+    return pickle.loads(str(blob))
+
+def _key(obj):
+    '''
+    Return the (pickled) lookup key for a name or va set key, with ascii
+    unicode strings folded to str so they match like they do in a dict.
+    '''
+    if isinstance(obj, unicode):
+        try:
+            obj = obj.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+    return _dump(obj)
+
+def _connect(filename):
+    db = sqlite3.connect(filename, check_same_thread=False)
+    db.text_factory = str
+    return db
+
+def _createTables(db):
+    db.execute('PRAGMA application_id = %d' % viv_application_id)
+    for sql in schema:
+        db.execute(sql)
+
+def _insertEvents(db, events, seq):
+    db.executemany('INSERT INTO events VALUES (?,?,?)',
+                   ( (seq + i, event, _dump(einfo)) for i, (event, einfo) in enumerate(events) ))
+
+def _insertLocation(db, loc):
+    lva, lsize, ltype, tinfo = loc
+    db.execute('INSERT INTO locations VALUES (?,?,?,?)', (_sva(lva), lsize, ltype, _dump(tinfo)))
+
+def _insertXref(db, xref):
+    fromva, tova, rtype, rflags = xref
+    db.execute('INSERT OR IGNORE INTO xrefs VALUES (?,?,?,?)', (_sva(fromva), _sva(tova), rtype, rflags))
+
+def _insertCodeBlock(db, cb):
+    va, size, funcva = cb
+    db.execute('INSERT INTO codeblocks VALUES (?,?,?)', (_sva(va), size, _sva(funcva)))
+
+def _locSpanRow(span):
+    start, end, loc = span
+    lva, lsize, ltype, tinfo = loc
+    return (_sva(start), _sva(end), _sva(lva), lsize, ltype, _dump(tinfo))
+
+def _blockSpanRow(span):
+    start, end, cb = span
+    va, size, funcva = cb
+    return (_sva(start), _sva(end), _sva(va), size, _sva(funcva))
+
+def _syncSpans(db, table, maplookup, mkrow, va, size):
+    '''
+    Replace the spans in the table which overlap [va, va+size) with those
+    currently in the workspace map.
+    '''
+    lo = va
+    hi = va + size
+
+    # widen the range to cover every (old) span which overlaps it...
+    row = db.execute('SELECT start, end FROM %s WHERE start < ? ORDER BY start DESC LIMIT 1' % table, (_sva(lo),)).fetchone()
+    if row != None and _uva(row[1]) > lo:
+        lo = _uva(row[0])
+    row = db.execute('SELECT MAX(end) FROM %s WHERE start >= ? AND start < ?' % table, (_sva(lo), _sva(hi))).fetchone()
+    if row[0] != None:
+        hi = max(hi, _uva(row[0]))
+
+    # ...and every (new) one
+    spans = maplookup.getMapRanges(lo, hi - lo)
+    if spans:
+        lo = min(lo, spans[0][0])
+        hi = max(hi, spans[-1][1])
+
+    db.execute('DELETE FROM %s WHERE start >= ? AND start < ?' % table, (_sva(lo), _sva(hi)))
+    rows = [ mkrow(span) for span in spans ]
+    if rows:
+        db.executemany('INSERT INTO %s VALUES (%s)' % (table, ','.join('?' * len(rows[0]))), rows)
+
+def _syncName(db, vw, va):
+    name = vw.name_by_va.get(va)
+    if name == None:
+        db.execute('DELETE FROM names WHERE va=?', (_sva(va),))
+        return
+    db.execute('INSERT OR REPLACE INTO names VALUES (?,?,?)', (_sva(va), _dump(name), _key(name)))
+
+def _syncFunction(db, vw, fva):
+    meta = vw.funcmeta.get(fva)
+    if meta == None:
+        db.execute('DELETE FROM functions WHERE va=?', (_sva(fva),))
+        return
+    db.execute('INSERT OR REPLACE INTO functions VALUES (?,?)', (_sva(fva), _dump(meta)))
+
+def _syncComment(db, vw, va):
+    cmnt = vw.comments.get(va)
+    if cmnt == None:
+        db.execute('DELETE FROM comments WHERE va=?', (_sva(va),))
+        return
+    db.execute('INSERT OR REPLACE INTO comments VALUES (?,?)', (_sva(va), _dump(cmnt)))
+
+def _insertVaSet(db, vw, name):
+    db.execute('INSERT OR REPLACE INTO vasets VALUES (?,?,?)', (_key(name), _dump(name), _dump(vw.vasetdefs.get(name))))
+    db.executemany('INSERT OR REPLACE INTO vasetrows VALUES (?,?,?)',
+                   [ (_key(name), _key(rkey), _dump(row)) for rkey, row in vw.vasets.get(name).items() ])
+
+def _delVaSet(db, name):
+    db.execute('DELETE FROM vasets WHERE name=?', (_key(name),))
+    db.execute('DELETE FROM vasetrows WHERE name=?', (_key(name),))
+
+def _writeTables(db, vw):
+    '''
+    Fill in the (empty) tables from the workspace state.
+    '''
+    for loc in vw.iterLocations():
+        _insertLocation(db, loc)
+    db.executemany('INSERT INTO locspans VALUES (?,?,?,?,?,?)',
+                   [ _locSpanRow(span) for span in vw.locmap.getMapRanges() ])
+
+    for xref in vw.getXrefs():
+        _insertXref(db, xref)
+
+    for va, name in vw.getNames():
+        db.execute('INSERT INTO names VALUES (?,?,?)', (_sva(va), _dump(name), _key(name)))
+
+    for fva in vw.getFunctions():
+        _syncFunction(db, vw, fva)
+
+    for cb in vw.getCodeBlocks():
+        _insertCodeBlock(db, cb)
+    db.executemany('INSERT INTO blockspans VALUES (?,?,?,?,?)',
+                   [ _blockSpanRow(span) for span in vw.blockmap.getMapRanges() ])
+
+    for name in vw.getVaSetNames():
+        _insertVaSet(db, vw, name)
+
+    for va, cmnt in vw.getComments():
+        db.execute('INSERT INTO comments VALUES (?,?)', (_sva(va), _dump(cmnt)))
+
+def _applyEvents(db, vw, events):
+    '''
+    Update the tables for the given (just saved) events.  Where the
+    handlers derive state from an event, the current workspace state
+    is copied rather than re-deriving it here.
+    '''
+    locdirty = []
+    blockdirty = []
+
+    for event, einfo in events:
+
+        if event == VWE_ADDLOCATION:
+            _insertLocation(db, einfo)
+            locdirty.append(einfo[:2])
+
+        elif event == VWE_DELLOCATION:
+            lva, lsize, ltype, tinfo = einfo
+            db.execute('DELETE FROM locations WHERE rowid = (SELECT rowid FROM locations '
+                       'WHERE va=? AND size=? AND ltype=? AND tinfo=? LIMIT 1)',
+                       (_sva(lva), lsize, ltype, _dump(tinfo)))
+            locdirty.append((lva, lsize))
+
+        elif event == VWE_ADDXREF:
+            _insertXref(db, einfo)
+
+        elif event == VWE_DELXREF:
+            fromva, tova, rtype, rflags = einfo
+            db.execute('DELETE FROM xrefs WHERE fromva=? AND tova=? AND rtype=? AND rflags=?',
+                       (_sva(fromva), _sva(tova), rtype, rflags))
+
+        elif event == VWE_SETNAME:
+            _syncName(db, vw, einfo[0])
+
+        elif event in (VWE_ADDFUNCTION, VWE_SETFUNCMETA):
+            _syncFunction(db, vw, einfo[0])
+
+        elif event == VWE_DELFUNCTION:
+            _syncFunction(db, vw, einfo)
+            for va, size in db.execute('SELECT va, size FROM codeblocks WHERE funcva=?', (_sva(einfo),)).fetchall():
+                blockdirty.append((_uva(va), size))
+            db.execute('DELETE FROM codeblocks WHERE funcva=?', (_sva(einfo),))
+
+        elif event == VWE_ADDCODEBLOCK:
+            _insertCodeBlock(db, einfo)
+            blockdirty.append(einfo[:2])
+
+        elif event == VWE_DELCODEBLOCK:
+            va, size, funcva = einfo
+            db.execute('DELETE FROM codeblocks WHERE rowid = (SELECT rowid FROM codeblocks '
+                       'WHERE va=? AND size=? AND funcva=? LIMIT 1)', (_sva(va), size, _sva(funcva)))
+            blockdirty.append((va, size))
+
+        elif event == VWE_ADDVASET:
+            _delVaSet(db, einfo[0])
+            if vw.vasets.get(einfo[0]) != None:
+                _insertVaSet(db, vw, einfo[0])
+
+        elif event == VWE_DELVASET:
+            _delVaSet(db, einfo)
+
+        elif event == VWE_SETVASETROW:
+            name, row = einfo
+            db.execute('INSERT OR REPLACE INTO vasetrows VALUES (?,?,?)', (_key(name), _key(row[0]), _dump(row)))
+
+        elif event == VWE_DELVASETROW:
+            name, va = einfo
+            db.execute('DELETE FROM vasetrows WHERE name=? AND rkey=?', (_key(name), _key(va)))
+
+        elif event == VWE_COMMENT:
+            _syncComment(db, vw, einfo[0])
+
+        elif event == VWE_ADDRELOC and len(einfo) == 4 and einfo[2] == RTYPE_BASEPTR:
+            # the handler makes a pointer location and xref
+            fname, ptroff, rtype, data = einfo
+            rva = vw.getFileMeta(fname, 'imagebase') + ptroff
+            loc = (rva, vw.psize, LOC_POINTER, None)
+            _insertLocation(db, loc)
+            locdirty.append(loc[:2])
+            for xref in vw.getXrefsFrom(rva, REF_PTR):
+                _insertXref(db, xref)
+
+    for va, size in locdirty:
+        _syncSpans(db, 'locspans', vw.locmap, _locSpanRow, va, size)
+
+    for va, size in blockdirty:
+        _syncSpans(db, 'blockspans', vw.blockmap, _blockSpanRow, va, size)
+
+def saveWorkspace(vw, filename, events=None):
+    if events == None:
+        events = vw.exportWorkspace()
+    events = viv_blobs.exportEvents(viv_blobs.getWorkspaceStore(vw), events)
+
+    tmpname = filename + '.tmp'
+    if os.path.exists(tmpname):
+        os.unlink(tmpname)
+
+    db = _connect(tmpname)
+    try:
+        with db:
+            _createTables(db)
+            _insertEvents(db, events, 0)
+            _writeTables(db, vw)
+    finally:
+        db.close()
+
+    # NOTE: windows won't rename over an existing file
+    if os.name == 'nt' and os.path.exists(filename):
+        os.unlink(filename)
+    os.rename(tmpname, filename)
+
+def saveWorkspaceChanges(vw, filename):
+    elist = vw.exportWorkspaceChanges()
+    if not len(elist):
+        return
+
+    if not os.path.exists(filename):
+        return saveWorkspace(vw, filename)
+
+    db = _connect(filename)
+    try:
+        with db:
+            seq = db.execute('SELECT MAX(seq) FROM events').fetchone()[0]
+            if seq == None:
+                seq = -1
+            _insertEvents(db, viv_blobs.exportEvents(viv_blobs.getWorkspaceStore(vw), elist), seq + 1)
+            _applyEvents(db, vw, elist)
+    finally:
+        db.close()
+
+def _iterEventRows(db, sql, size):
+    cur = db.execute(sql)
+    while True:
+        rows = cur.fetchmany(size)
+        if not rows:
+            return
+        yield [ (event, _load(einfo)) for event, einfo in rows ]
+
+def vivEventChunksFromFile(filename):
+    if not os.path.isfile(filename):
+        raise vivisect.InvalidWorkspace(filename, 'no such file')
+
+    db = _connect(filename)
+    try:
+        for events in _iterEventRows(db, 'SELECT event, einfo FROM events ORDER BY seq', viv_storage.chunk_size):
+            yield events
+    finally:
+        db.close()
+
+def vivEventsFromFile(filename):
+    events = []
+    for chunk in vivEventChunksFromFile(filename):
+        events.extend(chunk)
+    return events
+
+def vivEventsToFile(filename, events):
+    '''
+    Write a file holding just the given events (with empty tables, so
+    it may be loaded with loadWorkspace() but not openWorkspace()).
+    '''
+    if os.path.exists(filename):
+        os.unlink(filename)
+    db = _connect(filename)
+    try:
+        with db:
+            _createTables(db)
+            _insertEvents(db, events, 0)
+    finally:
+        db.close()
+
+def vivEventsAppendFile(filename, events):
+    db = _connect(filename)
+    try:
+        with db:
+            seq = db.execute('SELECT MAX(seq) FROM events').fetchone()[0]
+            if seq == None:
+                seq = -1
+            _insertEvents(db, events, seq + 1)
+    finally:
+        db.close()
+
+def loadWorkspace(vw, filename, progress=None):
+    chunks = vivEventChunksFromFile(filename)
+    chunks = viv_blobs.importChunks(viv_blobs.getWorkspaceStore(vw), chunks)
+    vw.importWorkspaceChunks(chunks, progress=progress)
+
+def openWorkspace(filename):
+    '''
+    Open the given sqlitefile workspace in read mode (see SqliteWorkspace).
+
+    Example:
+        vw = vivisect.storage.sqlitefile.openWorkspace('foo.viv')
+        for fva in vw.getFunctions():
+            print(vw.getName(fva))
+    '''
+    return SqliteWorkspace(filename)
+
+class SqliteWorkspace(vivisect.VivWorkspace):
+    '''
+    A read-only VivWorkspace whose locations, xrefs, functions, code
+    blocks, names, va sets and comments are queried from an sqlitefile
+    workspace as they are asked for (rather than replaying every event).
+
+    Function meta data and code blocks are cached per function once
+    faulted in.  The queries share one connection (under a lock) so a
+    workspace may be used from several threads.
+
+    Only the accessors are backed by the tables, so analysis and other
+    changes to the workspace are not allowed (they raise an Exception).
+    '''
+    def __init__(self, filename):
+        self._sql_readonly = False
+        vivisect.VivWorkspace.__init__(self)
+        self._sql_lock = threading.Lock()
+        self._sql_funcmeta = {}
+        self._sql_funcblocks = {}
+
+        self._sql_db = _connect(filename)
+        self._sql_db.execute('PRAGMA query_only = 1')
+
+        # replay the events which the tables don't cover
+        sql = 'SELECT event, einfo FROM events WHERE event NOT IN (%s) ORDER BY seq' % ','.join([ str(e) for e in table_events ])
+        store = viv_blobs.getWorkspaceStore(self)
+        with self._sql_lock:
+            chunks = list(_iterEventRows(self._sql_db, sql, viv_storage.chunk_size))
+        for events in chunks:
+            self.importWorkspace(list(viv_blobs.importEvents(store, events)))
+
+        self.setMeta('StorageModule', 'vivisect.storage.sqlitefile')
+        self.setMeta('StorageName', filename)
+        self._sql_readonly = True
+
+    def _fireEvent(self, event, einfo, local=False, skip=None):
+        if self._sql_readonly and not event & VTE_MASK:
+            raise Exception('SqliteWorkspace is read-only (event %d)' % event)
+        return vivisect.VivWorkspace._fireEvent(self, event, einfo, local=local, skip=skip)
+
+    def _fireEvents(self, events, local=False, skip=None):
+        if self._sql_readonly:
+            for event, einfo in events:
+                if not event & VTE_MASK:
+                    raise Exception('SqliteWorkspace is read-only (event %d)' % event)
+        return vivisect.VivWorkspace._fireEvents(self, events, local=local, skip=skip)
+
+    def saveWorkspace(self, fullsave=True):
+        raise Exception('SqliteWorkspace is read-only')
+
+    def close(self):
+        '''
+        Close the database connection.
+        '''
+        with self._sql_lock:
+            self._sql_db.close()
+
+    def _query(self, sql, args=()):
+        with self._sql_lock:
+            return self._sql_db.execute(sql, args).fetchall()
+
+    def _queryOne(self, sql, args=()):
+        with self._sql_lock:
+            return self._sql_db.execute(sql, args).fetchone()
+
+    #
+    # Locations
+    #
+
+    def _mkLoc(self, row):
+        lva, lsize, ltype, tinfo = row
+        return (_uva(lva), lsize, ltype, _load(tinfo))
+
+    def _getLocSpan(self, va, prev=False):
+        row = self._queryOne('SELECT end, va, size, ltype, tinfo FROM locspans WHERE start <= ? ORDER BY start DESC LIMIT 1', (_sva(va),))
+        if row == None:
+            return None
+        if not prev and _uva(row[0]) <= va:
+            return None
+        return self._mkLoc(row[1:])
+
+    def getLocation(self, va, range=False):
+        return self._getLocSpan(va)
+
+    def getPrevLocation(self, va, adjacent=True):
+        return self._getLocSpan(va - 1, prev=not adjacent)
+
+    def iterLocations(self, ltype=None, linfo=None):
+        if ltype == None:
+            rows = self._query('SELECT va, size, ltype, tinfo FROM locations ORDER BY rowid')
+        else:
+            rows = self._query('SELECT va, size, ltype, tinfo FROM locations WHERE ltype=? ORDER BY rowid', (ltype,))
+
+        for row in rows:
+            loc = self._mkLoc(row)
+            if linfo != None and loc[L_TINFO] != linfo:
+                continue
+            yield loc
+
+    def getLocations(self, ltype=None, linfo=None):
+        return list(self.iterLocations(ltype=ltype, linfo=linfo))
+
+    def getLocationCount(self, ltype=None):
+        if ltype == None:
+            return self._queryOne('SELECT COUNT(*) FROM locations')[0]
+        return self._queryOne('SELECT COUNT(*) FROM locations WHERE ltype=?', (ltype,))[0]
+
+    def _getLocSpans(self, va, size):
+        '''
+        Return the (start, end, loc) location map spans which overlap
+        [va, va+size) in order.
+        '''
+        rows = self._query('SELECT * FROM (SELECT * FROM locspans WHERE start < ? ORDER BY start DESC LIMIT 1) '
+                           'UNION ALL SELECT * FROM locspans WHERE start >= ? AND start < ? ORDER BY start',
+                           (_sva(va), _sva(va), _sva(va + size)))
+        spans = [ (_uva(row[0]), _uva(row[1]), self._mkLoc(row[2:])) for row in rows ]
+        if spans and spans[0][1] <= va:
+            spans.pop(0)
+        return spans
+
+    def getLocationRange(self, va, size):
+        spans = self._getLocSpans(va, size)
+        starts = [ span[0] for span in spans ]
+
+        ret = []
+        endva = va + size
+        while va < endva:
+            i = bisect.bisect_right(starts, va) - 1
+            if i >= 0 and spans[i][1] > va:
+                loc = spans[i][2]
+                ret.append(loc)
+                va += loc[L_SIZE]
+                continue
+
+            # The undefined run goes until the next location (or endva)
+            nextva = endva
+            if i + 1 < len(starts):
+                nextva = min(starts[i + 1], endva)
+            ret.append((va, nextva - va, LOC_UNDEF, None))
+            va = nextva
+
+        return ret
+
+    def iterUndefinedRanges(self, va=None, size=None):
+        if va == None:
+            ranges = [ (mva, msize) for mva, msize, mperm, mname in self.getMemoryMaps() ]
+        else:
+            ranges = [ (va, size) ]
+
+        for rva, rsize in ranges:
+            rend = rva + rsize
+            for start, end, loc in self._getLocSpans(rva, rsize):
+                if start > rva:
+                    yield rva, start - rva
+                rva = max(rva, end)
+            if rva < rend:
+                yield rva, rend - rva
+
+    def _getLocCoverage(self, va, size):
+        coverage = 0
+        for start, end, loc in self._getLocSpans(va, size):
+            coverage += min(end, va + size) - max(start, va)
+        return coverage
+
+    def getMemoryMapCoverage(self):
+        return [ (mva, msize, mperms, mname, self._getLocCoverage(mva, msize))
+                 for mva, msize, mperms, mname in self.getMemoryMaps() ]
+
+    def getLocationDistribution(self):
+        totsize = float(0)
+        for mapva, mapsize, mperm, mname in self.getMemoryMaps():
+            totsize += mapsize
+
+        counts = dict([ (ltype, (cnt, size)) for ltype, cnt, size in
+                        self._query('SELECT ltype, COUNT(*), SUM(size) FROM locations GROUP BY ltype') ])
+        loctot = 0
+        ret = {}
+        for i in xrange(LOC_MAX):
+            cnt, size = counts.get(i, (0, 0))
+            loctot += size
+
+            tname = loc_type_names.get(i, 'Unknown')
+            ret[i] = (tname, cnt, size, int((size/totsize)*100))
+
+        undeftot = totsize-loctot
+        ret[LOC_UNDEF] = ('Undefined', 0, undeftot, int((undeftot/totsize)*100))
+        return ret
+
+    def getDiscoveredInfo(self):
+        info = list(vivisect.VivWorkspace.getDiscoveredInfo(self))
+        info[4] = self._queryOne('SELECT COUNT(*) FROM functions')[0]
+        info[5] = self._queryOne('SELECT COUNT(*) FROM codeblocks')[0]
+        return tuple(info)
+
+    def getStats(self):
+        stats = vivisect.VivWorkspace.getStats(self)
+        stats['functions'] = self._queryOne('SELECT COUNT(*) FROM functions')[0]
+        return stats
+
+    #
+    # Xrefs
+    #
+
+    def _mkXrefs(self, rows):
+        return [ (_uva(fromva), _uva(tova), rtype, rflags) for fromva, tova, rtype, rflags in rows ]
+
+    def getXrefs(self, rtype=None):
+        if rtype:
+            return self._mkXrefs(self._query('SELECT * FROM xrefs WHERE rtype=? ORDER BY rowid', (rtype,)))
+        return self._mkXrefs(self._query('SELECT * FROM xrefs ORDER BY rowid'))
+
+    def getXrefCount(self, rtype=None):
+        if rtype:
+            return self._queryOne('SELECT COUNT(*) FROM xrefs WHERE rtype=?', (rtype,))[0]
+        return self._queryOne('SELECT COUNT(*) FROM xrefs')[0]
+
+    def isXref(self, xref):
+        fromva, tova, rtype, rflags = xref
+        row = self._queryOne('SELECT 1 FROM xrefs WHERE fromva=? AND tova=? AND rtype=? AND rflags=?',
+                             (_sva(fromva), _sva(tova), rtype, rflags))
+        return row != None
+
+    def getXrefsFrom(self, va, rtype=None):
+        if rtype == None:
+            rows = self._query('SELECT * FROM xrefs WHERE fromva=? ORDER BY rowid', (_sva(va),))
+        else:
+            rows = self._query('SELECT * FROM xrefs WHERE fromva=? AND rtype=? ORDER BY rowid', (_sva(va), rtype))
+        return self._mkXrefs(rows)
+
+    def getXrefsTo(self, va, rtype=None):
+        if rtype == None:
+            rows = self._query('SELECT * FROM xrefs WHERE tova=? ORDER BY rowid', (_sva(va),))
+        else:
+            rows = self._query('SELECT * FROM xrefs WHERE tova=? AND rtype=? ORDER BY rowid', (_sva(va), rtype))
+        return self._mkXrefs(rows)
+
+    #
+    # Names
+    #
+
+    def getNames(self):
+        return [ (_uva(va), _load(name)) for va, name in self._query('SELECT va, name FROM names') ]
+
+    def getNamesInRange(self, va, size):
+        rows = self._query('SELECT va, name FROM names WHERE va >= ? AND va < ? ORDER BY va',
+                           (_sva(va), _sva(va + size)))
+        return [ (_uva(nva), _load(name)) for nva, name in rows ]
+
+    def vaByName(self, name):
+        row = self._queryOne('SELECT va FROM names WHERE nkey=?', (_key(name),))
+        if row == None:
+            return None
+        return _uva(row[0])
+
+    def getName(self, va, smart=False):
+        row = self._queryOne('SELECT name FROM names WHERE va=?', (_sva(va),))
+        if row != None:
+            return _load(row[0])
+
+        if not smart:
+            return None
+
+        baseva = self.getFunction(va)
+        basename = None
+        if baseva != None:
+            basename = self.getName(baseva)
+
+        if basename == None:
+            basename = self.getFileByVa(va)
+            if basename == None:
+                return None
+
+            baseva = self.getFileMeta(basename, 'imagebase')
+
+        delta = va - baseva
+
+        pom = ('','+')[delta>=0]
+        return "%s%s%s" % (basename, pom, hex(delta))
+
+    #
+    # Functions and code blocks
+    #
+
+    def getFunctionMetaDict(self, funcva):
+        meta = self._sql_funcmeta.get(funcva)
+        if meta != None:
+            return meta
+
+        row = self._queryOne('SELECT meta FROM functions WHERE va=?', (_sva(funcva),))
+        if row == None:
+            return None
+
+        meta = _load(row[0])
+        self._sql_funcmeta[funcva] = meta
+        return meta
+
+    def getFunctionMeta(self, funcva, key, default=None):
+        m = self.getFunctionMetaDict(funcva)
+        if m == None:
+            raise vivisect.InvalidFunction(funcva)
+        return m.get(key, default)
+
+    def isFunction(self, funcva):
+        return self.getFunctionMetaDict(funcva) != None
+
+    def getFunctions(self):
+        return [ _uva(va) for va, in self._query('SELECT va FROM functions') ]
+
+    def getFunction(self, va):
+        if self.isFunction(va):
+            return va
+        cbtup = self.getCodeBlock(va)
+        if cbtup != None:
+            return cbtup[CB_FUNCVA]
+        return None
+
+    def _mkBlocks(self, rows):
+        return [ (_uva(va), size, _uva(funcva)) for va, size, funcva in rows ]
+
+    def getFunctionBlocks(self, funcva):
+        blocks = self._sql_funcblocks.get(funcva)
+        if blocks == None:
+            blocks = self._mkBlocks(self._query('SELECT * FROM codeblocks WHERE funcva=? ORDER BY rowid', (_sva(funcva),)))
+            self._sql_funcblocks[funcva] = blocks
+        return blocks
+
+    def getCodeBlock(self, va):
+        row = self._queryOne('SELECT end, va, size, funcva FROM blockspans WHERE start <= ? ORDER BY start DESC LIMIT 1', (_sva(va),))
+        if row == None or _uva(row[0]) <= va:
+            return None
+        return self._mkBlocks([row[1:]])[0]
+
+    def getCodeBlocks(self):
+        return self._mkBlocks(self._query('SELECT * FROM codeblocks ORDER BY rowid'))
+
+    #
+    # VA sets
+    #
+
+    def getVaSetNames(self):
+        return [ _load(vname) for vname, in self._query('SELECT vname FROM vasets') ]
+
+    def getVaSetDef(self, name):
+        row = self._queryOne('SELECT defs FROM vasets WHERE name=?', (_key(name),))
+        if row == None:
+            raise vivisect.InvalidVaSet(name)
+        return _load(row[0])
+
+    def getVaSet(self, name):
+        # (the va set must exist, like the base method)
+        self.getVaSetDef(name)
+        ret = {}
+        for row, in self._query('SELECT row FROM vasetrows WHERE name=?', (_key(name),)):
+            row = _load(row)
+            ret[row[0]] = row
+        return ret
+
+    def getVaSetRows(self, name):
+        return self.getVaSet(name).values()
+
+    def getVaSetRow(self, name, va):
+        row = self._queryOne('SELECT row FROM vasetrows WHERE name=? AND rkey=?', (_key(name), _key(va)))
+        if row == None:
+            return None
+        return _load(row[0])
+
+    #
+    # Comments
+    #
+
+    def getComment(self, va):
+        row = self._queryOne('SELECT comment FROM comments WHERE va=?', (_sva(va),))
+        if row == None:
+            return None
+        return _load(row[0])
+
+    def getComments(self):
+        return [ (_uva(va), _load(cmnt)) for va, cmnt in self._query('SELECT va, comment FROM comments') ]
+
+    def getCommentsInRange(self, va, size):
+        rows = self._query('SELECT va, comment FROM comments WHERE va >= ? AND va < ? ORDER BY va',
+                           (_sva(va), _sva(va + size)))
+        return [ (_uva(cva), _load(cmnt)) for cva, cmnt in rows ]
@@ -0,0 +1,795 @@
+import gc
+import os
+import mmap
+import time
+import hashlib
+import shutil
+import tempfile
+import unittest
+
+import envi.threads as e_threads
+
+import vivisect
+import vivisect.compact as viv_compact
+import vivisect.snapshot as viv_snapshot
+import vivisect.remote.server as viv_server
+import vivisect.storage as viv_storage
+import vivisect.storage.basicfile as viv_basicfile
+import vivisect.storage.blobstore as viv_blobs
+import vivisect.storage.compressedfile as viv_compfile
+import vivisect.storage.indexfile as viv_indexfile
+import vivisect.storage.journalfile as viv_journalfile
+import vivisect.storage.sqlitefile as viv_sqlitefile
+
+from vivisect.const import *
+
+def getTestWorkspace():
+    vw = vivisect.VivWorkspace()
+    vw.setMeta('Architecture', 'i386')
+    vw.setMeta('Platform', 'windows')
+    vw.setMeta('Format', 'blob')
+    vw.addMemoryMap(0x41410000, 7, 'test', '\x90' * 0x10 + '\xc3' * 0xf0)
+
+    vw.addLocation(0x41410020, 4, LOC_NUMBER)
+    vw.addLocation(0x41410024, 4, LOC_POINTER)
+    vw.addLocation(0x41410028, 4, LOC_NUMBER)
+    vw.delLocation(0x41410028)
+    vw.addXref(0x41410024, 0x41410020, REF_PTR)
+    vw.addXref(0x41410024, 0x41410010, REF_PTR)
+    vw.delXref((0x41410024, 0x41410010, REF_PTR, 0))
+    vw.makeName(0x41410020, 'first')
+    vw.makeName(0x41410020, 'second')
+    vw.makeFunction(0x41410010)
+    return vw
+
+def getSavedEvents(vw):
+    # (full saves write the compacted events)
+    return viv_compact.compactEvents(vw, vw.exportWorkspace())
+
+class IndexFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'test.viv')
+        self.vw = getTestWorkspace()
+        self.vw.setMeta('StorageModule', 'vivisect.storage.indexfile')
+        self.vw.setMeta('StorageName', self.fname)
+        self.vw.saveWorkspace(fullsave=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_vivisect_indexfile_roundtrip(self):
+        self.assertEqual(viv_storage.guessStorageModule(self.fname), 'vivisect.storage.indexfile')
+
+        vw = vivisect.VivWorkspace()
+        vw.loadWorkspace(self.fname)
+        self.assertEqual(vw.getLocations(), self.vw.getLocations())
+        self.assertEqual(vw.getXrefs(), self.vw.getXrefs())
+        self.assertEqual(vw.getNames(), self.vw.getNames())
+        self.assertEqual(vw.getFunctions(), self.vw.getFunctions())
+        self.assertEqual(vw.readMemory(0x41410000, 0x100), self.vw.readMemory(0x41410000, 0x100))
+        self.assertEqual(vw.getMeta('Platform'), 'windows')
+
+        # incremental saves land in the journal
+        self.vw.makeName(0x41410024, 'third')
+        self.vw.saveWorkspace(fullsave=False)
+        vw = vivisect.VivWorkspace()
+        vw.loadWorkspace(self.fname)
+        self.assertEqual(vw.getName(0x41410024), 'third')
+
+    def test_vivisect_indexfile_lazy(self):
+        ifile = viv_indexfile.IndexedWorkspaceFile(self.fname)
+        try:
+            self.assertEqual(ifile.getMeta('Architecture'), 'i386')
+            self.assertEqual(ifile.getMemoryMaps(), [(0x41410000, 0x100, 7, 'test')])
+            self.assertEqual(ifile.readMemory(0x4141000f, 2), '\x90\xc3')
+
+            self.assertEqual(ifile.getLocation(0x41410022), (0x41410020, 4, LOC_NUMBER, None))
+            self.assertEqual(ifile.getLocation(0x41410028), None)
+            for va in xrange(0x41410000, 0x41410100):
+                self.assertEqual(ifile.getLocation(va), self.vw.getLocation(va))
+
+            self.assertEqual(ifile.getXrefsFrom(0x41410024), [(0x41410024, 0x41410020, REF_PTR, 0)])
+            self.assertEqual(ifile.getXrefsTo(0x41410010), [])
+
+            self.assertEqual(ifile.getName(0x41410020), 'second')
+            self.assertEqual(ifile.getFunctions(), [0x41410010])
+            self.assertEqual(ifile.getFunctionMeta(0x41410010), self.vw.getFunctionMetaDict(0x41410010))
+
+            self.assertEqual(list(ifile.iterEvents()), getSavedEvents(self.vw))
+        finally:
+            ifile.close()
+
+    def test_vivisect_indexfile_unpackable(self):
+        # records that do not fit the index formats stay in the event stream
+        self.vw.addXref(0x41410024, 0x41410010, REF_PTR, -1)
+        self.vw.makeName(0x41410024, 'third')
+        self.vw.saveWorkspace(fullsave=True)
+
+        ifile = viv_indexfile.IndexedWorkspaceFile(self.fname)
+        try:
+            self.assertEqual(ifile.getXrefsTo(0x41410010), [])
+            self.assertEqual(ifile.getName(0x41410024), 'third')
+            self.assertEqual(list(ifile.iterEvents()), getSavedEvents(self.vw))
+        finally:
+            ifile.close()
+
+        vw = vivisect.VivWorkspace()
+        vw.loadWorkspace(self.fname)
+        self.assertEqual(vw.getXrefsTo(0x41410010), [(0x41410024, 0x41410010, REF_PTR, -1)])
+
+class BasicFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'test.viv')
+        self.vw = getTestWorkspace()
+        self.chunk_size = viv_storage.chunk_size
+        viv_storage.chunk_size = 5
+        viv_basicfile.vivEventsToFile(self.fname, self.vw.exportWorkspace())
+
+    def tearDown(self):
+        viv_storage.chunk_size = self.chunk_size
+        shutil.rmtree(self.tmpdir)
+
+    def test_vivisect_basicfile_chunks(self):
+        events = self.vw.exportWorkspace()
+        chunks = list(viv_basicfile.vivEventChunksFromFile(self.fname))
+        self.assertEqual(len(chunks), (len(events) + 4) / 5)
+        self.assertEqual(viv_basicfile.vivEventsFromFile(self.fname), events)
+
+        # appended changes are just more chunks
+        viv_basicfile.vivEventsAppendFile(self.fname, [(VWE_SETNAME, (0x41410024, 'third'))])
+        self.assertEqual(len(list(viv_basicfile.vivEventChunksFromFile(self.fname))), len(chunks) + 1)
+
+    def test_vivisect_basicfile_progress(self):
+        counts = []
+        def progress(count, rate):
+            counts.append(count)
+            self.assertTrue(rate > 0)
+
+        events = self.vw.exportWorkspace()
+        vw = vivisect.VivWorkspace()
+        vw.loadWorkspace(self.fname, progress=progress)
+        self.assertEqual(vw.getLocations(), self.vw.getLocations())
+        self.assertEqual(vw.getXrefs(), self.vw.getXrefs())
+        self.assertEqual(vw.getNames(), self.vw.getNames())
+        self.assertEqual(counts[-1], len(events))
+
+    def test_vivisect_server_stream(self):
+        counts = []
+        def progress(count, rate):
+            counts.append(count)
+
+        server = viv_server.VivServer(self.tmpdir)
+        self.assertEqual(server.listWorkspaces(), ['test.viv'])
+
+        events = []
+        chan = server.createEventChannel('test.viv', progress=progress)
+        while len(events) < len(self.vw.exportWorkspace()):
+            events.extend(server.getNextEvents(chan))
+        self.assertEqual(events, self.vw.exportWorkspace())
+
+        # once the channel is streamed, new events follow along
+        server._fireEvent('test.viv', VWE_COMMENT, (0x41410024, 'hi'))
+        self.assertEqual(server.getNextEvents(chan), [(VWE_COMMENT, (0x41410024, 'hi'))])
+        self.assertEqual(counts[-1], len(self.vw.exportWorkspace()))
+
+    def test_vivisect_server_stream_error(self):
+        # a file which fails to load shuts the channel down (after
+        # the events streamed so far)
+        with file(self.fname, 'ab') as f:
+            f.write('\xff\xff')
+
+        server = viv_server.VivServer(self.tmpdir)
+        chan = server.createEventChannel('test.viv')
+        events = []
+        def getAll():
+            for i in xrange(100):
+                events.extend(server.getNextEvents(chan))
+
+        self.assertRaises(e_threads.QueueShutdown, getAll)
+        self.assertEqual(events, self.vw.exportWorkspace())
+
+    def test_vivisect_server_stream_client(self):
+        # a client which can't transfer the file only returns from
+        # connecting once every streamed event has arrived
+        server = viv_server.VivServer(self.tmpdir)
+        def noTransfer(wsname):
+            raise Exception('no transfers')
+        server.openTransfer = noTransfer
+
+        vivEventChunksFromFile = viv_basicfile.vivEventChunksFromFile
+        def slowChunks(filename):
+            for events in vivEventChunksFromFile(filename):
+                for evt in events:
+                    time.sleep(0.01)
+                    yield [evt]
+
+        viv_basicfile.vivEventChunksFromFile = slowChunks
+        try:
+            vw = vivisect.VivWorkspace()
+            cli = viv_server.VivServerClient(vw, server, 'test.viv', cachedir=os.path.join(self.tmpdir, 'cache'))
+            vw.initWorkspaceClient(cli)
+        finally:
+            viv_basicfile.vivEventChunksFromFile = vivEventChunksFromFile
+
+        self.assertFalse(cli.transferred)
+        self.assertEqual(vw.getLocations(), self.vw.getLocations())
+        self.assertEqual(vw.getNames(), self.vw.getNames())
+
+        # a failed stream is an error rather than a partial workspace
+        with file(self.fname, 'ab') as f:
+            f.write('\xff\xff')
+        vw = vivisect.VivWorkspace()
+        cli = viv_server.VivServerClient(vw, server, 'test.viv', cachedir=os.path.join(self.tmpdir, 'cache'))
+        self.assertRaises(Exception, vw.initWorkspaceClient, cli)
+
+    def connectClient(self, server, cachedir):
+        vw = vivisect.VivWorkspace()
+        cli = viv_server.VivServerClient(vw, server, 'test.viv', cachedir=cachedir)
+        vw.initWorkspaceClient(cli)
+        self.assertTrue(cli.transferred)
+        self.assertEqual(vw.getLocations(), self.vw.getLocations())
+        self.assertEqual(vw.getXrefs(), self.vw.getXrefs())
+        self.assertEqual(vw.getNames(), self.vw.getNames())
+        self.assertEqual(vw.readMemory(0x41410000, 0x100), self.vw.readMemory(0x41410000, 0x100))
+        return vw
+
+    def test_vivisect_server_transfer(self):
+        server = viv_server.VivServer(self.tmpdir)
+        cachedir = os.path.join(self.tmpdir, 'cache')
+
+        reads = []
+        readTransfer = server.readTransfer
+        def countReads(xferid, idx, offset, size):
+            buf = readTransfer(xferid, idx, offset, size)
+            reads.append(len(buf))
+            return buf
+        server.readTransfer = countReads
+
+        vw = self.connectClient(server, cachedir)
+        self.assertEqual(sum(reads), os.path.getsize(self.fname))
+
+        # events after the transfer point arrive through the channel
+        server._fireEvent('test.viv', VWE_COMMENT, (0x41410024, 'hi'))
+        for i in xrange(100):
+            if vw.getComment(0x41410024) != None:
+                break
+            time.sleep(0.1)
+        self.assertEqual(vw.getComment(0x41410024), 'hi')
+
+        # the server snapshots the workspace in the background
+        for i in xrange(100):
+            if not server.snapbusy:
+                break
+            time.sleep(0.1)
+        snapsize = os.path.getsize(viv_snapshot.getSnapshotName(self.fname))
+
+        # reconnects only transfer what is new (here, the snapshot)
+        del reads[:]
+        self.connectClient(server, cachedir)
+        self.assertEqual(sum(reads), snapsize)
+
+        # ...and resume partial transfers
+        wspath = os.path.join(cachedir, hashlib.md5('test.viv').hexdigest() + '.viv')
+        with file(wspath, 'r+b') as f:
+            f.truncate(100)
+        del reads[:]
+        self.connectClient(server, cachedir)
+        self.assertEqual(sum(reads), os.path.getsize(self.fname) - 100)
+
+        # (bytes which no longer match start over)
+        with file(wspath, 'r+b') as f:
+            f.write('VIVX')
+        del reads[:]
+        self.connectClient(server, cachedir)
+        self.assertEqual(sum(reads), os.path.getsize(self.fname))
+
+class JournalFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'test.viv')
+        self.vw = getTestWorkspace()
+        self.vw.setMeta('StorageModule', 'vivisect.storage.journalfile')
+        self.vw.setMeta('StorageName', self.fname)
+        self.vw.saveWorkspace(fullsave=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def loadWorkspace(self):
+        vw = vivisect.VivWorkspace()
+        vw.loadWorkspace(self.fname)
+        return vw
+
+    def test_vivisect_journalfile_roundtrip(self):
+        self.assertEqual(viv_storage.guessStorageModule(self.fname), 'vivisect.storage.journalfile')
+        self.assertEqual(viv_journalfile.vivEventsFromFile(self.fname), getSavedEvents(self.vw))
+
+        vw = self.loadWorkspace()
+        self.assertEqual(vw.getLocations(), self.vw.getLocations())
+        self.assertEqual(vw.getXrefs(), self.vw.getXrefs())
+        self.assertEqual(vw.getNames(), self.vw.getNames())
+
+        size = os.path.getsize(self.fname)
+        self.vw.makeName(0x41410024, 'third')
+        self.vw.saveWorkspace(fullsave=False)
+        self.assertTrue(os.path.getsize(self.fname) > size)
+        self.assertEqual(self.loadWorkspace().getName(0x41410024), 'third')
+
+    def test_vivisect_journalfile_torn(self):
+        self.vw.makeName(0x41410024, 'third')
+        self.vw.saveWorkspace(fullsave=False)
+        size = os.path.getsize(self.fname)
+
+        # a save which died part way through...
+        self.vw.makeName(0x41410024, 'fourth')
+        self.vw.saveWorkspace(fullsave=False)
+        with file(self.fname, 'r+b') as f:
+            f.truncate(os.path.getsize(self.fname) - 3)
+
+        self.assertEqual(self.loadWorkspace().getName(0x41410024), 'third')
+        self.assertEqual(os.path.getsize(self.fname), size)
+
+        # corrupt data is truncated the same way
+        self.vw.makeName(0x41410024, 'fifth')
+        self.vw.saveWorkspace(fullsave=False)
+        with file(self.fname, 'r+b') as f:
+            f.seek(size + viv_journalfile.rec_size)
+            f.write('\xff')
+
+        self.assertEqual(self.loadWorkspace().getName(0x41410024), 'third')
+        self.assertEqual(os.path.getsize(self.fname), size)
+
+        # and appends after a torn tail land after the last checkpoint
+        self.vw.makeName(0x41410024, 'sixth')
+        self.vw.saveWorkspace(fullsave=False)
+        with file(self.fname, 'ab') as f:
+            f.write('\x01\xff\xff')
+        self.vw.makeName(0x41410020, 'seventh')
+        self.vw.saveWorkspace(fullsave=False)
+        vw = self.loadWorkspace()
+        self.assertEqual(vw.getName(0x41410020), 'seventh')
+        self.assertEqual(vw.getName(0x41410024), 'sixth')
+
+    def test_vivisect_journalfile_readonly(self):
+        self.vw.makeName(0x41410024, 'third')
+        self.vw.saveWorkspace(fullsave=False)
+        size = os.path.getsize(self.fname)
+        with file(self.fname, 'ab') as f:
+            f.write('\x01\xff\xff')
+
+        # (as if the file were read-only, even for root)
+        def rofile(filename, mode='r'):
+            if mode != 'rb':
+                raise IOError(13, 'Permission denied', filename)
+            return file(filename, mode)
+
+        viv_journalfile.file = rofile
+        try:
+            self.assertEqual(self.loadWorkspace().getName(0x41410024), 'third')
+            self.assertRaises(IOError, viv_journalfile.recoverFile, self.fname)
+        finally:
+            del viv_journalfile.file
+
+        self.assertEqual(os.path.getsize(self.fname), size + 3)
+        self.assertEqual(viv_journalfile.recoverFile(self.fname)[0], len(getSavedEvents(self.vw)))
+        self.assertEqual(os.path.getsize(self.fname), size)
+
+    def test_vivisect_journalfile_checkpoint(self):
+        total, journal = viv_journalfile.recoverFile(self.fname)
+        self.assertEqual(journal, 0)
+
+        # once the journal outgrows the base image it's rewritten
+        for i in xrange(total):
+            self.vw.makeName(0x41410024, 'name%d' % i)
+            self.vw.saveWorkspace(fullsave=False)
+            newtotal, journal = viv_journalfile.recoverFile(self.fname)
+            self.assertTrue(journal <= newtotal - journal)
+
+        self.assertTrue(newtotal > total)
+        self.assertEqual(self.loadWorkspace().getName(0x41410024), 'name%d' % (total - 1))
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'test.viv')
+        self.vw = getTestWorkspace()
+        # (poke cfginfo directly so the test doesn't autosave viv.json)
+        self.vw.config.viv.cfginfo['SaveSnapshots'] = True
+        self.vw.setMeta('StorageName', self.fname)
+        self.vw.saveWorkspace(fullsave=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertWorkspacesEqual(self, vw1, vw2):
+        self.assertEqual(vw1.getLocations(), vw2.getLocations())
+        self.assertEqual(vw1.getXrefs(), vw2.getXrefs())
+        self.assertEqual(sorted(vw1.getNames()), sorted(vw2.getNames()))
+        self.assertEqual(sorted(vw1.getFunctions()), sorted(vw2.getFunctions()))
+        self.assertEqual(vw1.getMemoryMaps(), vw2.getMemoryMaps())
+        self.assertEqual(vw1.getFunctionMetaDict(0x41410010), vw2.getFunctionMetaDict(0x41410010))
+        self.assertEqual(vw1.psize, vw2.psize)
+
+    def test_vivisect_snapshot_load(self):
+        self.assertTrue(os.path.isfile(viv_snapshot.getSnapshotName(self.fname)))
+
+        # changes saved after the snapshot are replayed
+        self.vw.makeName(0x41410024, 'third')
+        self.vw.saveWorkspace(fullsave=False)
+
+        events = viv_basicfile.vivEventsFromFile(self.fname)
+        vw = vivisect.VivWorkspace()
+        rest = viv_snapshot.loadSnapshot(vw, self.fname, viv_basicfile.vivEventChunksFromFile(self.fname))
+        self.assertEqual(list(rest), [events[-1:]])
+        self.assertEqual(vw.exportWorkspace(), events[:-1])
+
+        # (the events may end part way through a chunk)
+        rest = viv_snapshot.loadSnapshot(vivisect.VivWorkspace(), self.fname, [events[:3], events[3:]])
+        self.assertEqual(list(rest), [events[-1:]])
+
+        vw = vivisect.VivWorkspace()
+        vw.loadWorkspace(self.fname)
+        self.assertWorkspacesEqual(vw, self.vw)
+        self.assertEqual(vw.getName(0x41410024), 'third')
+        self.assertEqual(vw.exportWorkspace()[:len(events)], events)
+        self.assertEqual(vw.arch.getPointerSize(), 4)
+        self.assertEqual(vw.parseOpcode(0x41410010).mnem, 'ret')
+
+    def test_vivisect_snapshot_compact(self):
+        # full saves write compacted files without touching our events
+        events = list(self.vw.exportWorkspace())
+        self.vw.saveWorkspace(fullsave=True)
+        self.assertEqual(self.vw.exportWorkspace(), events)
+        self.assertTrue(len(viv_basicfile.vivEventsFromFile(self.fname)) < len(events))
+
+        self.vw.makeName(0x41410024, 'third')
+        self.vw.saveWorkspace(fullsave=False)
+        self.assertEqual(self.vw.exportWorkspaceChanges(), [])
+
+        vw = vivisect.VivWorkspace()
+        vw.loadWorkspace(self.fname)
+        self.assertWorkspacesEqual(vw, self.vw)
+        self.assertEqual(vw.getName(0x41410024), 'third')
+
+        # save, compact, then incremental save (which must be a full save)
+        self.vw.compactWorkspace()
+        self.assertEqual(self.vw.exportWorkspaceChanges(), self.vw.exportWorkspace())
+        self.vw.makeName(0x41410028, 'fourth')
+        self.vw.saveWorkspace(fullsave=False)
+        self.assertEqual(self.vw.exportWorkspaceChanges(), [])
+        self.assertEqual(viv_basicfile.vivEventsFromFile(self.fname), self.vw.exportWorkspace())
+
+        self.vw.makeName(0x4141002c, 'fifth')
+        self.vw.saveWorkspace(fullsave=False)
+
+        vw = vivisect.VivWorkspace()
+        vw.loadWorkspace(self.fname)
+        self.assertWorkspacesEqual(vw, self.vw)
+        self.assertEqual(vw.getName(0x41410028), 'fourth')
+        self.assertEqual(vw.getName(0x4141002c), 'fifth')
+
+    def test_vivisect_snapshot_mismatch(self):
+        events = viv_basicfile.vivEventsFromFile(self.fname)
+
+        version = viv_snapshot.snapshot_version
+        viv_snapshot.snapshot_version += 1
+        try:
+            self.assertEqual(viv_snapshot.loadSnapshot(vivisect.VivWorkspace(), self.fname, [events]), None)
+        finally:
+            viv_snapshot.snapshot_version = version
+
+        # a workspace rewritten without a new snapshot is replayed
+        self.vw.config.viv.cfginfo['SaveSnapshots'] = False
+        self.vw.makeName(0x41410024, 'third')
+        self.vw.saveWorkspace(fullsave=True)
+        self.assertFalse(os.path.exists(viv_snapshot.getSnapshotName(self.fname)))
+
+        events = viv_basicfile.vivEventsFromFile(self.fname)
+        self.assertEqual(viv_snapshot.loadSnapshot(vivisect.VivWorkspace(), self.fname, [events]), None)
+
+        vw = vivisect.VivWorkspace()
+        vw.loadWorkspace(self.fname)
+        self.assertWorkspacesEqual(vw, self.vw)
+        self.assertEqual(vw.getName(0x41410024), 'third')
+
+    def test_vivisect_snapshot_digest(self):
+        # (hashed a few bytes at a time so the reads are split)
+        readsize = viv_snapshot.snapshot_readsize
+        viv_snapshot.snapshot_readsize = 0x40
+        try:
+            fsize = os.path.getsize(self.fname)
+            digest = viv_snapshot._hashFile(self.fname, fsize)
+            self.assertNotEqual(viv_snapshot._hashFile(self.fname, fsize - 1), digest)
+            self.assertEqual(viv_snapshot._hashFile(self.fname, fsize + 1), None)
+
+            # a change anywhere (not just at the ends) is caught
+            for off in (fsize / 2, fsize - 1):
+                with file(self.fname, 'r+b') as f:
+                    f.seek(off)
+                    byte = f.read(1)
+                    f.seek(off)
+                    f.write(chr(ord(byte) ^ 1))
+                self.assertNotEqual(viv_snapshot._hashFile(self.fname, fsize), digest)
+                digest = viv_snapshot._hashFile(self.fname, fsize)
+        finally:
+            viv_snapshot.snapshot_readsize = readsize
+
+class BlobStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.blobdir = os.path.join(self.tmpdir, 'blobs')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def saveTestWorkspace(self, wsname, modname='vivisect.storage.basicfile'):
+        fname = os.path.join(self.tmpdir, wsname)
+        vw = getTestWorkspace()
+        vw.config.viv.cfginfo['BlobStore'] = self.blobdir
+        vw.setMeta('StorageModule', modname)
+        vw.setMeta('StorageName', fname)
+        vw.saveWorkspace()
+        return fname
+
+    def test_vivisect_blobstore_shared(self):
+        fname1 = self.saveTestWorkspace('test1.viv')
+        fname2 = self.saveTestWorkspace('test2.viv', modname='vivisect.storage.journalfile')
+
+        # both workspaces reference the same single blob
+        blobs = [ fnames for dname, dnames, fnames in os.walk(self.blobdir) if fnames ]
+        self.assertEqual(len(blobs), 1)
+        self.assertEqual(len(blobs[0]), 1)
+
+        vws = []
+        for fname in (fname1, fname2):
+            vw = vivisect.VivWorkspace()
+            vw.config.viv.cfginfo['BlobStore'] = self.blobdir
+            vw.loadWorkspace(fname)
+            vws.append(vw)
+
+        offset, bytez = vws[0].getByteDef(0x41410000)
+        self.assertTrue(isinstance(bytez, mmap.mmap))
+        self.assertTrue(vws[1].getByteDef(0x41410000)[1] is bytez)
+        self.assertEqual(vws[0].readMemory(0x4141000f, 2), '\x90\xc3')
+        self.assertEqual(vws[0].parseOpcode(0x41410000).mnem, 'nop')
+
+        # writes leave the blob alone
+        with vws[0].getAdminRights():
+            vws[0].writeMemory(0x41410000, 'AAAA')
+        self.assertEqual(vws[0].readMemory(0x41410000, 5), 'AAAA\x90')
+        self.assertEqual(bytez[:5], '\x90' * 5)
+
+        # the mmap (and its fd) goes away with the workspaces using it
+        store = viv_blobs.getBlobStore(self.blobdir)
+        self.assertEqual(store._maps.values(), [bytez])
+        del vws, vw, bytez
+        gc.collect()
+        self.assertEqual(store._maps.values(), [])
+
+    def test_vivisect_blobstore_missing(self):
+        fname = self.saveTestWorkspace('test.viv')
+        vw = vivisect.VivWorkspace()
+        self.assertRaises(vivisect.InvalidWorkspace, vw.loadWorkspace, fname)
+
+        # without a store, the bytes are saved in the workspace again
+        vw = vivisect.VivWorkspace()
+        vw.config.viv.cfginfo['BlobStore'] = self.blobdir
+        vw.loadWorkspace(fname)
+        vw.config.viv.cfginfo['BlobStore'] = ''
+        vw.saveWorkspace()
+        events = viv_basicfile.vivEventsFromFile(fname)
+        mbytes = [ einfo[3] for event, einfo in events if event == VWE_ADDMMAP ]
+        self.assertEqual(mbytes, ['\x90' * 0x10 + '\xc3' * 0xf0])
+
+class SqliteFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'test.viv')
+        self.vw = getTestWorkspace()
+        self.vw.setComment(0x41410020, 'a number')
+        self.vw.addVaSet('testset', (('va', VASET_ADDRESS), ('name', VASET_STRING)))
+        self.vw.setVaSetRow('testset', (0x41410020, 'first'))
+        self.vw.addFile('test', 0x41410000, '00' * 16)
+        self.vw.addSegment(0x41410000, 0x80, '.text', 'test')
+        self.vw.setMeta('StorageModule', 'vivisect.storage.sqlitefile')
+        self.vw.setMeta('StorageName', self.fname)
+        self.vw.saveWorkspace(fullsave=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertLazyEqual(self, vw):
+        lvw = viv_sqlitefile.openWorkspace(self.fname)
+        try:
+            for va in xrange(0x41410000, 0x41410100):
+                self.assertEqual(lvw.getLocation(va), vw.getLocation(va))
+                self.assertEqual(lvw.getCodeBlock(va), vw.getCodeBlock(va))
+                self.assertEqual(lvw.getXrefsFrom(va), vw.getXrefsFrom(va))
+                self.assertEqual(lvw.getXrefsTo(va), vw.getXrefsTo(va))
+                self.assertEqual(lvw.getName(va, smart=True), vw.getName(va, smart=True))
+                self.assertEqual(lvw.getFunction(va), vw.getFunction(va))
+                self.assertEqual(lvw.getComment(va), vw.getComment(va))
+
+            self.assertEqual(lvw.getLocations(), vw.getLocations())
+            self.assertEqual(lvw.getLocations(LOC_OP), vw.getLocations(LOC_OP))
+            self.assertEqual(lvw.getLocationCount(), vw.getLocationCount())
+            self.assertEqual(lvw.getXrefs(), vw.getXrefs())
+            self.assertEqual(sorted(lvw.getNames()), sorted(vw.getNames()))
+            self.assertEqual(sorted(lvw.getFunctions()), sorted(vw.getFunctions()))
+            self.assertEqual(lvw.getCodeBlocks(), vw.getCodeBlocks())
+            for fva in vw.getFunctions():
+                self.assertEqual(lvw.getFunctionMetaDict(fva), vw.getFunctionMetaDict(fva))
+                self.assertEqual(lvw.getFunctionBlocks(fva), vw.getFunctionBlocks(fva))
+            self.assertEqual(lvw.getVaSetNames(), vw.getVaSetNames())
+            self.assertEqual(lvw.getVaSet('testset'), vw.getVaSet('testset'))
+            self.assertEqual(lvw.getVaSetRow('testset', 0x41410020), vw.getVaSetRow('testset', 0x41410020))
+            self.assertEqual(lvw.readMemory(0x41410000, 0x100), vw.readMemory(0x41410000, 0x100))
+            self.assertEqual(lvw.parseOpcode(0x41410010).mnem, 'ret')
+
+            # (the range/coverage APIs too)
+            for va, size in ((0x41410000, 0x100), (0x41410000, 0x30), (0x41410011, 0x12), (0x41410022, 1), (0x41410030, 0x10)):
+                self.assertEqual(lvw.getLocationRange(va, size), vw.getLocationRange(va, size))
+                self.assertEqual(list(lvw.iterUndefinedRanges(va, size)), list(vw.iterUndefinedRanges(va, size)))
+                self.assertEqual(lvw.getNamesInRange(va, size), vw.getNamesInRange(va, size))
+                linfo = lvw.getRenderInfo(va, size)
+                info = vw.getRenderInfo(va, size)
+                self.assertEqual(linfo[:4], info[:4])
+                self.assertEqual(sorted(linfo[4].keys()), sorted(info[4].keys()))
+            self.assertEqual(list(lvw.iterUndefinedRanges()), list(vw.iterUndefinedRanges()))
+            self.assertEqual(lvw.getMemoryMapCoverage(), vw.getMemoryMapCoverage())
+            self.assertEqual(lvw.getSegmentCoverage(), vw.getSegmentCoverage())
+            self.assertEqual(lvw.getDiscoveredInfo(), vw.getDiscoveredInfo())
+            self.assertEqual(lvw.getLocationDistribution(), vw.getLocationDistribution())
+            self.assertEqual(lvw.getStats()['functions'], vw.getStats()['functions'])
+        finally:
+            lvw.close()
+
+    def test_vivisect_sqlitefile_roundtrip(self):
+        self.assertEqual(viv_storage.guessStorageModule(self.fname), 'vivisect.storage.sqlitefile')
+
+        vw = vivisect.VivWorkspace()
+        vw.loadFromFile(self.fname)
+        self.assertEqual(vw.getLocations(), self.vw.getLocations())
+        self.assertEqual(vw.getXrefs(), self.vw.getXrefs())
+        self.assertEqual(vw.getNames(), self.vw.getNames())
+        self.assertEqual(vw.getVaSet('testset'), self.vw.getVaSet('testset'))
+        self.assertEqual(vw.getMeta('Platform'), 'windows')
+
+    def test_vivisect_sqlitefile_lazy(self):
+        self.assertLazyEqual(self.vw)
+
+        lvw = viv_sqlitefile.openWorkspace(self.fname)
+        try:
+            self.assertEqual(len(lvw.getLocationRange(0x41410000, 0x30)), 6)
+            self.assertEqual(lvw.getRenderInfo(0x41410018, 0x10)[2], {0x41410020: 'second'})
+            self.assertEqual(lvw.getDiscoveredInfo()[:2], (9, 0x100 - 9))
+        finally:
+            lvw.close()
+
+    def test_vivisect_sqlitefile_changes(self):
+        # overlap, delete and rename things so the map spans change
+        self.vw.addLocation(0x41410022, 4, LOC_NUMBER)
+        self.vw.delLocation(0x41410024)
+        self.vw.makeName(0x41410020, None)
+        self.vw.makeName(0x41410022, 'third')
+        self.vw.setComment(0x41410020, None)
+        self.vw.setVaSetRow('testset', (0x41410022, 'third'))
+        self.vw.delVaSetRow('testset', 0x41410020)
+        self.vw.makeFunction(0x41410000)
+        self.vw.delFunction(0x41410010)
+        self.vw.saveWorkspace(fullsave=False)
+        self.assertLazyEqual(self.vw)
+
+        lvw = viv_sqlitefile.openWorkspace(self.fname)
+        try:
+            self.assertEqual(lvw.vaByName('third'), 0x41410022)
+            self.assertEqual(lvw.vaByName(u'third'), 0x41410022)
+            self.assertEqual(lvw.vaByName('second'), None)
+        finally:
+            lvw.close()
+
+        # ...and the events match the tables
+        vw = vivisect.VivWorkspace()
+        vw.loadWorkspace(self.fname)
+        self.assertEqual(vw.getLocations(), self.vw.getLocations())
+        self.assertEqual(vw.getCodeBlocks(), self.vw.getCodeBlocks())
+
+    def test_vivisect_sqlitefile_readonly(self):
+        lvw = viv_sqlitefile.openWorkspace(self.fname)
+        try:
+            self.assertRaises(Exception, lvw.makeName, 0x41410020, 'nope')
+            self.assertRaises(Exception, lvw.saveWorkspace)
+            self.assertEqual(lvw.getName(0x41410020), 'second')
+        finally:
+            lvw.close()
+
+class CompressedFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'test.viv')
+        self.events_per_chunk = viv_compfile.events_per_chunk
+        viv_compfile.events_per_chunk = 5
+        self.map_chunk_size = viv_compfile.map_chunk_size
+        self.vw = getTestWorkspace()
+        self.vw.setMeta('StorageModule', 'vivisect.storage.compressedfile')
+        self.vw.setMeta('StorageName', self.fname)
+
+    def tearDown(self):
+        viv_compfile.events_per_chunk = self.events_per_chunk
+        viv_compfile.map_chunk_size = self.map_chunk_size
+        shutil.rmtree(self.tmpdir)
+
+    def test_vivisect_compressedfile_codecs(self):
+        events = self.vw.exportWorkspace()
+        for codec in viv_compfile.codecs.keys():
+            for workers in (1, 4):
+                viv_compfile.vivEventsToFile(self.fname, events, codec=codec, workers=workers)
+                self.assertEqual(viv_compfile.vivEventsFromFile(self.fname, workers=workers), events)
+
+    def test_vivisect_compressedfile_roundtrip(self):
+        self.vw.config.viv.cfginfo['CompressCodec'] = 'bz2'
+        self.vw.config.viv.cfginfo['CompressWorkers'] = 2
+        self.vw.saveWorkspace()
+        self.assertEqual(viv_storage.guessStorageModule(self.fname), 'vivisect.storage.compressedfile')
+
+        self.vw.makeName(0x41410024, 'third')
+        self.vw.saveWorkspace(fullsave=False)
+
+        vw = vivisect.VivWorkspace()
+        vw.loadFromFile(self.fname)
+        self.assertEqual(vw.getLocations(), self.vw.getLocations())
+        self.assertEqual(vw.getXrefs(), self.vw.getXrefs())
+        self.assertEqual(vw.getName(0x41410024), 'third')
+        self.assertEqual(vw.readMemory(0x41410000, 0x100), self.vw.readMemory(0x41410000, 0x100))
+
+    def test_vivisect_compressedfile_index(self):
+        events = self.vw.exportWorkspace()
+        viv_compfile.vivEventsToFile(self.fname, events)
+
+        infos = list(viv_compfile.iterChunkIndex(self.fname))
+        self.assertEqual(sum([ info.count for info in infos ]), len(events))
+
+        # memory maps are chunked alone, and any chunk may be read by itself
+        for info in infos:
+            chunk = viv_compfile.readChunk(self.fname, info)
+            self.assertEqual(chunk, events[info.first:info.first + info.count])
+            if VWE_ADDMMAP in [ evt[0] for evt in chunk ]:
+                self.assertEqual(info.count, 1)
+
+        # a corrupt chunk is detected rather than unpickled
+        with file(self.fname, 'r+b') as f:
+            f.seek(infos[-1].offset + viv_compfile.chunk_hdr_size)
+            f.write('\xff\xff\xff\xff')
+        self.assertRaises(vivisect.InvalidWorkspace, viv_compfile.vivEventsFromFile, self.fname)
+
+    def test_vivisect_compressedfile_bigmaps(self):
+        # big memory maps are saved as map bytes chunks (and joined again)
+        viv_compfile.map_chunk_size = 0x30
+        events = self.vw.exportWorkspace()
+        for workers in (1, 4):
+            viv_compfile.vivEventsToFile(self.fname, events, workers=workers)
+            self.assertEqual(viv_compfile.vivEventsFromFile(self.fname, workers=workers), events)
+
+        msizes = [ len(einfo[3]) for event, einfo in events if event == VWE_ADDMMAP ]
+        infos = list(viv_compfile.iterChunkIndex(self.fname))
+        mchunks = [ info for info in infos if info.kind == viv_compfile.CHUNK_MAPBYTES ]
+        self.assertEqual(len(mchunks), sum([ (size + 0x2f) / 0x30 for size in msizes ]))
+        self.assertEqual(sum([ info.rlen for info in mchunks ]), sum(msizes))
+
+        for info in infos:
+            if info.kind == viv_compfile.CHUNK_EVENTS:
+                self.assertEqual(viv_compfile.readChunk(self.fname, info), events[info.first:info.first + info.count])
+
+        # missing map bytes are detected
+        with file(self.fname, 'r+b') as f:
+            f.truncate(mchunks[-1].offset)
+        self.assertRaises(vivisect.InvalidWorkspace, viv_compfile.vivEventsFromFile, self.fname)
@@ -0,0 +1,389 @@
+import os
+import mmap
+import Queue
+import tempfile
+import threading
+import unittest
+
+import envi
+import vivisect
+import vivisect.base as viv_base
+import vivisect.parsers as viv_parsers
+import vivisect.remote.server as viv_server
+import vivisect.storage.blobstore as viv_blobs
+
+from vivisect.const import *
+
+class OldServer:
+    '''
+    A workspace server from before _fireEvents (one event at a time).
+    '''
+    def __init__(self):
+        self.fired = []
+        self.q = Queue.Queue()
+
+    def vprint(self, msg):
+        pass
+
+    def createEventChannel(self, wsname=None):
+        return 1
+
+    def exportWorkspace(self, wsname=None):
+        return []
+
+    def waitForEvents(self, chan):
+        return self.q.get()
+
+    def _fireEvent(self, *args, **kwargs):
+        self.fired.append((args, kwargs))
+
+def getMemWorkspace(size=0x1000):
+    vw = vivisect.VivWorkspace()
+    vw.setMeta('Architecture', 'i386')
+    vw.addMemoryMap(0x41410000, 7, 'none', '\x00' * size)
+    return vw
+
+class WorkspaceCoreTest(unittest.TestCase):
+
+    def test_vivisect_location_index(self):
+        vw = getMemWorkspace()
+        vw.addLocation(0x41410000, 4, LOC_NUMBER)
+        vw.addLocation(0x41410010, 4, LOC_IMPORT, 'kernel32.CreateFileA')
+        vw.addLocation(0x41410014, 4, LOC_IMPORT, 'kernel32.ReadFile')
+        vw.addLocation(0x41410020, 6, LOC_STRING)
+
+        self.assertEqual(vw.getLocationCount(), 4)
+        self.assertEqual(vw.getLocationCount(LOC_IMPORT), 2)
+        self.assertEqual(vw.getLocationCount(LOC_VFTABLE), 0)
+        self.assertEqual(len(vw.getLocations()), 4)
+        # (all locations come back in the order they were added)
+        self.assertEqual([ loc[L_VA] for loc in vw.getLocations() ],
+                         [0x41410000, 0x41410010, 0x41410014, 0x41410020])
+        self.assertEqual(list(vw.iterLocations()), vw.getLocations())
+        self.assertEqual(vw.getLocations(LOC_STRING), [(0x41410020, 6, LOC_STRING, None)])
+        self.assertEqual(vw.getLocations(LOC_IMPORT, 'kernel32.ReadFile'),
+                         [(0x41410014, 4, LOC_IMPORT, 'kernel32.ReadFile')])
+        self.assertEqual(list(vw.iterLocations(LOC_OP)), [])
+
+        vw.delLocation(0x41410010)
+        self.assertEqual(vw.getLocationCount(LOC_IMPORT), 1)
+        self.assertEqual(vw.getLocations(LOC_IMPORT, 'kernel32.CreateFileA'), [])
+        self.assertIsNone(vw.getLocation(0x41410010))
+
+        # getLocations() hands out a copy which is safe to mutate through
+        for lva, lsize, ltype, linfo in vw.getLocations(LOC_IMPORT):
+            vw.delLocation(lva)
+        self.assertEqual(vw.getImports(), [])
+
+    def test_vivisect_indexedlist(self):
+        il = viv_base.IndexedList([3, 1, 2, 1])
+        self.assertEqual(len(il), 4)
+        self.assertEqual(il.count(1), 2)
+
+        il.remove(1)
+        self.assertEqual(il.tolist(), [3, 2, 1])
+        self.assertTrue(1 in il)
+        il.remove(1)
+        self.assertFalse(1 in il)
+        self.assertRaises(ValueError, il.remove, 1)
+
+        # enough removals to force a compaction keep order intact
+        for i in xrange(5000):
+            il.append(i + 10)
+        for i in xrange(5000):
+            if i % 3:
+                il.remove(i + 10)
+        self.assertTrue(len(il._items) < 5002)
+        self.assertEqual(il.tolist(), [3, 2] + [ i + 10 for i in xrange(0, 5000, 3) ])
+        self.assertEqual(len(il), len(il.tolist()))
+
+    def test_vivisect_xref_index(self):
+        vw = getMemWorkspace()
+        vw.addXref(0x41410000, 0x41410100, REF_CODE, envi.BR_PROC)
+        vw.addXref(0x41410010, 0x41410100, REF_CODE, envi.BR_PROC)
+        vw.addXref(0x41410010, 0x41410100, REF_CODE, envi.BR_PROC)
+        vw.addXref(0x41410010, 0x41410200, REF_PTR)
+        vw.addXref(0x41410020, 0x41410100, REF_CODE)
+
+        # (all xrefs come back in the order they were added)
+        self.assertEqual(vw.getXrefs(), [(0x41410000, 0x41410100, REF_CODE, envi.BR_PROC),
+                                         (0x41410010, 0x41410100, REF_CODE, envi.BR_PROC),
+                                         (0x41410010, 0x41410200, REF_PTR, 0),
+                                         (0x41410020, 0x41410100, REF_CODE, 0)])
+        vw.delXref((0x41410020, 0x41410100, REF_CODE, 0))
+
+        self.assertEqual(vw.getXrefCount(), 3)
+        self.assertEqual(vw.getXrefCount(REF_CODE), 2)
+        self.assertEqual(len(vw.getXrefsTo(0x41410100)), 2)
+        self.assertEqual(vw.getXrefsFrom(0x41410010, rtype=REF_PTR), [(0x41410010, 0x41410200, REF_PTR, 0)])
+        self.assertEqual(vw.getXrefs(REF_PTR), [(0x41410010, 0x41410200, REF_PTR, 0)])
+        self.assertEqual(sorted(vw.getCallers(0x41410100)), [0x41410000, 0x41410010])
+
+        # deleted xrefs must leave every index
+        xref = (0x41410010, 0x41410100, REF_CODE, envi.BR_PROC)
+        vw.delXref(xref)
+        self.assertFalse(vw.isXref(xref))
+        self.assertEqual(vw.getXrefCount(), 2)
+        self.assertTrue(xref not in vw.getXrefs())
+        self.assertEqual(vw.getCallers(0x41410100), [0x41410000])
+        self.assertEqual(vw.getXrefsFrom(0x41410010), [(0x41410010, 0x41410200, REF_PTR, 0)])
+        self.assertRaises(Exception, vw.delXref, xref)
+
+    def test_vivisect_undefined_ranges(self):
+        vw = getMemWorkspace(0x100)
+        vw.addLocation(0x41410010, 4, LOC_NUMBER)
+        vw.addLocation(0x41410014, 4, LOC_NUMBER)
+        vw.addLocation(0x41410080, 0x10, LOC_PAD)
+
+        self.assertEqual(list(vw.iterUndefinedRanges()),
+                         [(0x41410000, 0x10), (0x41410018, 0x68), (0x41410090, 0x70)])
+        self.assertEqual(list(vw.iterUndefinedRanges(0x41410012, 0x10)), [(0x41410018, 0xa)])
+
+        # locations made while iterating are honored
+        ranges = []
+        for uva, usize in vw.iterUndefinedRanges():
+            ranges.append((uva, usize))
+            if uva == 0x41410018:
+                vw.addLocation(0x41410090, 4, LOC_NUMBER)
+        self.assertEqual(ranges[-1], (0x41410094, 0x6c))
+
+        self.assertEqual(vw.getLocationRange(0x4141000c, 0x10),
+                         [(0x4141000c, 4, LOC_UNDEF, None),
+                          (0x41410010, 4, LOC_NUMBER, None),
+                          (0x41410014, 4, LOC_NUMBER, None),
+                          (0x41410018, 4, LOC_UNDEF, None)])
+
+    def test_vivisect_coverage(self):
+        vw = getMemWorkspace(0x100)
+        vw.addMemoryMap(0x41420000, 6, 'data', '\x00' * 0x100)
+        vw.addSegment(0x41410000, 0x80, '.text', 'none')
+        vw.addSegment(0x41410080, 0x80, '.text2', 'none')
+
+        vw.addLocation(0x41410010, 4, LOC_NUMBER)
+        vw.addLocation(0x41410090, 8, LOC_STRING)
+        vw.addLocation(0x41420000, 4, LOC_POINTER)
+        vw.delLocation(0x41410010)
+        vw.addLocation(0x41410012, 4, LOC_NUMBER)
+
+        self.assertEqual(vw.getMemoryMapCoverage(),
+                         [(0x41410000, 0x100, 7, 'none', 12), (0x41420000, 0x100, 6, 'data', 4)])
+        self.assertEqual(vw.getSegmentCoverage(),
+                         [(0x41410000, 0x80, '.text', 'none', 4), (0x41410080, 0x80, '.text2', 'none', 8)])
+
+        info = vw.getDiscoveredInfo()
+        self.assertEqual(info[:2], (12, 0x100 - 12))
+        self.assertEqual(info[3], 3)
+
+        dist = vw.getLocationDistribution()
+        self.assertEqual(dist[LOC_NUMBER][1:3], (1, 4))
+        self.assertEqual(dist[LOC_STRING][1:3], (1, 8))
+
+    def test_vivisect_render_info(self):
+        vw = getMemWorkspace()
+        vw.addLocation(0x41410010, 4, LOC_NUMBER)
+        vw.addLocation(0x41410020, 4, LOC_NUMBER)
+        vw.makeName(0x41410010, 'num_one')
+        vw.makeName(0x41410018, 'undef_name')
+        vw.makeName(0x41410100, 'far_away')
+        vw.setComment(0x41410019, 'undef comment')
+        vw.setComment(0x41410020, 'number two')
+
+        self.assertEqual(vw.getNamesInRange(0x41410000, 0x20), [(0x41410010, 'num_one'), (0x41410018, 'undef_name')])
+        self.assertEqual(vw.getCommentsInRange(0x41410019, 1), [(0x41410019, 'undef comment')])
+
+        locs, funcs, names, cmnts, extras = vw.getRenderInfo(0x41410012, 0x10)
+        self.assertEqual(locs[0], (0x41410010, 4, LOC_NUMBER, None))
+        self.assertEqual(names, {0x41410010: 'num_one', 0x41410018: 'undef_name'})
+        self.assertEqual(cmnts, {0x41410019: 'undef comment', 0x41410020: 'number two'})
+
+        # renames and deletes are reflected
+        vw.makeName(0x41410018, None)
+        vw.makeName(0x41410010, 'num_uno')
+        vw.setComment(0x41410020, None)
+        batch = vw.getRenderInfoBatch([(0x41410000, 0x30), (0x41410100, 4)])
+        self.assertEqual(batch[0][2], {0x41410010: 'num_uno'})
+        self.assertEqual(batch[0][3], {0x41410019: 'undef comment'})
+        self.assertEqual(batch[1][2], {0x41410100: 'far_away'})
+
+    def test_vivisect_opcode_cache(self):
+        vw = getMemWorkspace()
+        vw.writeMemory(0x41410000, '\x90\x90\xc3')
+
+        op = vw.parseOpcode(0x41410000)
+        self.assertEqual(op.mnem, 'nop')
+        self.assertTrue(vw.parseOpcode(0x41410000) is op)
+        self.assertEqual(vw.getOpcodeCacheStats(), (1, 1, 1))
+
+        # writes drop any cached opcode which may overlap them
+        vw.parseOpcode(0x41410001)
+        vw.writeMemory(0x41410001, '\xcc')
+        self.assertEqual(vw.parseOpcode(0x41410001).mnem, 'int3')
+        self.assertEqual(vw.parseOpcode(0x41410000).mnem, 'nop')
+        self.assertTrue(vw.parseOpcode(0x41410000) is not op)
+
+        stats = vw.getStats()
+        self.assertEqual(stats['opcode_cache_hits'], 2)
+        self.assertEqual(stats['opcode_cache_misses'], 4)
+
+        vw.addMemoryMap(0x41420000, 7, 'more', '\x90' * 0x100)
+        self.assertEqual(vw.getOpcodeCacheStats()[2], 0)
+
+        # so does changing the (default) architecture
+        self.assertEqual(vw.parseOpcode(0x41420000).mnem, 'nop')
+        vw.setMeta('Architecture', 'arm')
+        self.assertEqual(vw.getOpcodeCacheStats()[2], 0)
+        self.assertEqual(vw.parseOpcode(0x41420000).mnem, 'umull')
+        vw.setMeta('Architecture', 'i386')
+
+        # least recently used opcodes are evicted first
+        # (poke cfginfo directly so the test doesn't autosave viv.json)
+        vw.config.viv.cfginfo['OpcodeCacheSize'] = 2
+        vw.parseOpcode(0x41420000)
+        vw.parseOpcode(0x41420001)
+        vw.parseOpcode(0x41420000)
+        vw.parseOpcode(0x41420002)
+        self.assertEqual(sorted(va for va, arch in vw._op_cache), [0x41420000, 0x41420002])
+
+    def test_vivisect_emulator_memory(self):
+        # emulators get their own copy of (written) workspace maps
+        vw = getMemWorkspace()
+        vw.writeMemory(0x41410010, 'AA')
+        emu = vw.getEmulator()
+        vw.writeMemory(0x41410010, 'ZZ')
+        self.assertEqual(emu.readMemory(0x41410010, 2), 'AA')
+
+        emu.writeMemory(0x41410020, 'QQ')
+        self.assertEqual(vw.readMemory(0x41410020, 2), '\x00\x00')
+
+    def test_vivisect_bulk_events(self):
+        vw = getMemWorkspace()
+        chan = vw.createEventChannel()
+
+        with vw.bulkEvents():
+            vw.addLocation(0x41410000, 4, LOC_NUMBER)
+            vw.makeName(0x41410000, 'bulk_one')
+            # handlers run right away, publishing waits for the block to exit
+            self.assertEqual(vw.getName(0x41410000), 'bulk_one')
+            self.assertRaises(Exception, vw.waitForEvents, chan, timeout=0.01)
+        self.assertEqual([ e for e, einfo in vw.waitForEvents(chan) ], [VWE_ADDLOCATION, VWE_SETNAME])
+
+        # only the thread inside the with block defers its events
+        with vw.bulkEvents():
+            thr = threading.Thread(target=vw.makeName, args=(0x41410004, 'other_thread'))
+            thr.start()
+            thr.join()
+            self.assertEqual(vw.waitForEvents(chan, timeout=5), [(VWE_SETNAME, (0x41410004, 'other_thread'))])
+
+        events = [ (VWE_ADDLOCATION, (0x41410010, 4, LOC_NUMBER, None)),
+                   (VWE_COMMENT, (0x41410010, 'bulk comment')) ]
+        vw._fireEvents(events)
+        self.assertEqual(vw.getComment(0x41410010), 'bulk comment')
+        self.assertEqual(vw.waitForEvents(chan), events)
+        self.assertEqual(vw.exportWorkspace()[-2:], events)
+
+        # replaying through the bulk path builds the same workspace
+        newvw = vivisect.VivWorkspace()
+        newvw.importWorkspace(vw.exportWorkspace())
+        self.assertEqual(newvw.getLocations(), vw.getLocations())
+        self.assertEqual(newvw.getNames(), vw.getNames())
+
+    def test_vivisect_old_server_events(self):
+        events = [ (VWE_ADDLOCATION, (0x41410010, 4, LOC_NUMBER, None)),
+                   (VWE_COMMENT, (0x41410010, 'bulk comment')) ]
+
+        server = OldServer()
+        vw = getMemWorkspace()
+        vw.initWorkspaceClient(server)
+        try:
+            with vw.bulkEvents():
+                vw._fireEvents(events)
+                self.assertEqual(server.fired, [])
+            self.assertEqual(server.fired, [ (etup, {'skip': 1}) for etup in events ])
+        finally:
+            vw.server = None
+            server.q.put([])
+
+        server = OldServer()
+        client = viv_server.VivServerClient(vw, server, 'test.viv')
+        client._fireEvents(events)
+        self.assertEqual(server.fired, [ (('test.viv',) + etup, {'local': False, 'skip': None}) for etup in events ])
+
+    def test_vivisect_compact_events(self):
+        vw = getMemWorkspace()
+        vw.addLocation(0x41410000, 4, LOC_NUMBER)
+        vw.addLocation(0x41410010, 4, LOC_POINTER)
+        vw.addXref(0x41410010, 0x41410000, REF_PTR)
+        for i in xrange(10):
+            vw.makeName(0x41410000, 'name_%d' % i)
+            vw.setComment(0x41410000, 'comment %d' % i)
+            vw.delXref((0x41410010, 0x41410000, REF_PTR, 0))
+            vw.delLocation(0x41410010)
+            vw.addLocation(0x41410010, 4, LOC_POINTER)
+            vw.addXref(0x41410010, 0x41410000, REF_PTR)
+        vw.makeName(0x41410020, 'gone')
+        vw.makeName(0x41410020, None)
+        vw.setComment(0x41410020, 'gone')
+        vw.setComment(0x41410020, None)
+
+        # overlapping locations must *not* be cancelled (del clears both)
+        vw.addLocation(0x41410040, 8, LOC_NUMBER)
+        vw.addLocation(0x41410044, 4, LOC_NUMBER)
+        vw.delLocation(0x41410040)
+
+        events = list(vw.exportWorkspace())
+        before, after = vw.compactWorkspace()
+        self.assertEqual(before, len(events))
+        self.assertTrue(after < before - 50)
+
+        old = vivisect.VivWorkspace()
+        old.importWorkspace(events)
+        new = vivisect.VivWorkspace()
+        new.importWorkspace(vw.exportWorkspace())
+        for wvw in (vw, new):
+            self.assertEqual(wvw.getLocations(), old.getLocations())
+            self.assertEqual(wvw.getXrefs(), old.getXrefs())
+            self.assertEqual(wvw.getNames(), old.getNames())
+            self.assertEqual(wvw.getComments(), old.getComments())
+            self.assertEqual(wvw.getLocation(0x41410044), old.getLocation(0x41410044))
+
+        self.assertEqual(vw.getName(0x41410000), 'name_9')
+        self.assertEqual(vw.getComment(0x41410000), 'comment 9')
+        self.assertEqual(vw.compactWorkspace(), (after, after))
+
+    def test_vivisect_map_input_files(self):
+        fd, fname = tempfile.mkstemp()
+        os.write(fd, '\x90' * 0x2000 + '\xc3hi\x00' + 'A' * 0x100)
+        os.close(fd)
+        try:
+            vw = vivisect.VivWorkspace()
+            vw.config.viv.cfginfo['MapInputFiles'] = True
+            vw.config.viv.parsers.blob.cfginfo['arch'] = 'i386'
+            vw.loadFromFile(fname, fmtname='blob')
+
+            va = vw.config.viv.parsers.blob.baseaddr
+            self.assertEqual(type(vw.getByteDef(va)[1]), mmap.mmap)
+            self.assertEqual(vw.parseOpcode(va + 0x2000).mnem, 'ret')
+            self.assertEqual(vw.readMemString(va + 0x2001), 'hi')
+            self.assertEqual(vw.asciiStringSize(va + 0x2001), 3)
+
+            # (an unaligned range is a buffer of an aligned mmap)
+            with file(fname, 'rb') as f:
+                bytez = viv_parsers.mapFileBytes(vw, f, 0x2001, 3)
+                self.assertEqual((type(bytez), bytez[:]), (buffer, 'hi\x00'))
+                self.assertEqual(viv_parsers.mapFileBytes(vw, f, 0x2001, 0x1000), None)
+
+            # the first write gives the map a private copy
+            vw.writeMemory(va, '\xcc')
+            self.assertEqual(vw.readMemory(va, 2), '\xcc\x90')
+            with file(fname, 'rb') as f:
+                self.assertEqual(f.read(1), '\x90')
+
+            # and saved events get the bytes (not the mmap)
+            events = list(viv_blobs.exportEvents(None, vw.exportWorkspace()))
+            self.assertEqual([ type(einfo[3]) for event, einfo in events if event == VWE_ADDMMAP ], [str])
+            new = vivisect.VivWorkspace()
+            new.importWorkspace(events)
+            self.assertEqual(new.readMemory(va + 0x2000, 4), '\xc3hi\x00')
+
+        finally:
+            os.unlink(fname)
@@ -0,0 +1,69 @@
+'''
+Benchmark the compressedfile storage codecs: the size of each workspace
+(relative to the basicfile size) against the save and load throughput
+(MB/s of pickled events).
+
+Usage: python -m vivisect.tools.compbench [-w workers] <file.viv> [...]
+'''
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+
+import vivisect
+import vivisect.storage.basicfile as viv_basicfile
+import vivisect.storage.compressedfile as viv_compfile
+
+def measure(events, rawsize, fname, codec, level, workers):
+    start = time.time()
+    viv_compfile.vivEventsToFile(fname, events, codec=codec, level=level, workers=workers)
+    savetime = time.time() - start
+
+    start = time.time()
+    count = len(viv_compfile.vivEventsFromFile(fname, workers=workers))
+    loadtime = time.time() - start
+    assert count == len(events)
+
+    mb = rawsize / (1024.0 * 1024.0)
+    return {
+        'size': os.path.getsize(fname),
+        'save': mb / max(savetime, 0.000001),
+        'load': mb / max(loadtime, 0.000001),
+    }
+
+def main(argv):
+    parser = optparse.OptionParser(usage='python -m vivisect.tools.compbench [-w workers] <file.viv> [...]')
+    parser.add_option('-w', '--workers', dest='workers', default=0, type='int', help='worker threads (0 for one per cpu)')
+    options, argv = parser.parse_args(argv)
+
+    if not argv:
+        parser.print_help()
+        return 1
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print('%-32s %-6s %5s %12s %7s %10s %10s' % ('file', 'codec', 'level', 'size(KB)', 'ratio', 'save MB/s', 'load MB/s'))
+        for fname in argv:
+            vw = vivisect.VivWorkspace()
+            vw.loadWorkspace(fname)
+            events = vw.exportWorkspace()
+
+            plain = os.path.join(tmpdir, 'plain.viv')
+            viv_basicfile.vivEventsToFile(plain, events)
+            rawsize = os.path.getsize(plain)
+            print('%-32s %-6s %5s %12d %7.2f' % (fname[-32:], 'none', '-', rawsize / 1024, 1.0))
+
+            for codec in sorted(viv_compfile.codecs.keys()):
+                for level in (1, 6, 9):
+                    res = measure(events, rawsize, os.path.join(tmpdir, 'comp.viv'), codec, level, options.workers)
+                    print('%-32s %-6s %5d %12d %7.2f %10.1f %10.1f' % (fname[-32:], codec, level, res['size'] / 1024,
+                                                                      float(rawsize) / res['size'], res['save'], res['load']))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
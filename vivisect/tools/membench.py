@@ -0,0 +1,106 @@
+'''
+Microbenchmark MemoryObject map lookups as the number of memory maps
+grows, comparing the bisect map index against a linear scan of the maps
+(which is what the index falls back to when maps overlap).
+
+Each round does getMemoryMap(), readMemory() and getByteDef() lookups
+at random addresses (repeating each address a few times, like opcode
+parsing does) plus isValidPointer() checks of unmapped addresses.
+
+With --snaps, it instead compares emulator style snapshot churn (restore
+a snapshot, do a few stack writes, take a snapshot) on a MemoryObject
+against the copy-on-write pages of a CowMemoryObject as the size of the
+written map grows.
+
+Usage: python -m vivisect.tools.membench [-n lookups] [--snaps] [mapcount|mapsize ...]
+'''
+import sys
+import time
+import random
+import optparse
+
+import envi.memory as e_mem
+
+def buildMemory(mapcount, linear=False):
+    mem = e_mem.MemoryObject()
+    for i in xrange(mapcount):
+        # (pages with gaps between them, added in a scrambled order)
+        va = 0x10000000 + ((i * 7919) % mapcount) * 0x2000
+        mem.addMemoryMap(va, e_mem.MM_RWX, 'map%d' % i, '\x90' * 0x1000)
+    if linear:
+        mem._map_overlap = True
+    return mem
+
+def measure(mem, vas, badvas):
+    start = time.time()
+    for va in vas:
+        mem.getMemoryMap(va)
+        mem.readMemory(va, 16)
+        mem.getByteDef(va)
+    for va in badvas:
+        mem.isValidPointer(va)
+    return (len(vas) * 3 + len(badvas)) / max(time.time() - start, 0.000001)
+
+def measureSnaps(mem, mapsize, paths):
+    rand = random.Random(0x5a5)
+    mem.addMemoryMap(0xbfb00000, e_mem.MM_READ_WRITE, '[stack]', '\xfe' * mapsize)
+    mem.addMemoryMap(0x10000000, e_mem.MM_RWX, 'code', '\x90' * 0x10000)
+    todo = [mem.getMemorySnap()]
+
+    start = time.time()
+    for i in xrange(paths):
+        mem.setMemorySnap(todo.pop(rand.randrange(len(todo))))
+        sp = 0xbfb00000 + mapsize - 0x100
+        for j in xrange(8):
+            mem.writeMemory(sp - rand.randrange(0x200), 'AAAA')
+        mem.readMemory(sp, 16)
+        # (a branch forks two paths)
+        snap = mem.getMemorySnap()
+        todo.extend([snap, snap])
+
+    return paths / max(time.time() - start, 0.000001)
+
+def mainSnaps(options, argv):
+    sizes = [ int(x, 0) for x in argv ]
+    if not sizes:
+        sizes = [0x1000, 0x8000, 0x40000, 0x100000]
+
+    print('%10s %14s %14s %8s' % ('mapsize', 'copy paths/s', 'cow paths/s', 'speedup'))
+    for mapsize in sizes:
+        paths = max(options.lookups / 10, 1)
+        copy = measureSnaps(e_mem.MemoryObject(), mapsize, paths)
+        cow = measureSnaps(e_mem.CowMemoryObject(), mapsize, paths)
+        print('%10d %14d %14d %7.1fx' % (mapsize, copy, cow, cow / copy))
+
+    return 0
+
+def main(argv):
+    parser = optparse.OptionParser(usage='python -m vivisect.tools.membench [-n lookups] [--snaps] [mapcount|mapsize ...]')
+    parser.add_option('-n', dest='lookups', default=20000, type='int', help='lookups per round')
+    parser.add_option('--snaps', dest='snaps', default=False, action='store_true', help='benchmark snapshot churn')
+    options, argv = parser.parse_args(argv)
+
+    if options.snaps:
+        return mainSnaps(options, argv)
+
+    counts = [ int(x) for x in argv ]
+    if not counts:
+        counts = [1, 10, 100, 500, 1000]
+
+    rand = random.Random(0x4074)
+    print('%8s %14s %14s %8s' % ('maps', 'linear/sec', 'indexed/sec', 'speedup'))
+    for mapcount in counts:
+        vas = []
+        while len(vas) < options.lookups:
+            va = 0x10000000 + rand.randrange(mapcount) * 0x2000 + rand.randrange(0x1000 - 0x20)
+            vas.extend([va, va + 1, va + 2, va + 3])
+        badvas = [ 0x10001000 + rand.randrange(mapcount) * 0x2000 for i in xrange(options.lookups / 4) ]
+
+        linear = measure(buildMemory(mapcount, linear=True), vas, badvas)
+        indexed = measure(buildMemory(mapcount), vas, badvas)
+        print('%8d %14d %14d %7.1fx' % (mapcount, linear, indexed, indexed / linear))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))